@@ -1,19 +1,77 @@
+"""Audio formats, one module each, looked up through CODECS.
+
+A format's module is only imported the first time it's needed (see load_module()), so e.g. a directory of FLACs never
+loads the MP4 reader."""
+
+import collections
+import importlib
+
+# every run writes MP3s, so that module is always loaded; its eyed3 import is deferred until needed
 from . import (
-    faac,
-    flac,
     mp3,
-    vorbis,
+    util,
 )
 
-# map of extensions to the audio format modules
-FMT_BY_EXT = {}
-for module in (faac, flac, mp3, vorbis):
-    for ext in module.EXTENSIONS:
-        if ext in FMT_BY_EXT:
-            raise Exception(
-                "Duplicate extension found among audio formats: {} found in {} and {}".format(
-                    ext,
-                    module.__name__,
-                    FMT_BY_EXT[ext].__name__,
-                ))
-        FMT_BY_EXT[ext] = module
+# what's known about a format without importing its module:
+#   name: its module in this package
+#   extensions: lowercase, with their period
+#   can_stream: decode_to_pipe() can feed the encoder directly, without an intermediate WAV
+#   batch_tags: read_tags_many() with the tool backend reads many files per process, rather than one process per file
+#   native_tags: the default tag backend reads in-process, without the format's command-line tools
+#   pcm_ratio: about how many bytes of WAV a byte of the format decodes to, for estimating free space (lossy formats
+#     assume 128 kbps)
+#   can_verify: the format carries a checksum of its audio, and make_verifier() checks the decoded WAV against it
+Codec = collections.namedtuple("Codec", (
+    "name",
+    "extensions",
+    "can_stream",
+    "batch_tags",
+    "native_tags",
+    "pcm_ratio",
+    "can_verify",
+))
+
+CODECS = (
+    Codec(name="faac", extensions=(".m4a", ".mp4", ".aac"), can_stream=True, batch_tags=False, native_tags=True, pcm_ratio=11.0, can_verify=False),
+    Codec(name="flac", extensions=(".flac",), can_stream=True, batch_tags=True, native_tags=True, pcm_ratio=2.0, can_verify=True),
+    # passed through rather than decoded
+    Codec(name="mp3", extensions=(".mp3",), can_stream=False, batch_tags=True, native_tags=True, pcm_ratio=11.0, can_verify=False),
+    Codec(name="vorbis", extensions=(".ogg", ".oga"), can_stream=True, batch_tags=False, native_tags=True, pcm_ratio=11.0, can_verify=False),
+    Codec(name="wav", extensions=(".wav",), can_stream=True, batch_tags=True, native_tags=True, pcm_ratio=1.0, can_verify=False),
+)
+
+
+def _build_codecs_by_ext(codecs):
+    codecs_by_ext = {}
+    for codec in codecs:
+        for ext in codec.extensions:
+            assert ext.startswith("."), "Extension {} of {} doesn't start with period.".format(ext, codec.name)
+            assert ext.lower() == ext, "Extension {} must be lowercase!".format(ext)
+            assert ext not in codecs_by_ext, "Extension {} claimed by multiple formats: {} and {}.".format(
+                ext, codec.name, codecs_by_ext[ext].name)
+            codecs_by_ext[ext] = codec
+    return codecs_by_ext
+
+# lowercase extension (with its period) -> Codec
+CODECS_BY_EXT = _build_codecs_by_ext(CODECS)
+
+
+def codec_for_filename(fn):
+    """The Codec handling fn (by extension, case-insensitively), or None"""
+    idx = fn.rfind(".")
+    if idx <= 0:
+        return None
+    return CODECS_BY_EXT.get(fn[idx:].lower())
+
+
+def load_module(codec):
+    """The module implementing codec, imported on first use"""
+    return importlib.import_module("." + codec.name, __name__)
+
+
+def module_for_filename(fn):
+    """The module handling fn, or None"""
+    codec = codec_for_filename(fn)
+    if codec is None:
+        return None
+    return load_module(codec)
@@ -1,27 +1,49 @@
+import hashlib
+import os
 import re
 import subprocess
 
+from . import (
+    mp3,
+    mp4meta,
+)
 from .util import (
+    hash_file,
+    InvalidMetadataException,
     maybe_convert_int,
     Tags,
 )
+from .. import trace
+from ..util import (
+    parallel_map,
+)
+
 
-EXTENSIONS = [".m4a", ".mp4", ".aac"]
+# "native" walks the MP4 atoms in-process (falling back to faad for raw ADTS streams, which have none), "faad" parses
+# `faad --info`
+TAG_BACKENDS = ("native", "faad")
+TAG_BACKEND = "native"
 
-def read_tags(fn):
-    output = subprocess.check_output([
+def read_tags(fn, backend=None):
+    backend = backend or TAG_BACKEND
+    assert backend in TAG_BACKENDS, "Unknown tag backend {}".format(backend)
+    if backend == "native":
+        try:
+            return mp4meta.read_tags(fn)
+        except InvalidMetadataException:
+            pass
+
+    output = trace.check_output([
         "faad",
         "--info",
         fn,
     ], stderr=subprocess.STDOUT).decode("utf8", "ignore")
 
     tags = {}
-    print output
     for line in output.split("\n"):
         match = re.match(r"(?P<key>.+?)(?:\s+)?:(?:\s+)?(?P<val>.+)", line)
         if match:
             tags[match.group("key")] = match.group("val")
-    print tags
 
     artist = tags.get("Artist")
 
@@ -64,9 +86,46 @@ def read_tags(fn):
     )
 
 
+def read_tags_many(fns, jobs=1, backend=None):
+    """Reads the tags of many files, returned in the order of fns. faad takes one file at a time, so the processes run
+    concurrently."""
+    backend = backend or TAG_BACKEND
+    if backend == "native":
+        return [read_tags(fn, backend=backend) for fn in fns]
+    return parallel_map(lambda fn: read_tags(fn, backend=backend), fns, jobs)
+
+
 def decode(fn, output_fn):
-    subprocess.check_call([
+    trace.check_call([
         "faad",
         "-o", output_fn,
         fn,
     ])
+
+
+def decode_to_pipe(fn):
+    """Starts decoding to WAV on stdout and returns the decoder process"""
+    # see flac.decode_to_pipe()
+    return trace.popen([
+        "faad",
+        "-w",
+        fn,
+    ], stdout=subprocess.PIPE, close_fds=True)
+
+
+def audio_payload_hash(fn):
+    """Hashes the audio (the mdat atoms), but not the tags, of fn. Raw ADTS streams have no atoms; like MP3s, the
+    frames between any ID3 tags are hashed."""
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        try:
+            mdats = [
+                (body, atom_end)
+                for name, body, atom_end in mp4meta.iter_atoms(f, 0, os.fstat(f.fileno()).st_size, fn)
+                if name == "mdat"
+            ]
+        except InvalidMetadataException:
+            return mp3.audio_payload_hash(fn)
+    for body, atom_end in mdats:
+        hash_file(fn, start=body, length=atom_end - body, h=h)
+    return h.hexdigest()
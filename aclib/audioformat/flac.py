@@ -1,13 +1,63 @@
+import collections
+import hashlib
+import itertools
+import struct
 import subprocess
 
+from . import (
+    vorbiscomment,
+    wav,
+)
 from .util import (
+    hash_file,
+    InvalidMetadataException,
     vorbiscomment_to_tags,
 )
+from .. import trace
+from ..util import (
+    parallel_map,
+)
+
+
+# files per metaflac invocation in read_tags_many
+READ_TAGS_BATCH_SIZE = 64
+
+FLAC_STREAMINFO_BLOCK = 0
+
+# bytes of decoded audio read from the decoder at a time when verifying
+VERIFY_BLOCK_SIZE = 1 << 16
 
-EXTENSIONS = [".flac"]
+# outcomes of verifying decoded audio: it matched the MD5 in STREAMINFO, or the encoder didn't store one
+VERIFIED = "verified"
+NO_MD5 = "no_md5"
 
-def read_tags(fn):
-    output = subprocess.check_output([
+# WAV stores 8-bit samples unsigned; the MD5 is of signed samples
+_SIGN_FLIP = "".join(chr(c ^ 0x80) for c in xrange(256))
+
+class Md5MismatchException(Exception):
+    # thrown when the decoded audio of a FLAC doesn't match the MD5 in its STREAMINFO
+    pass
+
+# md5 is the digest of the unencoded audio, or all zeroes if the encoder didn't compute one
+StreamInfo = collections.namedtuple("StreamInfo", (
+    "sample_rate",
+    "channels",
+    "bits_per_sample",
+    "total_samples",
+    "md5",
+))
+
+# "native" parses the metadata blocks in-process, "metaflac" shells out
+TAG_BACKENDS = ("native", "metaflac")
+TAG_BACKEND = "native"
+
+def read_tags(fn, backend=None):
+    backend = backend or TAG_BACKEND
+    assert backend in TAG_BACKENDS, "Unknown tag backend {}".format(backend)
+    if backend == "native":
+        return vorbiscomment_to_tags(vorbiscomment.read_flac_comments(fn))
+
+    output = trace.check_output([
         "metaflac",
         "--no-utf8-convert",
         "--export-tags-to=-",
@@ -17,9 +67,173 @@ def read_tags(fn):
     return vorbiscomment_to_tags(output)
 
 
-def decode(fn, output_fn):
-    subprocess.check_call([
+def read_tags_many(fns, jobs=1, backend=None):
+    """Reads the tags of many files, returned in the order of fns.
+
+    metaflac takes many files per invocation, so this spawns one process per batch and runs the batches concurrently."""
+    backend = backend or TAG_BACKEND
+    if backend == "native":
+        return [read_tags(fn, backend=backend) for fn in fns]
+
+    batches = [
+        fns[i:i + READ_TAGS_BATCH_SIZE]
+        for i in xrange(0, len(fns), READ_TAGS_BATCH_SIZE)
+    ]
+    return list(itertools.chain.from_iterable(parallel_map(_read_tags_batch, batches, jobs)))
+
+
+def _read_tags_batch(fns):
+    if len(fns) == 1:
+        # metaflac only prefixes lines with the filename when given several files
+        return [read_tags(fns[0], backend="metaflac")]
+
+    output = trace.check_output([
+        "metaflac",
+        "--no-utf8-convert",
+        "--export-tags-to=-",
+    ] + list(fns))
+
+    # files are listed in order, each line prefixed with "<filename>:"; files without tags print nothing.
+    # lines without a known prefix continue the current file's value.
+    lines_by_idx = [[] for _ in fns]
+    idx = None
+    for line in output.split("\n"):
+        for next_idx in xrange(idx or 0, len(fns)):
+            prefix = fns[next_idx] + ":"
+            if line.startswith(prefix):
+                idx = next_idx
+                line = line[len(prefix):]
+                break
+        if idx is not None:
+            lines_by_idx[idx].append(line)
+
+    return [
+        vorbiscomment_to_tags("\n".join(lines).decode("utf8", "ignore"))
+        for lines in lines_by_idx
+    ]
+
+
+def decode(fn, output_fn, verify=False):
+    """Decodes fn to the WAV file output_fn.
+
+    With verify, the audio is hashed as it's written and checked against the MD5 in STREAMINFO: returns VERIFIED or
+    NO_MD5, or raises an Md5MismatchException."""
+    if not verify:
+        trace.check_call([
+            "flac",
+            "-d", fn,
+            "-o", output_fn,
+        ])
+        return None
+
+    verifier = make_verifier(fn)
+    decoder = decode_to_pipe(fn)
+    with open(output_fn, "wb") as f:
+        while True:
+            buf = decoder.stdout.read(VERIFY_BLOCK_SIZE)
+            if not buf:
+                break
+            verifier.feed(buf)
+            f.write(buf)
+    decoder.stdout.close()
+
+    rc = trace.wait(decoder)
+    if rc:
+        raise subprocess.CalledProcessError(rc, decoder.trace_cmd)
+    return verifier.result()
+
+
+def decode_to_pipe(fn):
+    """Starts decoding to WAV on stdout and returns the decoder process"""
+    # close_fds: tracks are streamed concurrently, and a process of another track holding on to this pipe would keep
+    # the encoder from ever seeing its end (and this decoder from seeing SIGPIPE if the encoder dies)
+    return trace.popen([
         "flac",
         "-d", fn,
-        "-o", output_fn,
-    ])
+        "-c",
+    ], stdout=subprocess.PIPE, close_fds=True)
+
+
+class Md5Verifier(object):
+    """Hashes the decoded WAV stream of a FLAC as it's fed, to check it against the MD5 in STREAMINFO.
+
+    The MD5 is of the interleaved samples as little-endian signed integers, which is how WAV stores them but for
+    8-bit samples."""
+    def __init__(self, fn):
+        self.fn = fn
+        self.info = read_streaminfo(fn)
+        self._md5 = hashlib.md5()
+        self._header = ""
+        self._in_data = False
+        # bytes of audio left, if STREAMINFO knows; anything after (e.g. the WAV's pad byte) isn't audio
+        bytes_per_sample = (self.info.bits_per_sample + 7) // 8
+        self._remaining = self.info.total_samples * self.info.channels * bytes_per_sample or None
+
+
+    def feed(self, buf):
+        if self.info.md5 == "\0" * 16:
+            return
+        if not self._in_data:
+            self._header += buf
+            data_offset = wav.find_data(self._header)
+            if data_offset is None:
+                return
+            buf = self._header[data_offset:]
+            self._header = ""
+            self._in_data = True
+
+        if self._remaining is not None:
+            buf = buf[:self._remaining]
+            self._remaining -= len(buf)
+        if self.info.bits_per_sample <= 8:
+            buf = buf.translate(_SIGN_FLIP)
+        self._md5.update(buf)
+
+
+    def result(self):
+        """VERIFIED or NO_MD5, once everything has been fed. Raises an Md5MismatchException if the audio doesn't match."""
+        if self.info.md5 == "\0" * 16:
+            return NO_MD5
+        if self._md5.digest() != self.info.md5:
+            raise Md5MismatchException("The decoded audio of {} doesn't match the MD5 in its STREAMINFO ({}).".format(
+                self.fn,
+                "truncated" if self._remaining else "corrupt",
+            ))
+        return VERIFIED
+
+
+    def __repr__(self):
+        return "Md5Verifier({})".format(self.fn)
+
+
+def make_verifier(fn):
+    """A verifier to feed fn's decoded WAV stream to; see Md5Verifier"""
+    return Md5Verifier(fn)
+
+
+def read_streaminfo(fn):
+    blocks, _ = vorbiscomment.read_flac_blocks(fn, (FLAC_STREAMINFO_BLOCK,))
+    data = blocks.get(FLAC_STREAMINFO_BLOCK, "")
+    if len(data) < 34:
+        raise InvalidMetadataException("No STREAMINFO block in {}.".format(fn))
+
+    # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1, 36 bits total samples
+    packed, = struct.unpack(">Q", data[10:18])
+    return StreamInfo(
+        sample_rate=packed >> 44,
+        channels=((packed >> 41) & 0x7) + 1,
+        bits_per_sample=((packed >> 36) & 0x1f) + 1,
+        total_samples=packed & 0xfffffffff,
+        md5=data[18:34],
+    )
+
+
+def audio_payload_hash(fn):
+    """Hashes the audio, but not the tags, of fn"""
+    info = read_streaminfo(fn)
+    if info.md5 != "\0" * 16:
+        # the encoder already hashed the audio for us
+        return hashlib.sha1("flac-md5:{}:{}".format(info.md5.encode("hex"), info.total_samples)).hexdigest()
+
+    _, audio_offset = vorbiscomment.read_flac_blocks(fn, ())
+    return hash_file(fn, start=audio_offset).hexdigest()
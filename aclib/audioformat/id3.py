@@ -0,0 +1,233 @@
+"""Fast, header-only reader for ID3v2.3/ID3v2.4 tags.
+
+Reads just the tag at the start of the file (never the audio frames) and decodes the handful of frames we map to
+Tags. Anything unusual (ID3v2.2, unsynchronisation, extended headers, compressed/encrypted frames, ID3v1-only files)
+raises InvalidMetadataException so the caller can fall back to eyed3."""
+
+import collections
+import struct
+
+from .util import (
+    InvalidMetadataException,
+    maybe_convert_int,
+    Tags,
+)
+
+ID3_HEADER_SIZE = 10
+
+# an ID3v1 tag is the last 128 bytes of the file, starting with "TAG"
+ID3V1_SIZE = 128
+
+# tag header flags
+FLAG_UNSYNC = 0x80
+FLAG_EXTENDED_HEADER = 0x40
+FLAG_FOOTER = 0x10
+
+# frame format flags we don't handle: v2.3 compression/encryption/grouping, v2.4 grouping/compression/encryption/
+# unsynchronisation/data length indicator
+UNSUPPORTED_FRAME_FLAGS = {
+    3: 0xe0,
+    4: 0x4f,
+}
+
+ENCODINGS = {
+    "\x00": "latin_1",
+    "\x01": "utf_16",
+    "\x02": "utf_16_be",
+    "\x03": "utf_8",
+}
+
+# frames to look in for the year, in the order eyed3's getBestDate() prefers them (v2.4 only: TDRL)
+YEAR_FRAMES = ("TDOR", "XDOR", "TORY", "TDRL", "TDRC", "TYER")
+
+# version is (major, revision), e.g. (4, 0); frames maps frame ids to the raw bodies of every such frame
+Id3Frames = collections.namedtuple("Id3Frames", ("version", "frames"))
+
+
+def read_frames(fn):
+    """Reads the raw frames of the ID3v2 tag at the start of fn, or returns None if there isn't one"""
+    with open(fn, "rb") as f:
+        header = f.read(ID3_HEADER_SIZE)
+        if len(header) < ID3_HEADER_SIZE or header[:3] != "ID3":
+            return None
+
+        major, revision, flags = ord(header[3]), ord(header[4]), ord(header[5])
+        if major not in UNSUPPORTED_FRAME_FLAGS:
+            raise InvalidMetadataException("Unsupported ID3v2.{} tag in {}.".format(major, fn))
+        if flags & (FLAG_UNSYNC | FLAG_EXTENDED_HEADER):
+            raise InvalidMetadataException("Unsupported ID3 tag flags ({:#x}) in {}.".format(flags, fn))
+
+        data = f.read(_syncsafe(header[6:10]))
+
+    frames = collections.defaultdict(list)
+    pos = 0
+    while pos + ID3_HEADER_SIZE <= len(data):
+        frame_id = data[pos:pos + 4]
+        if frame_id[0] == "\0":
+            # padding
+            break
+
+        size = _syncsafe(data[pos + 4:pos + 8]) if major == 4 else struct.unpack(">I", data[pos + 4:pos + 8])[0]
+        if ord(data[pos + 9]) & UNSUPPORTED_FRAME_FLAGS[major]:
+            raise InvalidMetadataException("Unsupported flags for frame {} in {}.".format(frame_id, fn))
+
+        pos += ID3_HEADER_SIZE
+        if pos + size > len(data):
+            raise InvalidMetadataException("Frame {} overruns the tag in {}.".format(frame_id, fn))
+        frames[frame_id].append(data[pos:pos + size])
+        pos += size
+
+    return Id3Frames(version=(major, revision), frames=dict(frames))
+
+
+def read_tags(fn):
+    id3_frames = read_frames(fn)
+    if id3_frames is None:
+        # possibly an ID3v1 tag, which eyed3 handles
+        raise InvalidMetadataException("No ID3v2 tag found in {}.".format(fn))
+    frames = id3_frames.frames
+
+    def get_text(frame_id):
+        if frame_id not in frames:
+            return None
+        return decode_text_frame(frames[frame_id][0], fn)
+
+    def get_comment():
+        if "COMM" not in frames:
+            return None
+        # encoding, 3 bytes of language, description, then the text
+        data = frames["COMM"][0]
+        encoding = data[:1]
+        _, text = _split_terminated(data[4:], encoding)
+        return _decode(text, encoding, fn)
+
+    def get_pair(frame_id):
+        text = get_text(frame_id)
+        if not text:
+            return None, None
+        n = text.split("/")
+        try:
+            return int(n[0]), (int(n[1]) if len(n) == 2 else None)
+        except ValueError:
+            return None, None
+
+    year = None
+    for frame_id in YEAR_FRAMES:
+        if frame_id == "TDRL" and id3_frames.version[0] != 4:
+            continue
+        text = get_text(frame_id)
+        if text:
+            year = maybe_convert_int(text[:4], fallback_on_failure=True)
+            if not isinstance(year, int):
+                raise InvalidMetadataException("Can't parse date {!r} in {}.".format(text, fn))
+            break
+
+    track_no, cd_tracks = get_pair("TRCK")
+    cd_no, _ = get_pair("TPOS")
+
+    genre_id, genre_name = None, None
+    genre_text = get_text("TCON")
+    if genre_text:
+        # eyed3 owns the genre table; deferred so the fast path doesn't pay for importing it up front
+        import eyed3.id3
+        try:
+            genre = eyed3.id3.Genre.parse(genre_text)
+        except ValueError:
+            genre = None
+        if genre:
+            genre_id, genre_name = genre.id, genre.name
+
+    return Tags(
+        album_artist=get_text("TPE2"),
+        artist=get_text("TPE1"),
+        title=get_text("TIT2"),
+        album=get_text("TALB"),
+        year=year,
+        track_no=track_no,
+        cd_no=cd_no,
+        cd_tracks=cd_tracks,
+        genre_id=genre_id,
+        genre_name=genre_name,
+        comment=get_comment() or None,
+        composer=get_text("TCOM") or None,
+        original_artist=get_text("TOPE") or None,
+        encoded_by=get_text("TENC") or None,
+    )
+
+
+def tag_size(fn):
+    """The size of the ID3v2 tag (of any version) at the start of fn, including its header, padding and footer; 0 if
+    there isn't one"""
+    with open(fn, "rb") as f:
+        header = f.read(ID3_HEADER_SIZE)
+    if len(header) < ID3_HEADER_SIZE or header[:3] != "ID3":
+        return 0
+    footer_size = ID3_HEADER_SIZE if ord(header[5]) & FLAG_FOOTER else 0
+    return ID3_HEADER_SIZE + _syncsafe(header[6:10]) + footer_size
+
+
+def add_padding(fn, padding):
+    """Appends padding bytes of padding to fn, which holds nothing but an ID3v2 tag without a footer"""
+    with open(fn, "r+b") as f:
+        header = f.read(ID3_HEADER_SIZE)
+        assert header[:3] == "ID3" and not ord(header[5]) & FLAG_FOOTER
+        size = _syncsafe(header[6:10]) + padding
+        f.seek(0, 2)
+        assert f.tell() == ID3_HEADER_SIZE + size - padding
+        f.write("\0" * padding)
+        f.seek(6)
+        f.write(_to_syncsafe(size))
+
+
+def has_v1_tag(fn):
+    with open(fn, "rb") as f:
+        f.seek(0, 2)
+        if f.tell() < ID3V1_SIZE:
+            return False
+        f.seek(-ID3V1_SIZE, 2)
+        return f.read(3) == "TAG"
+
+
+def decode_text_frame(data, fn):
+    """The text of the raw body of a text frame (e.g. from read_frames()), without its terminator"""
+    if not data:
+        return u""
+    return _decode(data[1:], data[0], fn)
+
+
+def _syncsafe(data):
+    return sum((ord(c) & 0x7f) << (7 * i) for i, c in enumerate(reversed(data)))
+
+
+def _to_syncsafe(n):
+    assert n < 1 << 28
+    return "".join(chr((n >> (7 * i)) & 0x7f) for i in reversed(xrange(4)))
+
+
+def _decode(data, encoding, fn):
+    if encoding not in ENCODINGS:
+        raise InvalidMetadataException("Unknown text encoding {!r} in {}.".format(encoding, fn))
+    codec = ENCODINGS[encoding]
+    if codec.startswith("utf_16") and len(data) % 2 and data[-1:] == "\0":
+        # stray terminator after UTF-16 text; common in the wild
+        data = data[:-1]
+    try:
+        return data.decode(codec).rstrip(u"\0")
+    except UnicodeDecodeError:
+        raise InvalidMetadataException("Can't decode text in {}.".format(fn))
+
+
+def _split_terminated(data, encoding):
+    """Splits a terminated string off the front of data"""
+    if encoding in ("\x01", "\x02"):
+        # the terminator is two null bytes on a character boundary
+        pos = 0
+        while True:
+            pos = data.find("\0\0", pos)
+            if pos < 0:
+                return data, ""
+            if pos % 2 == 0:
+                return data[:pos], data[pos + 2:]
+            pos += 1
+    head, _, tail = data.partition("\0")
+    return head, tail
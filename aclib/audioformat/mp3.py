@@ -1,14 +1,30 @@
 import collections
+import errno
+import os
+import shutil
+import struct
 import subprocess
 import sys
 
-import eyed3
-
+from . import (
+    id3,
+    wav,
+)
 from .util import (
+    hash_file,
+    InvalidMetadataException,
     Tags,
 )
+from .. import trace
+from ..util import (
+    job_count,
+    job_slot,
+    parallel_map,
+)
 
-EXTENSIONS = [".mp3"]
+# "native" reads just the ID3v2 frames (falling back to eyed3 for anything unusual), "eyed3" always uses eyed3
+TAG_BACKENDS = ("native", "eyed3")
+TAG_BACKEND = "native"
 
 LAME_OPTS = [
     "-m", "auto",
@@ -20,21 +36,362 @@ LAME_OPTS = [
     "--preset", "extreme",
 ]
 
+# most bytes of MP3 per byte of CD-quality PCM, at the highest bitrate LAME_OPTS allows
+MAX_ENCODED_RATIO = 320 / 1411.2
+
+# bytes read from a decoder at a time when its output goes to several encoders
+STREAM_BLOCK_SIZE = 1 << 16
+
+# bytes of padding reserved after the frames by write_tagged_copy(), so later tag edits fit in place
+TAG_PADDING = 4096
+
+# samples of each neighbouring track fed to the encoder at track boundaries by encode_gapless()
+GAPLESS_CONTEXT_SAMPLES = 1152
+
+# the LAME header stores encoder delay and padding as 12-bit values
+MAX_LAME_DELAY_PADDING = 0xfff
+
+class InvalidLameTagException(Exception):
+    pass
+
+# offset is the position of the LAME tag in the file; delay/padding are in samples per channel
+LameTag = collections.namedtuple("LameTag", (
+    "frame_offset",
+    "offset",
+    "sample_rate",
+    "samples_per_frame",
+    "num_frames",
+    "delay",
+    "padding",
+))
+
+
+def encode(wav_fns, output_dir, jobs=1, lame_opts=None):
+    """Encodes the provided WAV files into the given output directory, with lame_opts (LAME_OPTS by default)
 
-def encode(wav_fns, output_dir):
-    """Encodes the provided WAV files into the given output directory"""
+    With jobs > 1, tracks are encoded concurrently by encode_gapless(); otherwise by a single `lame --nogap`.
+    `jobs` may be a util.JobSlots shared with other discs."""
     assert all(fn.endswith(".wav") for fn in wav_fns)
-    subprocess.check_call(
-        ["lame"]
-        + LAME_OPTS
-        + [ "--nogaptags",
-            "--nogapout", output_dir,
-            "--nogap", ]
-        + wav_fns,
+    lame_opts = LAME_OPTS if lame_opts is None else lame_opts
+    if encode_mode(len(wav_fns), jobs) == "gapless":
+        return encode_gapless(wav_fns, output_dir, jobs, lame_opts=lame_opts)
+
+    with job_slot(jobs):
+        trace.check_call(
+            ["lame"]
+            + lame_opts
+            + [ "--nogaptags",
+                "--nogapout", output_dir,
+                "--nogap", ]
+            + wav_fns,
+        )
+
+
+def encode_mode(num_tracks, jobs):
+    """How encode() will encode a disc: "gapless" for encode_gapless(), "nogap" for a single lame --nogap"""
+    if job_count(jobs) > 1 and num_tracks > 1:
+        return "gapless"
+    return "nogap"
+
+
+def encode_gapless(wav_fns, output_dir, jobs, lame_opts=None):
+    """Encodes each WAV file with its own lame process, up to `jobs` at a time, while keeping the album gapless.
+
+    Each track is encoded with up to GAPLESS_CONTEXT_SAMPLES of its neighbours' audio on either side, so the encoder
+    sees a continuous signal across track boundaries, as it would in a single --nogap run. The borrowed samples are
+    then added to the encoder delay/padding in each file's LAME header so that gapless decoders trim them again."""
+    assert all(fn.endswith(".wav") for fn in wav_fns)
+    lame_opts = LAME_OPTS if lame_opts is None else lame_opts
+    infos = [wav.read_wav_info(fn) for fn in wav_fns]
+
+    def _compatible(a, b):
+        return (a.channels, a.sample_rate, a.block_align) == (b.channels, b.sample_rate, b.block_align)
+
+    def _encode(idx):
+        fn, info = wav_fns[idx], infos[idx]
+
+        prefix = suffix = ""
+        if idx > 0 and _compatible(infos[idx - 1], info):
+            prefix = wav.read_pcm(wav_fns[idx - 1], infos[idx - 1], -GAPLESS_CONTEXT_SAMPLES, GAPLESS_CONTEXT_SAMPLES)
+        if idx + 1 < len(wav_fns) and _compatible(infos[idx + 1], info):
+            suffix = wav.read_pcm(wav_fns[idx + 1], infos[idx + 1], 0, GAPLESS_CONTEXT_SAMPLES)
+
+        output_fn = os.path.join(output_dir, os.path.splitext(os.path.basename(fn))[0] + ".mp3")
+        encoder = trace.popen(
+            ["lame"]
+            + lame_opts
+            + ["-", output_fn],
+            stdin=subprocess.PIPE,
+            # tracks are encoded concurrently: a lame holding on to another's stdin would keep it from ever seeing the
+            # end of its input
+            close_fds=True,
+        )
+        try:
+            encoder.stdin.write(wav.wav_header(info, len(prefix) + info.data_size + len(suffix)))
+            encoder.stdin.write(prefix)
+            with open(fn, "rb") as f:
+                f.seek(info.data_offset)
+                remaining = info.data_size
+                while remaining:
+                    buf = f.read(min(remaining, 1 << 20))
+                    assert buf, "{} is shorter than its header claims".format(fn)
+                    encoder.stdin.write(buf)
+                    remaining -= len(buf)
+            encoder.stdin.write(suffix)
+            encoder.stdin.close()
+        except IOError as exc:
+            # lame went away early; its exit status below says why
+            if exc.errno != errno.EPIPE:
+                raise
+
+        rc = trace.wait(encoder)
+        if rc:
+            raise subprocess.CalledProcessError(rc, "lame")
+
+        add_lame_delay_padding(
+            output_fn,
+            len(prefix) // info.block_align,
+            len(suffix) // info.block_align,
+            info.sample_rate,
+        )
+
+    parallel_map(_encode, range(len(wav_fns)), jobs)
+
+
+def _crc16(data, crc=0):
+    # CRC-16 (polynomial 0x8005, reflected), as used for the LAME tag checksum
+    for c in data:
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ ord(c)) & 0xff]
+    return crc
+
+def _make_crc16_table():
+    table = []
+    for i in xrange(256):
+        crc = i
+        for _ in xrange(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC16_TABLE = _make_crc16_table()
+
+
+def _audio_offset(f):
+    """Offset of the first MPEG frame in the open file f, past any ID3v2 tag"""
+    f.seek(0)
+    head = f.read(10)
+    if head[:3] != "ID3":
+        return 0
+    offset = 10 + sum(ord(c) << (7 * i) for i, c in enumerate(reversed(head[6:10])))
+    if ord(head[5]) & 0x10:
+        # footer present
+        offset += 10
+    return offset
+
+
+def audio_payload_hash(fn):
+    """Hashes the MPEG frames of fn, ignoring its ID3v2 and ID3v1 tags"""
+    with open(fn, "rb") as f:
+        start = _audio_offset(f)
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if end - start >= 128:
+            f.seek(end - 128)
+            if f.read(3) == "TAG":
+                end -= 128
+    return hash_file(fn, start=start, length=max(0, end - start)).hexdigest()
+
+
+def read_lame_tag(fn):
+    """Reads the gapless information from the LAME header in the first frame of fn.
+
+    Returns None if there's no LAME header."""
+    with open(fn, "rb") as f:
+        frame_offset = _audio_offset(f)
+        f.seek(frame_offset)
+        frame = f.read(512)
+
+    if len(frame) < 4 or ord(frame[0]) != 0xff or ord(frame[1]) & 0xe0 != 0xe0:
+        raise InvalidLameTagException("No MPEG frame found at offset {} in {}.".format(frame_offset, fn))
+
+    version = (ord(frame[1]) >> 3) & 0x3
+    mpeg1 = (version == 3)
+    mono = ((ord(frame[3]) >> 6) & 0x3 == 3)
+    sample_rate = (44100, 48000, 32000, None)[(ord(frame[2]) >> 2) & 0x3]
+    if sample_rate is None or version == 1:
+        raise InvalidLameTagException("Invalid MPEG frame header in {}.".format(fn))
+    sample_rate //= {3: 1, 2: 2, 0: 4}[version]
+
+    # Xing/Info header sits right after the side information
+    pos = 4 + (
+        (17 if mono else 32) if mpeg1
+        else (9 if mono else 17)
+    )
+    if frame[pos:pos + 4] not in ("Xing", "Info"):
+        return None
+
+    flags, = struct.unpack(">I", frame[pos + 4:pos + 8])
+    pos += 8
+    num_frames = None
+    if flags & 0x1:
+        num_frames, = struct.unpack(">I", frame[pos:pos + 4])
+        pos += 4
+    for flag, size in ((0x2, 4), (0x4, 100), (0x8, 4)):
+        if flags & flag:
+            pos += size
+
+    if len(frame) < pos + 36 or frame[pos:pos + 4] not in ("LAME", "Lavf", "Lavc"):
+        return None
+
+    delay_padding = frame[pos + 21:pos + 24]
+    return LameTag(
+        frame_offset=frame_offset,
+        offset=frame_offset + pos,
+        sample_rate=sample_rate,
+        samples_per_frame=1152 if mpeg1 else 576,
+        num_frames=num_frames,
+        delay=(ord(delay_padding[0]) << 4) | (ord(delay_padding[1]) >> 4),
+        padding=((ord(delay_padding[1]) & 0xf) << 8) | ord(delay_padding[2]),
+    )
+
+
+def write_lame_delay_padding(fn, delay, padding):
+    """Rewrites the encoder delay/padding in fn's LAME header in place, updating the header's checksum"""
+    tag = read_lame_tag(fn)
+    if tag is None:
+        raise InvalidLameTagException("No LAME header found in {}.".format(fn))
+    if not (0 <= delay <= MAX_LAME_DELAY_PADDING and 0 <= padding <= MAX_LAME_DELAY_PADDING):
+        raise InvalidLameTagException("Delay ({}) and padding ({}) must fit in 12 bits.".format(delay, padding))
+
+    with open(fn, "r+b") as f:
+        f.seek(tag.frame_offset)
+        # the checksum covers the frame up to the checksum itself
+        checked = f.read(tag.offset - tag.frame_offset + 34)
+        lame_pos = tag.offset - tag.frame_offset
+        checked = (
+            checked[:lame_pos + 21]
+            + chr(delay >> 4) + chr(((delay & 0xf) << 4) | (padding >> 8)) + chr(padding & 0xff)
+            + checked[lame_pos + 24:]
+        )
+
+        f.seek(tag.frame_offset)
+        f.write(checked)
+        f.write(struct.pack(">H", _crc16(checked)))
+
+
+def add_lame_delay_padding(fn, extra_delay, extra_padding, input_sample_rate):
+    """Marks extra_delay samples at the start and extra_padding samples at the end of fn as not part of the track"""
+    tag = read_lame_tag(fn)
+    if tag is None:
+        raise InvalidLameTagException("No LAME header found in {}.".format(fn))
+
+    # lame may have resampled
+    scale = float(tag.sample_rate) / input_sample_rate
+    write_lame_delay_padding(
+        fn,
+        tag.delay + int(round(extra_delay * scale)),
+        tag.padding + int(round(extra_padding * scale)),
     )
 
 
-def read_tags(fn):
+def gapless_sample_count(fn):
+    """Number of samples per channel a gapless decoder produces for fn"""
+    tag = read_lame_tag(fn)
+    if tag is None or tag.num_frames is None:
+        raise InvalidLameTagException("No gapless information found in {}.".format(fn))
+    return tag.num_frames * tag.samples_per_frame - tag.delay - tag.padding
+
+
+def duration(fn):
+    """Seconds of audio in fn according to its LAME header, or None if it has no usable one"""
+    try:
+        tag = read_lame_tag(fn)
+    except InvalidLameTagException:
+        return None
+    if tag is None or tag.num_frames is None:
+        return None
+    return float(tag.num_frames * tag.samples_per_frame - tag.delay - tag.padding) / tag.sample_rate
+
+
+def encode_stream(decoder, output_fn, lame_opts=None):
+    """Encodes the WAV stream on the stdout of the `decoder` process into output_fn, with lame_opts (LAME_OPTS by
+    default).
+
+    Decoding and encoding overlap and no intermediate WAV is written. Each track is encoded on its own, so gapless
+    playback relies on the encoder delay/padding that lame records in the LAME header."""
+    encode_stream_many(decoder, [(output_fn, LAME_OPTS if lame_opts is None else lame_opts)])
+
+
+def encode_stream_many(decoder, outputs, observe=None):
+    """Like encode_stream(), but encodes the one decoded stream into every (output_fn, lame_opts) of outputs at once.
+
+    observe, if given, is called with each block of the stream as it's passed on, e.g. to hash it."""
+    assert outputs
+    if len(outputs) == 1 and observe is None:
+        # close_fds: see flac.decode_to_pipe()
+        encoders = [
+            trace.popen(["lame"] + outputs[0][1] + ["-", outputs[0][0]], stdin=decoder.stdout, close_fds=True),
+        ]
+    else:
+        # close_fds: an encoder holding on to another's stdin would keep it from ever seeing the end of its input
+        encoders = [
+            trace.popen(["lame"] + lame_opts + ["-", output_fn], stdin=subprocess.PIPE, close_fds=True)
+            for output_fn, lame_opts in outputs
+        ]
+        _tee(decoder.stdout, [encoder.stdin for encoder in encoders], observe)
+    # lame holds its own copy of the pipe; closing ours lets the decoder see SIGPIPE if lame dies
+    decoder.stdout.close()
+
+    encoder_rcs = [trace.wait(encoder) for encoder in encoders]
+    decoder_rc = trace.wait(decoder)
+    if decoder_rc:
+        raise subprocess.CalledProcessError(decoder_rc, "decoder for {}".format(outputs[0][0]))
+    for rc in encoder_rcs:
+        if rc:
+            raise subprocess.CalledProcessError(rc, "lame")
+
+
+def _tee(src, dsts, observe=None):
+    """Copies src to every file of dsts until it ends, then closes them, calling observe (if given) with every block.
+    A destination whose reader went away is dropped; once they all have, src is left unread."""
+    dsts = list(dsts)
+    while dsts:
+        buf = src.read(STREAM_BLOCK_SIZE)
+        if not buf:
+            break
+        if observe is not None:
+            observe(buf)
+        for dst in list(dsts):
+            try:
+                dst.write(buf)
+            except IOError as exc:
+                # that encoder went away early; its exit status says why
+                if exc.errno != errno.EPIPE:
+                    raise
+                dsts.remove(dst)
+                _close_quietly(dst)
+    for dst in dsts:
+        _close_quietly(dst)
+
+
+def _close_quietly(f):
+    try:
+        f.close()
+    except IOError as exc:
+        if exc.errno != errno.EPIPE:
+            raise
+
+
+def read_tags(fn, backend=None):
+    backend = backend or TAG_BACKEND
+    assert backend in TAG_BACKENDS, "Unknown tag backend {}".format(backend)
+    if backend == "native":
+        try:
+            return id3.read_tags(fn)
+        except InvalidMetadataException:
+            pass
+
+    import eyed3
     f = eyed3.load(unicode(fn, sys.getfilesystemencoding()))
     if f.tag is None:
         return Tags()
@@ -82,46 +439,87 @@ def read_tags(fn):
     )
 
 
+def read_tags_many(fns, jobs=1, backend=None):
+    """Reads the tags of many files, returned in the order of fns. Tags are parsed in-process, so there's nothing to
+    gain from running concurrently."""
+    return [read_tags(fn, backend=backend) for fn in fns]
+
+
 def write_tags(fn, tags):
     """ Writes the tags provided, augmenting what already exists.
 
     Each value is only updated if it's not None. Empty strings clear fields."""
+    import eyed3
+    import eyed3.id3
     f = eyed3.load(unicode(fn, sys.getfilesystemencoding()))
     if not f.tag:
         f.initTag(version=eyed3.id3.ID3_V2_4)
 
+    _apply_tags(f.tag, tags)
+    f.tag.save(version=eyed3.id3.ID3_V2_4, preserve_file_time=True)
+
+
+def write_tagged_copy(src_fn, dst_fn, tags, padding=TAG_PADDING):
+    """Writes src_fn to dst_fn with its tags augmented as in write_tags(), in a single pass.
+
+    The ID3v2.4 tag goes first with at least `padding` bytes reserved after it, so later tag edits (e.g. with
+    write_tags()) happen in place rather than rewriting the whole file."""
+    import eyed3.id3
+    tag = eyed3.id3.Tag()
+    # only the tag is parsed; unlike eyed3.load(), this doesn't scan the audio frames
+    if not tag.parse(unicode(src_fn, sys.getfilesystemencoding())):
+        tag = eyed3.id3.Tag(version=eyed3.id3.ID3_V2_4)
+    # an ID3v1 tag is at the end, and copied along with the audio
+    audio_offset = id3.tag_size(src_fn)
+
+    _apply_tags(tag, tags)
+
+    # saved to a file that doesn't exist yet, the tag is written alone, with a little padding of eyed3's own
+    if os.path.exists(dst_fn):
+        os.remove(dst_fn)
+    tag.save(unicode(dst_fn, sys.getfilesystemencoding()), version=eyed3.id3.ID3_V2_4)
+    id3.add_padding(dst_fn, padding)
+
+    with open(src_fn, "rb") as src, open(dst_fn, "ab") as dst:
+        src.seek(audio_offset)
+        shutil.copyfileobj(src, dst, 1 << 20)
+
+
+def _apply_tags(tag, tags):
+    """Updates the eyed3 tag with every value in tags that isn't None. Empty strings clear fields."""
+    import eyed3.id3
     if tags.album_artist is not None:
-        f.tag.album_artist = tags.album_artist
+        tag.album_artist = tags.album_artist
 
     if tags.artist is not None:
-        f.tag.artist = tags.artist
+        tag.artist = tags.artist
 
     if tags.title is not None:
-        f.tag.title = tags.title
+        tag.title = tags.title
 
     if tags.album is not None:
-        f.tag.album = tags.album
+        tag.album = tags.album
 
     if tags.year is not None:
-        f.tag.release_date = tags.year
+        tag.release_date = tags.year
         try:
-            f.tag.recording_date = tags.year
+            tag.recording_date = tags.year
         except AttributeError:
             # eyeD3 assumes a date-like object for non-ID3v2.4 tags, and we can't control the tag we read without modifying it!
             FakeDate = collections.namedtuple("FakeDate", ("year", "month", "day", "hour", "minute"))
-            f.tag.recording_date = FakeDate(year=tags.year, month=None, day=None, hour=None, minute=None)
+            tag.recording_date = FakeDate(year=tags.year, month=None, day=None, hour=None, minute=None)
 
     if tags.cd_no is not None:
-        _, num_discs = f.tag.disc_num
-        f.tag.disc_num = (tags.cd_no, num_discs)
+        _, num_discs = tag.disc_num
+        tag.disc_num = (tags.cd_no, num_discs)
 
     if tags.track_no is not None:
-        _, cd_tracks = f.tag.track_num
-        f.tag.track_num = (tags.track_no, cd_tracks)
+        _, cd_tracks = tag.track_num
+        tag.track_num = (tags.track_no, cd_tracks)
 
     if tags.cd_tracks is not None:
-        track_no, _ = f.tag.track_num
-        f.tag.track_num = (track_no, tags.cd_tracks)
+        track_no, _ = tag.track_num
+        tag.track_num = (track_no, tags.cd_tracks)
 
     if (tags.genre_id is not None
             or tags.genre_name is not None):
@@ -146,20 +544,18 @@ def write_tags(fn, tags):
 
             return eyed3.id3.Genre(name=tags.genre_name)
 
-        f.tag.genre = _get_genre()
+        tag.genre = _get_genre()
 
     if tags.comment is not None:
-        for c in f.tag.comments:
-            f.tag.comments.remove(c.description, c.lang)
-        f.tag.comments.set(tags.comment)
+        for c in tag.comments:
+            tag.comments.remove(c.description, c.lang)
+        tag.comments.set(tags.comment)
 
     if tags.composer is not None:
-        f.tag.frame_set.setTextFrame("TCOM", tags.composer)
+        tag.frame_set.setTextFrame("TCOM", tags.composer)
 
     if tags.original_artist is not None:
-        f.tag.frame_set.setTextFrame("TOPE", tags.original_artist)
+        tag.frame_set.setTextFrame("TOPE", tags.original_artist)
 
     if tags.encoded_by is not None:
-        f.tag.frame_set.setTextFrame("TENC", tags.encoded_by)
-
-    f.tag.save(version=eyed3.id3.ID3_V2_4, preserve_file_time=True)
+        tag.frame_set.setTextFrame("TENC", tags.encoded_by)
@@ -0,0 +1,155 @@
+"""In-process reader for iTunes-style MP4/M4A tags.
+
+Walks the atom tree by seeking from header to header, so the audio in `mdat` is never read, and decodes the items in
+moov/udta/meta/ilst."""
+
+import os
+import struct
+
+from .util import (
+    InvalidMetadataException,
+    maybe_convert_int,
+    Tags,
+)
+
+# atoms on the way to the tag list; "meta" is a full atom with 4 bytes of version/flags before its children
+ILST_PATHS = (
+    ("moov", "udta", "meta", "ilst"),
+    ("moov", "meta", "ilst"),
+)
+
+# well-known type of the "data" atom for UTF-8 text
+DATA_TYPE_UTF8 = 1
+
+
+def read_tags(fn):
+    items = read_ilst_items(fn)
+
+    def get_text(k):
+        v = items.get(k)
+        if v is None or v[0] != DATA_TYPE_UTF8:
+            return None
+        return v[1].decode("utf8", "ignore")
+
+    def get_pair(k):
+        # (number, total) as used by trkn and disk; zero means unset
+        v = items.get(k)
+        if v is None or len(v[1]) < 6:
+            return None, None
+        number, total = struct.unpack(">HH", v[1][2:6])
+        return number or None, total or None
+
+    artist = get_text("\xa9ART")
+    track_no, cd_tracks = get_pair("trkn")
+    cd_no, _ = get_pair("disk")
+
+    genre_id = None
+    if "gnre" in items and len(items["gnre"][1]) >= 2:
+        # ID3v1 genre index, off by one
+        genre_id = struct.unpack(">H", items["gnre"][1][:2])[0] - 1
+        if genre_id < 0:
+            genre_id = None
+
+    year = get_text("\xa9day")
+
+    return Tags(
+        artist=artist,
+        album_artist=(
+            get_text("aART")
+                or artist
+        ),
+
+        title=get_text("\xa9nam"),
+        album=get_text("\xa9alb"),
+        year=maybe_convert_int(year, fallback_on_failure=True),
+
+        track_no=track_no,
+        cd_no=cd_no,
+        cd_tracks=cd_tracks,
+
+        genre_id=genre_id,
+        genre_name=get_text("\xa9gen"),
+
+        comment=get_text("\xa9cmt"),
+        composer=get_text("\xa9wrt"),
+        original_artist=None,
+
+        encoded_by=(
+            get_text("\xa9too")
+            or get_text("\xa9enc")
+        ),
+    )
+
+
+def read_ilst_items(fn):
+    """Returns {item atom name: (data type, raw value)} from the file's tag list. Empty if the file has no tags."""
+    with open(fn, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        for path in ILST_PATHS:
+            span = _find_atom(f, path, 0, file_size, fn)
+            if span is not None:
+                start, end = span
+                f.seek(start)
+                return _parse_ilst(f.read(end - start), fn)
+    return {}
+
+
+def iter_atoms(f, start, end, fn):
+    """Yields (name, body start, atom end) for the atoms between start and end, reading only their headers"""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            raise InvalidMetadataException("Truncated atom header in {}.".format(fn))
+
+        size, name = struct.unpack(">I4s", header)
+        body = pos + 8
+        if size == 1:
+            size, = struct.unpack(">Q", f.read(8))
+            body += 8
+        elif size == 0:
+            # extends to the end of the enclosing atom
+            size = end - pos
+
+        if size < body - pos or pos + size > end:
+            raise InvalidMetadataException("Invalid size for atom {!r} in {}.".format(name, fn))
+
+        yield name, body, pos + size
+        pos += size
+
+
+def _find_atom(f, path, start, end, fn):
+    for name, body, atom_end in iter_atoms(f, start, end, fn):
+        if name != path[0]:
+            continue
+        if name == "meta":
+            body += 4
+        if len(path) == 1:
+            return body, atom_end
+        return _find_atom(f, path[1:], body, atom_end, fn)
+    return None
+
+
+def _parse_ilst(data, fn):
+    items = {}
+    pos = 0
+    while pos + 8 <= len(data):
+        size, name = struct.unpack_from(">I4s", data, pos)
+        if size < 8 or pos + size > len(data):
+            raise InvalidMetadataException("Invalid size for tag {!r} in {}.".format(name, fn))
+
+        # the value lives in the first "data" child: 4 bytes of type, 4 bytes of locale, then the payload
+        child = pos + 8
+        while child + 16 <= pos + size:
+            child_size, child_name = struct.unpack_from(">I4s", data, child)
+            if child_size < 8:
+                break
+            if child_name == "data" and child_size >= 16:
+                data_type, = struct.unpack_from(">I", data, child + 8)
+                items.setdefault(name, (data_type & 0xffffff, data[child + 16:child + child_size]))
+                break
+            child += child_size
+
+        pos += size
+    return items
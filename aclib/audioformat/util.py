@@ -1,3 +1,13 @@
+import hashlib
+
+# bytes per read when hashing audio
+HASH_BLOCK_SIZE = 1 << 20
+
+class InvalidMetadataException(Exception):
+    # thrown by the in-process tag readers for files they can't parse
+    pass
+
+
 class Tags(dict):
     __slots__ = [
         "album_artist",
@@ -148,3 +158,19 @@ def vorbiscomment_to_tags(vorbiscomment_output):
             or tags.get("encoded-by")
         ),
     )
+
+
+def hash_file(fn, start=0, length=None, h=None):
+    """Feeds `length` bytes of fn (everything, by default) starting at `start` into hash object h (a new sha1, by
+    default) and returns it"""
+    h = h or hashlib.sha1()
+    with open(fn, "rb") as f:
+        f.seek(start)
+        while length is None or length > 0:
+            buf = f.read(HASH_BLOCK_SIZE if length is None else min(length, HASH_BLOCK_SIZE))
+            if not buf:
+                break
+            h.update(buf)
+            if length is not None:
+                length -= len(buf)
+    return h
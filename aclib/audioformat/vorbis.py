@@ -1,13 +1,30 @@
+import hashlib
 import subprocess
 
+from . import vorbiscomment
 from .util import (
     vorbiscomment_to_tags,
 )
+from .. import trace
+from ..util import (
+    parallel_map,
+)
+
+
+# identification, comment and setup headers come before the audio packets
+NUM_HEADER_PACKETS = 3
+
+# "native" parses the comment header in-process, "vorbiscomment" shells out
+TAG_BACKENDS = ("native", "vorbiscomment")
+TAG_BACKEND = "native"
 
-EXTENSIONS = [".ogg", ".oga"]
+def read_tags(fn, backend=None):
+    backend = backend or TAG_BACKEND
+    assert backend in TAG_BACKENDS, "Unknown tag backend {}".format(backend)
+    if backend == "native":
+        return vorbiscomment_to_tags(vorbiscomment.read_ogg_comments(fn))
 
-def read_tags(fn):
-    output = subprocess.check_output([
+    output = trace.check_output([
         "vorbiscomment",
         "-l",
         fn,
@@ -16,9 +33,48 @@ def read_tags(fn):
     return vorbiscomment_to_tags(output)
 
 
+def read_tags_many(fns, jobs=1, backend=None):
+    """Reads the tags of many files, returned in the order of fns. vorbiscomment takes one file at a time, so the
+    processes run concurrently."""
+    backend = backend or TAG_BACKEND
+    if backend == "native":
+        return [read_tags(fn, backend=backend) for fn in fns]
+    return parallel_map(lambda fn: read_tags(fn, backend=backend), fns, jobs)
+
+
 def decode(fn, output_fn):
-    subprocess.check_call([
+    trace.check_call([
         "oggdec",
         "-o", output_fn,
         fn,
     ])
+
+
+def decode_to_pipe(fn):
+    """Starts decoding to WAV on stdout and returns the decoder process"""
+    # see flac.decode_to_pipe()
+    return trace.popen([
+        "oggdec",
+        "-o", "-",
+        fn,
+    ], stdout=subprocess.PIPE, close_fds=True)
+
+
+def audio_payload_hash(fn):
+    """Hashes the audio, but not the tags, of fn.
+
+    Only the bodies of the pages after the header packets count: they stay the same when the comment header is
+    rewritten, even if the pages get renumbered."""
+    h = hashlib.sha1()
+    serial = None
+    num_header_packets = 0
+    with open(fn, "rb") as f:
+        for page_serial, segment_table, body in vorbiscomment.iter_ogg_pages(f, fn):
+            if serial is None:
+                serial = page_serial
+            if page_serial == serial and num_header_packets < NUM_HEADER_PACKETS:
+                # the audio starts on a fresh page after the last header packet
+                num_header_packets += sum(1 for c in segment_table if ord(c) < 255)
+                continue
+            h.update(body)
+    return h.hexdigest()
@@ -0,0 +1,144 @@
+"""In-process readers for Vorbis comments in FLAC and Ogg Vorbis files.
+
+Only the metadata at the start of the file is read; the audio is never touched. The comments are rendered as the same
+KEY=VALUE lines that `metaflac --export-tags-to=-` and `vorbiscomment -l` print, so they can go through
+util.vorbiscomment_to_tags() unchanged."""
+
+import struct
+
+from .util import (
+    InvalidMetadataException,
+)
+
+FLAC_MAGIC = "fLaC"
+FLAC_VORBIS_COMMENT_BLOCK = 4
+
+OGG_MAGIC = "OggS"
+VORBIS_COMMENT_HEADER = "\x03vorbis"
+
+
+def read_flac_comments(fn):
+    """Returns the Vorbis comments of a FLAC file as unicode KEY=VALUE lines"""
+    blocks, _ = read_flac_blocks(fn, (FLAC_VORBIS_COMMENT_BLOCK,))
+    if FLAC_VORBIS_COMMENT_BLOCK not in blocks:
+        return u""
+    return _comments_to_unicode(_parse_vorbis_comment(blocks[FLAC_VORBIS_COMMENT_BLOCK], fn))
+
+
+def read_flac_blocks(fn, block_types):
+    """Reads the bodies of the requested types of FLAC metadata blocks, seeking past all others.
+
+    Returns ({block type: body}, offset of the first audio frame)."""
+    blocks = {}
+    with open(fn, "rb") as f:
+        magic = f.read(4)
+        if magic[:3] == "ID3":
+            # tolerate (non-standard) ID3v2 tags in front of the stream
+            header = magic + f.read(6)
+            size = sum(ord(c) << (7 * i) for i, c in enumerate(reversed(header[6:10])))
+            f.seek(10 + size)
+            magic = f.read(4)
+
+        if magic != FLAC_MAGIC:
+            raise InvalidMetadataException("{} is not a FLAC file.".format(fn))
+
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                raise InvalidMetadataException("Truncated metadata in {}.".format(fn))
+
+            is_last = ord(header[0]) & 0x80
+            block_type = ord(header[0]) & 0x7f
+            length, = struct.unpack(">I", "\0" + header[1:])
+
+            if block_type in block_types and block_type not in blocks:
+                blocks[block_type] = f.read(length)
+                if len(blocks[block_type]) < length:
+                    raise InvalidMetadataException("Truncated metadata in {}.".format(fn))
+            else:
+                f.seek(length, 1)
+
+            if is_last:
+                return blocks, f.tell()
+
+
+def read_ogg_comments(fn):
+    """Returns the Vorbis comments of an Ogg Vorbis file as unicode KEY=VALUE lines"""
+    with open(fn, "rb") as f:
+        packet = _read_ogg_packet(f, 1, fn)
+
+    if not packet.startswith(VORBIS_COMMENT_HEADER):
+        raise InvalidMetadataException("No Vorbis comment header found in {}.".format(fn))
+    return _comments_to_unicode(_parse_vorbis_comment(packet[len(VORBIS_COMMENT_HEADER):], fn))
+
+
+def iter_ogg_pages(f, fn):
+    """Yields (serial number, segment table, body) for every page from the current position of f to the end"""
+    while True:
+        header = f.read(27)
+        if not header:
+            return
+        if len(header) < 27:
+            raise InvalidMetadataException("Truncated Ogg stream in {}.".format(fn))
+
+        magic, _, _, _, serial, _, _, num_segments = struct.unpack("<4sBBqIIIB", header)
+        if magic != OGG_MAGIC:
+            raise InvalidMetadataException("{} is not an Ogg file.".format(fn))
+
+        segment_table = f.read(num_segments)
+        body = f.read(sum(ord(c) for c in segment_table))
+        if len(segment_table) < num_segments or len(body) < sum(ord(c) for c in segment_table):
+            raise InvalidMetadataException("Truncated Ogg stream in {}.".format(fn))
+        yield serial, segment_table, body
+
+
+def _read_ogg_packet(f, packet_no, fn):
+    """Reassembles packet number `packet_no` of the first logical stream from Ogg pages"""
+    serial = None
+    packets = [""]
+    for page_serial, segment_table, body in iter_ogg_pages(f, fn):
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            # page of another (multiplexed) stream
+            continue
+
+        pos = 0
+        for c in segment_table:
+            size = ord(c)
+            packets[-1] += body[pos:pos + size]
+            pos += size
+            if size < 255:
+                # packet complete
+                if len(packets) > packet_no:
+                    return packets[packet_no]
+                packets.append("")
+
+    raise InvalidMetadataException("Truncated Ogg stream in {}.".format(fn))
+
+
+def _parse_vorbis_comment(data, fn):
+    try:
+        pos = 0
+        vendor_length, = struct.unpack_from("<I", data, pos)
+        pos += 4 + vendor_length
+
+        num_comments, = struct.unpack_from("<I", data, pos)
+        pos += 4
+
+        comments = []
+        for _ in xrange(num_comments):
+            length, = struct.unpack_from("<I", data, pos)
+            pos += 4
+            comment = data[pos:pos + length]
+            if len(comment) < length:
+                raise InvalidMetadataException("Truncated Vorbis comment in {}.".format(fn))
+            comments.append(comment)
+            pos += length
+        return comments
+    except struct.error:
+        raise InvalidMetadataException("Truncated Vorbis comment in {}.".format(fn))
+
+
+def _comments_to_unicode(comments):
+    return "\n".join(comments).decode("utf8", "ignore")
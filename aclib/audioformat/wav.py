@@ -1,14 +1,141 @@
-import shutil
+import collections
+import hashlib
+import os
+import struct
 
 from .util import (
+    hash_file,
     Tags,
 )
+from ..util import (
+    link_or_clone,
+)
+
 
-EXTENSIONS = [".wav"]
+class InvalidWavException(Exception):
+    pass
+
+# fmt_chunk is the raw body of the "fmt " chunk; data_offset/data_size locate the PCM in the file
+WavInfo = collections.namedtuple("WavInfo", (
+    "fmt_chunk",
+    "channels",
+    "sample_rate",
+    "block_align",
+    "data_offset",
+    "data_size",
+))
 
 def read_tags(fn):
     return Tags()
 
 
+def read_tags_many(fns, jobs=1):
+    return [Tags() for _ in fns]
+
+
 def decode(fn, output_fn):
-    shutil.copy(fn, output_fn)
+    # the "decoded" file is only ever read, so it may share its data with the source; it's copied across filesystems
+    # all the same, as the source may be moved before the disc is done
+    link_or_clone(fn, output_fn)
+
+
+def decode_to_pipe(fn):
+    """Returns a stand-in for a decoder process whose stdout is the (already decoded) WAV itself"""
+    return _FileDecoder(fn)
+
+
+class _FileDecoder(object):
+    # what encoders use of a decoder process started by trace.popen(), for a file that needs no decoding; it has
+    # already exited successfully
+    returncode = 0
+
+    def __init__(self, fn):
+        self.stdout = open(fn, "rb")
+        self.trace_cmd = ["open", fn]
+
+    def wait(self):
+        return self.returncode
+
+
+def read_wav_info(fn):
+    """Parses the RIFF chunks of a WAV file up to the start of its PCM data"""
+    with open(fn, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != "RIFF" or wave != "WAVE":
+            raise InvalidWavException("{} is not a RIFF/WAVE file.".format(fn))
+
+        fmt_chunk = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise InvalidWavException("No data chunk found in {}.".format(fn))
+
+            chunk_id, size = struct.unpack("<4sI", header)
+            if chunk_id == "fmt ":
+                fmt_chunk = f.read(size)
+                f.seek(size % 2, os.SEEK_CUR)
+            elif chunk_id == "data":
+                if fmt_chunk is None:
+                    raise InvalidWavException("Data chunk before fmt chunk in {}.".format(fn))
+
+                channels, sample_rate, _, block_align = struct.unpack("<HIIH", fmt_chunk[2:14])
+                # decoders writing to a pipe can't go back and fix up the size, so trust the file instead
+                data_offset = f.tell()
+                data_size = min(size, os.fstat(f.fileno()).st_size - data_offset)
+                return WavInfo(
+                    fmt_chunk=fmt_chunk,
+                    channels=channels,
+                    sample_rate=sample_rate,
+                    block_align=block_align,
+                    data_offset=data_offset,
+                    data_size=data_size - data_size % block_align,
+                )
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+
+def find_data(header):
+    """Offset of the PCM in `header`, the start of a WAV stream, or None if it doesn't reach that far yet"""
+    if len(header) < 12:
+        return None
+    riff, _, wave = struct.unpack("<4sI4s", header[:12])
+    if riff != "RIFF" or wave != "WAVE":
+        raise InvalidWavException("Not a RIFF/WAVE stream.")
+
+    pos = 12
+    while pos + 8 <= len(header):
+        chunk_id, size = struct.unpack("<4sI", header[pos:pos + 8])
+        pos += 8
+        if chunk_id == "data":
+            return pos
+        pos += size + size % 2
+    return None
+
+
+def wav_header(info, data_size):
+    """Renders a WAV header with the format of `info` for `data_size` bytes of PCM"""
+    fmt_chunk = info.fmt_chunk + "\0" * (len(info.fmt_chunk) % 2)
+    return (
+        struct.pack("<4sI4s", "RIFF", 4 + 8 + len(fmt_chunk) + 8 + data_size, "WAVE")
+        + struct.pack("<4sI", "fmt ", len(info.fmt_chunk)) + fmt_chunk
+        + struct.pack("<4sI", "data", data_size)
+    )
+
+
+def read_pcm(fn, info, start_frame, num_frames):
+    """Reads up to num_frames of PCM from the data chunk, starting at start_frame (negative counts from the end)"""
+    total_frames = info.data_size // info.block_align
+    if start_frame < 0:
+        start_frame = max(0, total_frames + start_frame)
+    num_frames = max(0, min(num_frames, total_frames - start_frame))
+
+    with open(fn, "rb") as f:
+        f.seek(info.data_offset + start_frame * info.block_align)
+        return f.read(num_frames * info.block_align)
+
+
+def audio_payload_hash(fn):
+    """Hashes the format and PCM of fn, ignoring any other chunks"""
+    info = read_wav_info(fn)
+    h = hashlib.sha1(info.fmt_chunk)
+    return hash_file(fn, start=info.data_offset, length=info.data_size, h=h).hexdigest()
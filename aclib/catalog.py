@@ -0,0 +1,211 @@
+"""Persistent catalog of the library audio-convert has written: every output file with its final tags, duration, source
+and encode settings.
+
+Target paths and albums are indexed, so collisions and duplicate discs are found before any work is done, with a
+lookup per track rather than a walk of the output directory."""
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import collector
+from .audioformat import mp3
+from .audioformat.util import (
+    Tags,
+)
+from .util import (
+    makedirs,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path BLOB PRIMARY KEY,
+    root BLOB NOT NULL,
+    album_artist TEXT COLLATE NOCASE,
+    album TEXT COLLATE NOCASE,
+    year TEXT,
+    cd_no INTEGER,
+    tags TEXT NOT NULL,
+    duration REAL,
+    source_hash TEXT,
+    encode_settings TEXT,
+    added REAL NOT NULL,
+    verification TEXT
+);
+CREATE INDEX IF NOT EXISTS files_album ON files (root, album_artist, album, year);
+CREATE INDEX IF NOT EXISTS files_source_hash ON files (source_hash);
+"""
+
+# columns added since the first catalogs were made, which get them on opening
+ADDED_COLUMNS = (
+    ("verification", "TEXT"),
+)
+
+# source_hash is the audio payload hash of the source (see collector.AudioFile.audio_payload_hash()), encode_settings
+# a dict of how it was encoded and verification how checking the decoded source against its own checksum went (e.g.
+# flac.VERIFIED); all are None if unknown
+CatalogEntry = collections.namedtuple("CatalogEntry", (
+    "path",
+    "root",
+    "tags",
+    "duration",
+    "source_hash",
+    "encode_settings",
+    "added",
+    "verification",
+))
+
+_COLUMNS = "path, root, tags, duration, source_hash, encode_settings, added, verification"
+
+class Catalog(object):
+    """Output files by path, and by album under the output directory (root) they were written to.
+
+    Albums match case-insensitively. Nothing is committed until flush(). Safe to share between threads."""
+    def __init__(self, db_fn):
+        self.db_fn = db_fn
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_fn, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        columns = set(row[1] for row in self._conn.execute("PRAGMA table_info(files)"))
+        for name, column_type in ADDED_COLUMNS:
+            if name not in columns:
+                self._conn.execute("ALTER TABLE files ADD COLUMN {} {}".format(name, column_type))
+        self._conn.commit()
+
+
+    def add(self, path, root, tags, duration=None, source_hash=None, encode_settings=None, verification=None):
+        """Records the file at path, replacing what was recorded for it before"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files "
+                "(path, root, album_artist, album, year, cd_no, tags, duration, source_hash, encode_settings, added, "
+                "verification) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    sqlite3.Binary(os.path.abspath(path)),
+                    sqlite3.Binary(os.path.abspath(root)),
+                    tags.album_artist,
+                    tags.album,
+                    _year(tags.year),
+                    tags.cd_no,
+                    json.dumps(tags.to_dict()),
+                    duration,
+                    source_hash,
+                    None if encode_settings is None else json.dumps(encode_settings),
+                    time.time(),
+                    verification,
+                ),
+            )
+
+
+    def remove(self, path):
+        with self._lock:
+            self._conn.execute("DELETE FROM files WHERE path = ?", (sqlite3.Binary(os.path.abspath(path)),))
+
+
+    def get(self, path):
+        """The CatalogEntry of path, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT {} FROM files WHERE path = ?".format(_COLUMNS),
+                (sqlite3.Binary(os.path.abspath(path)),),
+            ).fetchone()
+        return None if row is None else _entry(row)
+
+
+    def find_album(self, root, album_artist, album, year, cd_no=None):
+        """The CatalogEntries of the album under root (of one of its discs, given cd_no), ordered by path"""
+        query = "SELECT {} FROM files WHERE root = ? AND album_artist = ? AND album = ? AND year = ?".format(_COLUMNS)
+        params = [sqlite3.Binary(os.path.abspath(root)), album_artist, album, _year(year)]
+        if cd_no is not None:
+            query += " AND cd_no = ?"
+            params.append(cd_no)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY path", params).fetchall()
+        return [_entry(row) for row in rows]
+
+
+    def find_source(self, source_hash):
+        """The CatalogEntries of the files converted from audio with this payload hash, ordered by path"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT {} FROM files WHERE source_hash = ? ORDER BY path".format(_COLUMNS),
+                (source_hash,),
+            ).fetchall()
+        return [_entry(row) for row in rows]
+
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+    def flush(self):
+        with self._lock:
+            self._conn.commit()
+
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+    def __repr__(self):
+        return "Catalog({})".format(self.db_fn)
+
+
+def _year(year):
+    # years are ints or strings depending on the tags they were read from
+    return None if year is None else unicode(year)
+
+
+def _entry(row):
+    path, root, tags, duration, source_hash, encode_settings, added, verification = row
+    return CatalogEntry(
+        path=str(path),
+        root=str(root),
+        tags=Tags(**json.loads(tags)),
+        duration=duration,
+        source_hash=source_hash,
+        encode_settings=None if encode_settings is None else json.loads(encode_settings),
+        added=added,
+        verification=verification,
+    )
+
+
+def add_library(output_catalog, root, jobs=1, skip_dirnames=()):
+    """Catalogs the MP3s already under the output directory root, e.g. converted before there was a catalog. Their
+    source and encode settings are unknown. Returns the number of files cataloged."""
+    num_added = 0
+    for scanned in collector.scan_library(root, jobs=jobs, allow_heterogenous=True, skip_dirnames=skip_dirnames):
+        if scanned.error is not None:
+            raise scanned.error
+        audio_files = [af for af in scanned.audio_files if af.ext == ".mp3"]
+        for audio_file, tags in zip(audio_files, collector.read_tags_many(audio_files, jobs=jobs)):
+            output_catalog.add(audio_file.path, root, tags, duration=mp3.duration(audio_file.path))
+            num_added += 1
+        output_catalog.flush()
+    return num_added
+
+
+# the catalog audio-convert records its output in; None if disabled
+_catalog = None
+
+def configure(cache_dir, enabled=True):
+    """Sets up (or with enabled=False, disables) the process-wide catalog and returns it"""
+    global _catalog
+    if _catalog is not None:
+        _catalog.close()
+        _catalog = None
+
+    if enabled:
+        makedirs(cache_dir)
+        _catalog = Catalog(os.path.join(cache_dir, "catalog.sqlite"))
+    return _catalog
+
+
+def get_catalog():
+    return _catalog
@@ -1,17 +1,26 @@
 import collections
+import multiprocessing.pool
 import os
+import Queue
+import sys
 
-from .audioformat import (
-    faac,
-    flac,
-    mp3,
-    vorbis,
-    wav,
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from . import (
+    audioformat,
+    tagcache,
 )
 
 class InvalidAudioDirectorException(Exception):
     pass
 
+
+# a directory with audio files found by scan_library(); error is set (and audio_files empty) if it's unusable
+ScannedDirectory = collections.namedtuple("ScannedDirectory", ("path", "audio_files", "error"))
+
 class AudioFile(object):
     def __init__(self, audio_module, path):
         self.audio_module = audio_module
@@ -24,48 +33,161 @@ class AudioFile(object):
 
 
     def read_tags(self):
-        return self.audio_module.read_tags(self.path)
+        cache = tagcache.get_cache()
+        if cache is None:
+            return self.audio_module.read_tags(self.path)
+        return cache.read_tags(self.path, self.audio_module.read_tags)
 
 
-    def decode(self, output_fn):
+    def decode(self, output_fn, verify=False):
+        """Decodes to the WAV file output_fn. With verify (for codecs that can_verify), checks the audio as it's
+        written and returns the outcome."""
+        if verify:
+            return self.audio_module.decode(self.path, output_fn, verify=True)
         self.audio_module.decode(self.path, output_fn)
+        return None
+
+
+    def audio_payload_hash(self):
+        return self.audio_module.audio_payload_hash(self.path)
+
+
+    def decode_to_pipe(self):
+        return self.audio_module.decode_to_pipe(self.path)
+
+
+    def make_verifier(self):
+        return self.audio_module.make_verifier(self.path)
 
 
     def __repr__(self):
         return "AudioFile({}, {})".format(self.audio_module.__name__, self.path)
 
 
+def read_tags_many(audio_files, jobs=1):
+    """Reads the tags of many AudioFiles, batched per audio module. Returns Tags in the order of audio_files.
+
+    Goes through the tag cache like AudioFile.read_tags; only the misses are read."""
+    cache = tagcache.get_cache()
+
+    tags = [None] * len(audio_files)
+    # of the misses, from before reading them
+    stat_keys = {}
+    idxs_by_module = collections.defaultdict(list)
+    for idx, audio_file in enumerate(audio_files):
+        if cache is not None:
+            tags[idx] = cache.get(audio_file.path)
+            if tags[idx] is None:
+                stat_keys[idx] = tagcache.stat_key(audio_file.path)
+        if tags[idx] is None:
+            idxs_by_module[audio_file.audio_module].append(idx)
+
+    for module, idxs in idxs_by_module.iteritems():
+        module_tags = module.read_tags_many([audio_files[idx].path for idx in idxs], jobs=jobs)
+        for idx, t in zip(idxs, module_tags):
+            tags[idx] = t
+            if cache is not None:
+                cache.put(audio_files[idx].path, t, stat_keys[idx])
+
+    if cache is not None:
+        cache.flush()
+    return tags
+
+
 def collect_audio_files(dir_fn, allow_heterogenous=False):
     """Finds relevant AudioFiles in the given directory and returns them sorted by filename.
 
     Throws an Exception if a heterogenous collection of files is discovered and not allowed."""
-    modules_by_ext = {}
-    for m in (faac, flac, mp3, vorbis, wav):
-        for ext in m.EXTENSIONS:
-            assert ext.startswith("."), "Extension {} in {} doesn't start with period.".format(ext, m)
-            assert ext.lower() == ext, "Extension {} must be lowercase!".format(ext)
-            assert ext not in modules_by_ext, "Extension {} defined in multiple modules: {} and {}.".format(ext, m, modules_by_ext[ext])
-            modules_by_ext[ext] = m
-
-    files_by_ext = collections.defaultdict(list)
-    for fn in os.listdir(dir_fn):
-        ext = os.path.splitext(fn)[1].lower()
-        files_by_ext[ext].append(fn)
-
-    files_by_audio_module = collections.defaultdict(list)
-    for ext, files in files_by_ext.iteritems():
-        if ext in modules_by_ext:
-            module = modules_by_ext[ext]
-            files_by_audio_module[module].extend(files)
-
+    files_by_audio_module = _files_by_audio_module(os.listdir(dir_fn))
     if not files_by_audio_module:
         raise InvalidAudioDirectorException(
             "No supported audio extensions found in {}. Valid extensions {}".format(
                 dir_fn,
-                sorted(modules_by_ext.keys()),
+                sorted(audioformat.CODECS_BY_EXT.keys()),
             )
         )
+    return _to_audio_files(dir_fn, files_by_audio_module, allow_heterogenous)
+
+
+def scan_library(root_dir, jobs=1, allow_heterogenous=False, skip_dirnames=()):
+    """Recursively finds every directory under root_dir (inclusive) with audio files, i.e. every candidate disc.
+
+    Yields a ScannedDirectory per such directory as soon as it's been listed, in no particular order. Heterogenous
+    directories that aren't allowed are yielded with an InvalidAudioDirectorException as their error rather than
+    ending the scan. Hidden directories, directories named in skip_dirnames and symlinks to directories are skipped.
+
+    Directories are listed by up to `jobs` threads, which mostly helps on network filesystems."""
+    if jobs <= 1:
+        pending = [root_dir]
+        while pending:
+            subdirs, scanned = _scan_dir(pending.pop(), allow_heterogenous, skip_dirnames)
+            pending.extend(reversed(subdirs))
+            if scanned is not None:
+                yield scanned
+        return
+
+    results = Queue.Queue()
+    def _scan(dir_fn):
+        try:
+            results.put((_scan_dir(dir_fn, allow_heterogenous, skip_dirnames), None))
+        except Exception:
+            results.put((None, sys.exc_info()))
+
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        pool.apply_async(_scan, (root_dir,))
+        num_pending = 1
+        while num_pending:
+            # a timeout keeps the main thread responsive to Ctrl+C
+            result, exc_info = results.get(True, 2 ** 31)
+            num_pending -= 1
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            subdirs, scanned = result
+            for subdir in subdirs:
+                pool.apply_async(_scan, (subdir,))
+            num_pending += len(subdirs)
+            if scanned is not None:
+                yield scanned
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _scan_dir(dir_fn, allow_heterogenous, skip_dirnames):
+    """Lists one directory. Returns (subdirectories to scan, ScannedDirectory or None if it has no audio)."""
+    subdirs = []
+    fns = []
+    for entry in scandir(dir_fn):
+        if entry.is_dir(follow_symlinks=False):
+            if not entry.name.startswith(".") and entry.name not in skip_dirnames:
+                subdirs.append(entry.path)
+        else:
+            fns.append(entry.name)
+    subdirs.sort()
+
+    files_by_audio_module = _files_by_audio_module(fns)
+    if not files_by_audio_module:
+        return subdirs, None
+
+    try:
+        audio_files = _to_audio_files(dir_fn, files_by_audio_module, allow_heterogenous)
+    except InvalidAudioDirectorException as exc:
+        return subdirs, ScannedDirectory(path=dir_fn, audio_files=[], error=exc)
+    return subdirs, ScannedDirectory(path=dir_fn, audio_files=audio_files, error=None)
+
+
+def _files_by_audio_module(fns):
+    files_by_audio_module = collections.defaultdict(list)
+    for fn in fns:
+        module = audioformat.module_for_filename(fn)
+        if module is not None:
+            files_by_audio_module[module].append(fn)
+    return files_by_audio_module
+
 
+def _to_audio_files(dir_fn, files_by_audio_module, allow_heterogenous):
     if (not allow_heterogenous
             and len(files_by_audio_module) > 1):
         raise InvalidAudioDirectorException(
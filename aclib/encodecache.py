@@ -0,0 +1,148 @@
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from .util import (
+    clone_file,
+    makedirs,
+)
+
+DEFAULT_MAX_BYTES = 20 * (1 << 30)
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+
+# bump to invalidate everything cached by older versions of the encoding code
+CACHE_VERSION = 1
+
+class EncodeCache(object):
+    """Content-addressed store of untagged encoded MP3s.
+
+    Entries are files named by their key; their mtime records when they were last used. evict() drops entries older
+    than max_age, then the least recently used ones until the cache fits in max_bytes."""
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        makedirs(cache_dir)
+
+
+    def get(self, key, output_fn):
+        """Copies the entry for key to output_fn. Returns False if there is none."""
+        path = self._path(key)
+        try:
+            clone_file(path, output_fn)
+            os.utime(path, None)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            with self._lock:
+                self.misses += 1
+            return False
+
+        with self._lock:
+            self.hits += 1
+        return True
+
+
+    def put(self, key, encoded_fn):
+        # copy under a temporary name first, so concurrent readers never see a partial entry
+        fd, tmp_fn = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            clone_file(encoded_fn, tmp_fn)
+            os.rename(tmp_fn, self._path(key))
+        except:
+            os.unlink(tmp_fn)
+            raise
+
+
+    def evict(self):
+        with self._lock:
+            now = time.time()
+            entries = []
+            for fn in os.listdir(self.cache_dir):
+                if fn.endswith(".tmp"):
+                    # still being written by put()
+                    continue
+                path = os.path.join(self.cache_dir, fn)
+                try:
+                    st = os.stat(path)
+                except OSError as exc:
+                    if exc.errno == errno.ENOENT:
+                        continue
+                    raise
+                entries.append((st.st_mtime, st.st_size, path))
+
+            total_bytes = sum(size for _, size, _ in entries)
+            for mtime, size, path in sorted(entries):
+                if now - mtime <= self.max_age and total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError as exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+                total_bytes -= size
+
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".mp3")
+
+
+    def __repr__(self):
+        return "EncodeCache({}, hits={}, misses={})".format(self.cache_dir, self.hits, self.misses)
+
+
+def track_keys(payload_hashes, lame_opts, mode, context_samples=None):
+    """Cache keys for each track of a disc, given the audio payload hash of every track in order.
+
+    What an encoded track depends on besides its own audio varies by mode:
+      "stream": nothing else
+      "gapless": its neighbours, whose boundary samples are encoded with it
+      "nogap": the whole disc, which is encoded in a single lame --nogap run"""
+    assert mode in ("stream", "gapless", "nogap")
+
+    keys = []
+    for idx, payload_hash in enumerate(payload_hashes):
+        if mode == "stream":
+            depends_on = [payload_hash]
+        elif mode == "gapless":
+            depends_on = [
+                payload_hashes[idx - 1] if idx > 0 else None,
+                payload_hash,
+                payload_hashes[idx + 1] if idx + 1 < len(payload_hashes) else None,
+            ]
+        else:
+            depends_on = list(payload_hashes) + [idx]
+
+        keys.append(hashlib.sha1(json.dumps([
+            CACHE_VERSION,
+            list(lame_opts),
+            mode,
+            context_samples,
+            depends_on,
+        ])).hexdigest())
+    return keys
+
+
+# the cache used by audio-convert; None bypasses caching
+_cache = None
+
+def configure(cache_dir, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE, enabled=True):
+    """Sets up (or with enabled=False, disables) the process-wide encode cache and returns it"""
+    global _cache
+    _cache = None
+    if enabled:
+        _cache = EncodeCache(cache_dir, max_bytes=max_bytes, max_age=max_age)
+    return _cache
+
+
+def get_cache():
+    return _cache
@@ -0,0 +1,240 @@
+import errno
+import fcntl
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+
+from .util import (
+    makedirs,
+)
+
+# per-track stages, in the order they complete; "started" and "source_moved" are recorded for the whole disc (track
+# None), the latter just before the source directory is moved
+STAGES = ("started", "decoded", "encoded", "tagged", "renamed", "source_moved")
+
+# seconds an incomplete disc stays resumable after it was started; remove_orphaned_work_dirs() gives up on it after that
+MAX_INCOMPLETE_AGE = 14 * 24 * 60 * 60
+
+# prefix of the directory holding each unfinished disc's intermediate files, by disc key; each journal has its own
+WORK_DIRNAME = "audio-convert-work"
+
+class JournalLockedException(Exception):
+    # thrown when another process is using the journal
+    pass
+
+class Journal(object):
+    """Append-only record of the stages each track of a disc has completed, so an interrupted run can resume.
+
+    Every line of the file is a JSON object {"disc": key, "stage": stage, "track": index or null, "info": {...}};
+    a disc's lines are dropped once it's complete. Entries are synced to disk as they're recorded. With fn=None the
+    journal is only kept in memory. Safe to share between threads, but not between processes: the file is locked until
+    close(), and opening it while another process has it raises a JournalLockedException."""
+    def __init__(self, fn):
+        self.fn = fn
+        self._lock = threading.Lock()
+        # disc key -> {(stage, track): info}
+        self._discs = {}
+        self._f = None
+        self._lock_f = None
+
+        if fn is not None:
+            # a file of its own, as compacting replaces the journal
+            self._lock_f = open(fn + ".lock", "a")
+            # encoders and decoders mustn't keep holding it
+            fcntl.fcntl(self._lock_f.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            try:
+                fcntl.flock(self._lock_f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as exc:
+                self._lock_f.close()
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                raise JournalLockedException("{} is in use by another process.".format(fn))
+            self._load()
+            self._f = open(fn, "a")
+
+
+    def get(self, disc, stage, track=None):
+        """The info recorded when track (or the whole disc) of disc completed stage, or None"""
+        with self._lock:
+            return self._discs.get(disc, {}).get((stage, track))
+
+
+    def record(self, disc, stage, track=None, **info):
+        assert stage in STAGES
+        with self._lock:
+            self._discs.setdefault(disc, {})[(stage, track)] = info
+            self._write({"disc": disc, "stage": stage, "track": track, "info": info})
+
+
+    def complete(self, disc):
+        """Forgets everything about a disc that has gone through every stage"""
+        with self._lock:
+            self._discs.pop(disc, None)
+            self._write({"disc": disc, "stage": None, "track": None, "info": {}})
+
+
+    def verification(self, disc, idx, track):
+        """How checking the decoded source of track idx of disc went, as recorded by whichever stage decoded it: "decoded"
+        (of idx, shared by the disc's profiles) if it was decoded to WAV, otherwise "encoded" of track, the track in
+        the journal of the profile it was streamed for. None if it wasn't checked or isn't recorded."""
+        for stage, key in (("decoded", idx), ("encoded", track)):
+            info = self.get(disc, stage, key)
+            if info is not None and info.get("verification") is not None:
+                return info["verification"]
+        return None
+
+
+    def incomplete_discs(self):
+        with self._lock:
+            return set(self._discs)
+
+
+    def abandoned_discs(self, now=None):
+        """Incomplete discs that will never resume: those whose source directory was moved by a run that didn't get
+        to complete() them, those whose sources changed or disappeared (so their disc key can't come up again) and
+        those started more than MAX_INCOMPLETE_AGE seconds ago"""
+        now = time.time() if now is None else now
+        with self._lock:
+            discs = [
+                (disc, stages.get(("started", None)), stages.get(("source_moved", None)))
+                for disc, stages in self._discs.iteritems()
+            ]
+
+        abandoned = set()
+        for disc, started, source_moved in discs:
+            if source_moved is not None and not os.path.exists(source_moved["dirname"].encode("utf8")):
+                abandoned.add(disc)
+            elif started is None:
+                # recorded before discs recorded their start: nothing to go by
+                continue
+            elif now - started["time"] > MAX_INCOMPLETE_AGE:
+                abandoned.add(disc)
+            else:
+                try:
+                    if disc_key([fn.encode("utf8") for fn in started["sources"]]) != disc:
+                        abandoned.add(disc)
+                except OSError:
+                    abandoned.add(disc)
+        return abandoned
+
+
+    def work_root(self, parent_dir):
+        """The directory in parent_dir for the work directories of this journal's discs. No other journal (in this
+        process or another) uses it."""
+        if self.fn is None:
+            owner = "pid{}-{}".format(os.getpid(), id(self))
+        else:
+            owner = hashlib.sha1(os.path.abspath(self.fn)).hexdigest()[:12]
+        return os.path.join(parent_dir, "{}-{}".format(WORK_DIRNAME, owner))
+
+
+    def remove_orphaned_work_dirs(self, work_root):
+        """Removes the work directories in work_root (see work_root()) of discs this journal isn't waiting on, e.g. left
+        by a crash before anything was recorded. Abandoned discs (see abandoned_discs()) are completed first."""
+        for disc in self.abandoned_discs():
+            self.complete(disc)
+
+        try:
+            names = os.listdir(work_root)
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return
+            raise
+
+        incomplete = self.incomplete_discs()
+        for name in names:
+            if name not in incomplete:
+                shutil.rmtree(os.path.join(work_root, name))
+
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if self._lock_f is not None:
+            # releases the lock
+            self._lock_f.close()
+            self._lock_f = None
+
+
+    def _write(self, entry):
+        if self._f is None:
+            return
+        self._f.write(json.dumps(entry) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+
+    def _load(self):
+        lines = []
+        try:
+            with open(self.fn) as f:
+                lines = f.readlines()
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # cut short by a crash
+                continue
+            if entry["stage"] is None:
+                self._discs.pop(entry["disc"], None)
+            else:
+                self._discs.setdefault(entry["disc"], {})[(entry["stage"], entry["track"])] = entry["info"]
+
+        # compact: rewrite just what's still relevant
+        tmp_fn = self.fn + ".tmp"
+        with open(tmp_fn, "w") as f:
+            for disc, stages in sorted(self._discs.iteritems()):
+                for (stage, track), info in sorted(stages.iteritems()):
+                    f.write(json.dumps({"disc": disc, "stage": stage, "track": track, "info": info}) + "\n")
+        os.rename(tmp_fn, self.fn)
+
+
+    def __repr__(self):
+        return "Journal({}, {} incomplete discs)".format(self.fn, len(self._discs))
+
+
+def disc_key(paths):
+    """Identifies a disc by its source files as they are now, so changed sources never resume from stale artifacts"""
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        mtime_ns = getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 10 ** 9)
+        h.update(json.dumps([os.path.abspath(path), st.st_size, mtime_ns]))
+    return h.hexdigest()
+
+
+# the journal used by audio-convert; in memory only unless configured
+_journal = Journal(None)
+
+def configure(cache_dir, enabled=True):
+    """Sets up the process-wide journal in cache_dir (or with enabled=False, in memory only) and returns it.
+
+    Processes sharing cache_dir (e.g. the watch daemon and a run from the command line) each get a journal of their
+    own: journal.jsonl if it's free, otherwise journal.1.jsonl, journal.2.jsonl, ..."""
+    global _journal
+    _journal.close()
+    if enabled:
+        makedirs(cache_dir)
+        for slot in itertools.count():
+            fn = os.path.join(cache_dir, "journal.jsonl" if slot == 0 else "journal.{}.jsonl".format(slot))
+            try:
+                _journal = Journal(fn)
+                break
+            except JournalLockedException:
+                continue
+    else:
+        _journal = Journal(None)
+    return _journal
+
+
+def get_journal():
+    return _journal
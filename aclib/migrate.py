@@ -0,0 +1,453 @@
+"""Bulk migration of the ID3 tags of an existing library.
+
+Each migration is a rule with:
+  name: how it's selected on the command line
+  needed(id3_frames, path): whether a file might need it, from the raw frames alone (see audioformat.id3)
+  apply(tag, path): changes the eyed3 tag; returns a list of (field, old value, new value), or raises to have the
+    file reported as an error and left unchanged
+
+Files for which no rule is needed are never loaded with eyed3, so rerunning a migration over a mostly migrated
+library costs little more than reading every tag header. Changed files are written as ID3v2.4 with their mtime
+preserved."""
+
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from . import (
+    collector,
+    tagcache,
+    util,
+)
+from .audioformat import id3
+from .audioformat.util import (
+    InvalidMetadataException,
+)
+
+VARIOUS_ARTISTS = u"Various Artists"
+
+# paths handed to each worker process at a time
+CHUNK_SIZE = 32
+
+# what rules are shown of a file with only an ID3v1 tag, which has no frames
+ID3V1_FRAMES = id3.Id3Frames(version=(1, 0), frames={})
+
+# changes is a list of (rule name, field, old value, new value); error is set instead if the file couldn't be migrated
+MigrationResult = collections.namedtuple("MigrationResult", ("path", "changes", "error"))
+
+class MissingFieldsException(Exception):
+    # thrown by RequireFields for a file that lacks fields every file should have; it's left unchanged
+    pass
+
+class RequireFields(object):
+    """Refuses to migrate files without an artist, title, album, year, track number, track count or disc number"""
+    name = "require_fields"
+
+    def needed(self, id3_frames, path):
+        def text(frame_id):
+            bodies = id3_frames.frames.get(frame_id)
+            return id3.decode_text_frame(bodies[0], path).strip() if bodies else u""
+
+        try:
+            track = text("TRCK").split(u"/")
+            return not (
+                all(text(frame_id) for frame_id in ("TPE1", "TIT2", "TALB"))
+                and any(text(frame_id) for frame_id in id3.YEAR_FRAMES)
+                and len(track) == 2 and all(_is_positive(n) for n in track)
+                and _is_positive(text("TPOS").split(u"/")[0])
+            )
+        except InvalidMetadataException:
+            # only eyed3 can tell
+            return True
+
+    def apply(self, tag, path):
+        date = tag.getBestDate()
+        missing = [
+            name
+            for name, value in (
+                ("artist", tag.artist),
+                ("title", tag.title),
+                ("album", tag.album),
+                ("year", date and date.year),
+                ("track_no", tag.track_num[0]),
+                ("cd_tracks", tag.track_num[1]),
+                ("cd_no", tag.disc_num[0]),
+            )
+            if not value
+        ]
+        if missing:
+            raise MissingFieldsException("Missing {}.".format(", ".join(missing)))
+        return []
+
+
+def _is_positive(s):
+    return s.strip().isdigit() and int(s) > 0
+
+
+class StripRgad(object):
+    """Removes the obsolete RGAD (replay gain) frame, which eyed3 can't write back"""
+    name = "strip_rgad"
+
+    def needed(self, id3_frames, path):
+        return "RGAD" in id3_frames.frames
+
+    def apply(self, tag, path):
+        if "RGAD" not in tag.frame_set:
+            return []
+        del tag.frame_set["RGAD"]
+        return [("RGAD", u"present", None)]
+
+
+class UpgradeToV24(object):
+    """Converts ID3v2.3 and older tags, ID3v1 included, to ID3v2.4"""
+    name = "upgrade_v24"
+
+    def needed(self, id3_frames, path):
+        return id3_frames.version[0] != 4
+
+    def apply(self, tag, path):
+        import eyed3.id3
+        if tag.version == eyed3.id3.ID3_V2_4:
+            return []
+        old_version = u".".join(str(v) for v in tag.version)
+        # converts the frames as well
+        tag.version = eyed3.id3.ID3_V2_4
+        return [("version", old_version, u"2.4.0")]
+
+
+class AddAlbumArtist(object):
+    """Sets a missing album artist to the artist, except on Various Artists compilations"""
+    name = "album_artist"
+
+    def needed(self, id3_frames, path):
+        if VARIOUS_ARTISTS.encode("utf8") in path:
+            return False
+        try:
+            album_artist = id3.decode_text_frame(id3_frames.frames.get("TPE2", [""])[0], path)
+        except InvalidMetadataException:
+            # only eyed3 can tell
+            return True
+        return not album_artist.strip()
+
+    def apply(self, tag, path):
+        if tag.album_artist or not tag.artist or VARIOUS_ARTISTS.encode("utf8") in path:
+            return []
+        tag.album_artist = tag.artist
+        return [("album_artist", None, tag.artist)]
+
+
+class RecordingDate(object):
+    """Makes the recording date the year: Plex reads it rather than the (original) release date.
+
+    The release date is set to the same, and the original release date removed. Files whose dates already agree on
+    the year are left alone."""
+    name = "recording_date"
+
+    def needed(self, id3_frames, path):
+        if id3_frames.version[0] == 1:
+            # eyed3 loads the year of an ID3v1 tag as the original release date
+            return True
+        try:
+            years = dict(
+                (frame_id, id3.decode_text_frame(id3_frames.frames[frame_id][0], path).strip()[:4])
+                for frame_id in id3.YEAR_FRAMES
+                if frame_id in id3_frames.frames
+            )
+        except InvalidMetadataException:
+            # only eyed3 can tell
+            return True
+        if not years:
+            return False
+        # (ID3v2.3 keeps the recording year in TYER.) A release date that's missing or agrees doesn't matter to Plex.
+        recording_year = years.get("TDRC") or years.get("TYER")
+        return recording_year is None or any(year != recording_year for year in years.itervalues())
+
+    def apply(self, tag, path):
+        import eyed3.id3
+        if tag.version != eyed3.id3.ID3_V2_4:
+            # the release date only has a frame of its own in ID3v2.4
+            tag.version = eyed3.id3.ID3_V2_4
+
+        old = (tag.recording_date, tag.release_date, tag.original_release_date)
+        date = tag.recording_date or tag.release_date or tag.original_release_date
+        if date is None:
+            return []
+        tag.recording_date = date
+        tag.release_date = date
+        tag.original_release_date = None
+
+        new = (tag.recording_date, tag.release_date, tag.original_release_date)
+        return [
+            (field, _date_str(old_date), _date_str(new_date))
+            for field, old_date, new_date in zip(("recording_date", "release_date", "original_release_date"), old, new)
+            if _date_str(old_date) != _date_str(new_date)
+        ]
+
+
+def _date_str(date):
+    return None if date is None else unicode(str(date))
+
+# every rule, in the order they're applied: RGAD has to go before eyed3 converts or saves a tag
+RULES = collections.OrderedDict((rule.name, rule) for rule in (
+    RequireFields,
+    StripRgad,
+    UpgradeToV24,
+    AddAlbumArtist,
+    RecordingDate,
+))
+
+
+def make_rules(names):
+    """Instances of the named rules, in the order of RULES"""
+    unknown = set(names) - set(RULES)
+    assert not unknown, "Unknown rules {}; valid rules are {}.".format(sorted(unknown), list(RULES))
+    return [rule() for name, rule in RULES.iteritems() if name in names]
+
+
+def migrate_file(path, rules, dry_run=False):
+    """Applies rules to the tag of the MP3 at path. Returns a MigrationResult. With dry_run, nothing is written.
+
+    ID3v1 tags are migrated to ID3v2.4 like any other; files without a tag are left alone."""
+    try:
+        id3_frames = id3.read_frames(path)
+        if id3_frames is None:
+            if not id3.has_v1_tag(path):
+                return MigrationResult(path=path, changes=[], error=None)
+            id3_frames = ID3V1_FRAMES
+    except InvalidMetadataException:
+        # only eyed3 can tell
+        id3_frames = None
+    if id3_frames is not None and not any(rule.needed(id3_frames, path) for rule in rules):
+        return MigrationResult(path=path, changes=[], error=None)
+
+    import eyed3
+    import eyed3.id3
+    f = eyed3.load(unicode(path, sys.getfilesystemencoding()))
+    if f is None:
+        return MigrationResult(path=path, changes=[], error="Not an MP3")
+    if f.tag is None:
+        return MigrationResult(path=path, changes=[], error=None)
+
+    changes = []
+    for rule in rules:
+        changes.extend((rule.name, field, old, new) for field, old, new in rule.apply(f.tag, path))
+    if changes and not dry_run:
+        f.tag.save(version=eyed3.id3.ID3_V2_4, preserve_file_time=True)
+    return MigrationResult(path=path, changes=changes, error=None)
+
+
+def _migrate_file_safely(path, rules, dry_run):
+    # one bad file mustn't end a run over the whole library
+    try:
+        return migrate_file(path, rules, dry_run)
+    except Exception as exc:
+        return MigrationResult(path=path, changes=[], error="{}: {}".format(exc.__class__.__name__, exc))
+
+
+def _migrate_chunk((paths, rules, dry_run)):
+    return [_migrate_file_safely(path, rules, dry_run) for path in paths]
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _ignore_sigint():
+    # Ctrl+C is handled by the parent, which terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def find_mp3s(paths, jobs=1, skip_dirnames=(), skip_containing=()):
+    """Yields the MP3s among paths and (recursively) in the directories among them, except those whose directory's
+    path contains any of skip_containing"""
+    def skipped(dirname):
+        return any(s in dirname for s in skip_containing)
+
+    for path in paths:
+        if not os.path.isdir(path):
+            if path.lower().endswith(".mp3") and not skipped(os.path.dirname(os.path.abspath(path))):
+                yield path
+            continue
+        for scanned in collector.scan_library(path, jobs=jobs, allow_heterogenous=True, skip_dirnames=skip_dirnames):
+            if skipped(scanned.path):
+                continue
+            for audio_file in scanned.audio_files:
+                if audio_file.ext == ".mp3":
+                    yield audio_file.path
+
+
+def migrate_library(paths, rules, jobs=1, dry_run=False, skip_dirnames=(), skip_containing=()):
+    """Migrates every MP3 found by find_mp3s(), up to `jobs` files at a time in worker processes.
+
+    Yields a MigrationResult per file as it's done, in no particular order. Files are migrated while the scan is still
+    going."""
+    mp3s = find_mp3s(paths, jobs=jobs, skip_dirnames=skip_dirnames, skip_containing=skip_containing)
+    if jobs <= 1:
+        for path in mp3s:
+            yield _migrate_file_safely(path, rules, dry_run)
+        return
+
+    # eyed3 is pure Python, so it takes processes rather than threads to use more than one core. Chunks are made here
+    # rather than by imap_unordered(), whose chunked iterator can't wait with a timeout.
+    pool = multiprocessing.Pool(jobs, initializer=_ignore_sigint)
+    try:
+        chunks = itertools.izip(_chunks(mp3s, CHUNK_SIZE), itertools.repeat(rules), itertools.repeat(dry_run))
+        results = pool.imap_unordered(_migrate_chunk, chunks)
+        while True:
+            try:
+                # a timeout keeps the main thread responsive to Ctrl+C
+                chunk_results = results.next(2 ** 31)
+            except StopIteration:
+                break
+            for result in chunk_results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class ChangeLog(object):
+    """Append-only record of the files a migration changed and what it changed, as JSON lines"""
+    def __init__(self, fn):
+        self.fn = fn
+        self._f = open(fn, "a")
+
+
+    def record(self, result):
+        self._f.write(json.dumps({
+            "time": time.time(),
+            "path": result.path.decode("utf8", "replace"),
+            "changes": result.changes,
+        }) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+
+    def close(self):
+        self._f.close()
+
+
+    def __repr__(self):
+        return "ChangeLog({})".format(self.fn)
+
+
+def format_changes(result):
+    """The changes of a MigrationResult as indented lines of text"""
+    return u"\n".join(
+        u"  {}: {}: {} -> {}".format(rule, field, old, new)
+        for rule, field, old, new in result.changes
+    )
+
+
+def main(argv, default_rules, description, skip_containing=()):
+    """Command-line entry point of the migration scripts, which differ in the rules they apply by default and the
+    paths they always skip"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "paths",
+        metavar="PATH",
+        nargs="+",
+        help="MP3s, and directories to search recursively for MP3s.",
+    )
+    parser.add_argument(
+        "--rules",
+        default=",".join(default_rules),
+        help="Comma-separated rules to apply, among {}. Defaults to %(default)s.".format(", ".join(RULES)),
+    )
+    parser.add_argument(
+        "--dry_run", "-n",
+        action="store_true",
+        help="Only print what would change.",
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=util.default_jobs(),
+        help="Number of files to migrate concurrently. Defaults to the number of cores.",
+    )
+    parser.add_argument(
+        "--skip",
+        metavar="DIRNAME",
+        action="append",
+        default=[],
+        help="Don't descend into directories with this name. May be repeated.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=tagcache.DEFAULT_CACHE_DIR,
+        help="audio-convert's cache directory, whose tag cache entries for changed files are dropped.",
+    )
+    parser.add_argument(
+        "--log_fn",
+        default=None,
+        help="Where to append the record of changed files. Defaults to a new file in --cache_dir.",
+    )
+    args = parser.parse_args(argv)
+    assert args.jobs >= 1, "--jobs must be at least 1."
+    rules = make_rules(args.rules.split(","))
+
+    log_fn = args.log_fn or os.path.join(args.cache_dir, "migrate-{}.jsonl".format(time.strftime("%Y%m%d-%H%M%S")))
+    # opened with the first change
+    change_log = None
+    cache = None
+    if not args.dry_run:
+        cache = tagcache.configure(args.cache_dir)
+
+    start = time.time()
+    counts = collections.Counter()
+    try:
+        results = migrate_library(
+            args.paths,
+            rules,
+            jobs=args.jobs,
+            dry_run=args.dry_run,
+            skip_dirnames=args.skip,
+            skip_containing=skip_containing,
+        )
+        for result in results:
+            counts["files"] += 1
+            if result.error is not None:
+                counts["errors"] += 1
+                print >>sys.stderr, "{}: {}".format(result.path, result.error)
+                continue
+            if not result.changes:
+                continue
+
+            counts["changed"] += 1
+            print result.path
+            print format_changes(result).encode("utf8")
+            if args.dry_run:
+                continue
+            if change_log is None:
+                util.makedirs(os.path.dirname(os.path.abspath(log_fn)))
+                change_log = ChangeLog(log_fn)
+            change_log.record(result)
+            cache.invalidate(result.path)
+    except KeyboardInterrupt:
+        print "Interrupted. Rerunning skips the files already migrated."
+    finally:
+        if change_log is not None:
+            change_log.close()
+        if cache is not None:
+            cache.close()
+
+    print "{} {} of {} files in {:.1f}s, {} errors.{}".format(
+        "Would change" if args.dry_run else "Changed",
+        counts["changed"],
+        counts["files"],
+        time.time() - start,
+        counts["errors"],
+        "" if change_log is None else " Changes recorded in {}.".format(change_log.fn),
+    )
+    return 1 if counts["errors"] else 0
@@ -0,0 +1,55 @@
+"""Output profiles: every disc can be encoded with several sets of lame options, each into an output directory of its
+own, decoding each source only once.
+
+The profile of --output_dir is always first and encodes with mp3.LAME_OPTS; --profile adds more."""
+
+import argparse
+import collections
+import os
+
+from .audioformat import mp3
+
+#   name: identifies the profile's files in the journal and work directory
+#   lame_opts: the encoder's options, which are part of the encode cache key
+#   output_dir: root of the profile's albums
+Profile = collections.namedtuple("Profile", ("name", "lame_opts", "output_dir"))
+
+# the profile of --output_dir
+DEFAULT_NAME = "default"
+
+# lame options of the profiles --profile can name without giving any
+PRESETS = collections.OrderedDict((
+    ("extreme", mp3.LAME_OPTS),
+    ("v0", ["-h", "-V", "0"]),
+    ("cbr320", ["-h", "-b", "320"]),
+    ("mobile", ["-h", "-V", "6"]),
+))
+
+
+def parse_profile(spec):
+    """argparse type of --profile: NAME:OUTPUT_DIR, or NAME:OUTPUT_DIR:LAME_OPTS with the options space-separated"""
+    parts = spec.split(":", 2)
+    if len(parts) < 2 or not parts[0] or not parts[1]:
+        raise argparse.ArgumentTypeError("{!r} isn't NAME:OUTPUT_DIR[:LAME_OPTS].".format(spec))
+    name, output_dir = parts[:2]
+    if not name.replace("-", "").replace("_", "").isalnum():
+        raise argparse.ArgumentTypeError("Profile names are letters, digits, - and _, not {!r}.".format(name))
+    if name == DEFAULT_NAME:
+        raise argparse.ArgumentTypeError("{} is the name of the --output_dir profile.".format(DEFAULT_NAME))
+
+    if len(parts) == 3:
+        lame_opts = parts[2].split()
+    elif name in PRESETS:
+        lame_opts = PRESETS[name]
+    else:
+        raise argparse.ArgumentTypeError("{} isn't a preset ({}); give its LAME_OPTS.".format(name, ", ".join(PRESETS)))
+    return Profile(name=name, lame_opts=list(lame_opts), output_dir=os.path.abspath(output_dir))
+
+
+def for_output_dir(output_dir, extra_profiles=()):
+    """The profiles of a disc converted into output_dir: its own, then extra_profiles"""
+    profiles = [Profile(name=DEFAULT_NAME, lame_opts=mp3.LAME_OPTS, output_dir=os.path.abspath(output_dir))]
+    profiles.extend(extra_profiles)
+    assert len(set(p.name for p in profiles)) == len(profiles), "Profile names must be unique."
+    assert len(set(p.output_dir for p in profiles)) == len(profiles), "Every profile needs an output directory of its own."
+    return profiles
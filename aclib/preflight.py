@@ -0,0 +1,185 @@
+"""Checks of every disc of a run before any of them is converted, so that what would otherwise fail part-way through
+one is reported up front, all at once.
+
+Discs are audio-convert's PendingDiscs, whose pending_audio_files are PendingAudioFiles."""
+
+import collections
+import os
+import tempfile
+import time
+
+from . import (
+    audioformat,
+    outputprofile,
+    util,
+)
+
+class PreflightException(Exception):
+    # thrown before any work is done when discs can't be converted as they are; lists every problem found
+    pass
+
+
+def check(pending_discs, processed_dirname, output_catalog=None, stream=False, extra_profiles=()):
+    """Raises a PreflightException listing every problem find_problems() finds"""
+    problems = find_problems(pending_discs, processed_dirname, output_catalog, stream, extra_profiles)
+    if problems:
+        raise PreflightException("{} problem(s) found before converting anything:\n{}".format(
+            len(problems),
+            "\n".join(problems),
+        ))
+
+
+def find_problems(pending_discs, processed_dirname, output_catalog=None, stream=False, extra_profiles=()):
+    """Problems converting pending_discs as they are: missing tags, track numbers that don't fit file names, targets
+    (in every profile) that already exist or that several tracks share, discs with tracks for several directories,
+    sources that can't be moved to processed_dirname in their output directory, discs output_catalog (a
+    catalog.Catalog, if given) already has, unwritable output directories and too little free space.
+
+    Catalog entries of files that no longer exist are removed along the way."""
+    problems = []
+    targets = set()
+    processed_targets = set()
+    # bytes needed by output directory
+    space_needed = {}
+    for disc in pending_discs:
+        pafs = disc.pending_audio_files
+        profiles = outputprofile.for_output_dir(disc.output_dir, extra_profiles)
+        # an interrupted run's output is the disc's own; a track that can't be named has no outputs
+        resumed = disc.resumed_filenames(profiles) if _has_filenames(pafs) else set()
+        disc_targets = collections.defaultdict(set)
+        for paf in pafs:
+            missing = paf.missing_tags()
+            if missing:
+                problems.append("{} is missing {}.".format(paf.current_filename, ", ".join(missing)))
+            try:
+                paf.new_filename
+            except util.InvalidDiscTrackException as exc:
+                problems.append("{}: {}".format(paf.current_filename, exc))
+                continue
+
+            for profile in profiles:
+                new_filename = os.path.abspath(paf.new_filename_for(profile))
+                if new_filename in targets:
+                    problems.append("{} is the target of more than one track.".format(new_filename))
+                targets.add(new_filename)
+                disc_targets[profile.name].add(new_filename)
+                if new_filename in resumed:
+                    continue
+                entry = None if output_catalog is None else output_catalog.get(new_filename)
+                if os.path.exists(new_filename):
+                    problems.append("{} would overwrite {}{}.".format(
+                        paf.current_filename,
+                        new_filename,
+                        "" if entry is None else time.strftime(", converted %Y-%m-%d %H:%M", time.localtime(entry.added)),
+                    ))
+                elif entry is not None:
+                    # deleted since
+                    output_catalog.remove(new_filename)
+
+        if any(len(set(os.path.dirname(target) for target in profile_targets)) > 1
+               for profile_targets in disc_targets.itervalues()):
+            problems.append("{} has tracks for more than one output directory.".format(disc.dirname))
+        if output_catalog is not None and not any(paf.is_singles for paf in pafs):
+            for profile in profiles:
+                problems.extend(duplicate_discs(output_catalog, disc, profile, resumed | targets))
+
+        processed_target = os.path.join(
+            os.path.abspath(disc.output_dir),
+            processed_dirname,
+            disc.processed_subdir,
+            os.path.basename(disc.dirname),
+        )
+        if os.path.exists(processed_target) or processed_target in processed_targets:
+            problems.append("{} can't be moved to {}, which is taken.".format(disc.dirname, processed_target))
+        processed_targets.add(processed_target)
+
+        for output_dir, num_bytes in estimate_space(disc, profiles, stream).iteritems():
+            if output_dir not in space_needed and not os.access(output_dir, os.W_OK):
+                problems.append("{} isn't writable.".format(output_dir))
+            space_needed[output_dir] = space_needed.get(output_dir, 0) + num_bytes
+
+    if output_catalog is not None:
+        output_catalog.flush()
+    problems.extend(space_problems(space_needed))
+    return problems
+
+
+def _has_filenames(pafs):
+    try:
+        for paf in pafs:
+            paf.new_filename
+    except util.InvalidDiscTrackException:
+        return False
+    return True
+
+
+def duplicate_discs(output_catalog, disc, profile, own_filenames):
+    """Problems for each disc of an album in disc that the catalog says was already converted for profile, other than
+    to own_filenames"""
+    problems = []
+    for album_artist, album, year, cd_no in sorted(set(
+            (paf.proposed_tags.album_artist, paf.proposed_tags.album, paf.proposed_tags.year, paf.proposed_tags.cd_no)
+            for paf in disc.pending_audio_files)):
+        existing = []
+        for entry in output_catalog.find_album(profile.output_dir, album_artist, album, year, cd_no=cd_no):
+            if entry.path in own_filenames:
+                continue
+            if os.path.exists(entry.path):
+                existing.append(entry.path)
+            else:
+                output_catalog.remove(entry.path)
+        if existing:
+            problems.append("{} is disc {} of {} - {} ({}), already converted to {}.".format(
+                disc.dirname,
+                cd_no,
+                unicode(album_artist).encode("utf8"),
+                unicode(album).encode("utf8"),
+                year,
+                os.path.dirname(existing[0]),
+            ))
+    return problems
+
+
+def estimate_space(disc, profiles, stream=False):
+    """Roughly the most bytes converting disc takes up at once, by directory: decoded WAVs (unless streamed) and
+    encoded MP3s in the work directory, in the system temp dir, and tagged copies in every profile's output
+    directory"""
+    pafs = disc.pending_audio_files
+    work_parent = tempfile.gettempdir()
+    space = dict((profile.output_dir, 0) for profile in profiles)
+    space[work_parent] = 0
+    can_stream = all(audioformat.codec_for_filename(paf.current_filename).can_stream for paf in pafs)
+    for paf in pafs:
+        size = os.path.getsize(paf.current_filename)
+        if not paf.needs_conversion():
+            for profile in profiles:
+                space[profile.output_dir] += size + audioformat.mp3.TAG_PADDING
+            continue
+        pcm_bytes = size * audioformat.codec_for_filename(paf.current_filename).pcm_ratio
+        mp3_bytes = int(pcm_bytes * audioformat.mp3.MAX_ENCODED_RATIO)
+        space[work_parent] += (0 if stream and can_stream else int(pcm_bytes)) + mp3_bytes * len(profiles)
+        for profile in profiles:
+            space[profile.output_dir] += mp3_bytes
+    return space
+
+
+def space_problems(space_needed):
+    """Problems for each filesystem with less free space than the output directories on it need, given the bytes
+    needed by output directory"""
+    needed_by_dev = {}
+    for output_dir, num_bytes in space_needed.iteritems():
+        dev = os.stat(output_dir).st_dev
+        dirs, total = needed_by_dev.get(dev, ([], 0))
+        needed_by_dev[dev] = (dirs + [output_dir], total + num_bytes)
+
+    problems = []
+    for dirs, num_bytes in needed_by_dev.itervalues():
+        st = os.statvfs(dirs[0])
+        free = st.f_bavail * st.f_frsize
+        if num_bytes > free:
+            problems.append("About {:.0f} MB are needed on the filesystem of {}, but only {:.0f} MB are free.".format(
+                num_bytes / float(1 << 20),
+                ", ".join(sorted(dirs)),
+                free / float(1 << 20),
+            ))
+    return problems
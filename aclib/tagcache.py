@@ -0,0 +1,179 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .audioformat.util import (
+    Tags,
+)
+from .util import (
+    makedirs,
+)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "audio-convert",
+)
+DEFAULT_MAX_ENTRIES = 500000
+
+# writes are committed in batches; flush() commits the rest
+COMMIT_EVERY = 256
+
+# stored as the database's user_version; bump it whenever the schema or what a reader returns for a file changes (e.g.
+# a parser fix), so that a cache of another version is discarded rather than served
+VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    path BLOB PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    tags TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_last_used ON tags (last_used);
+"""
+
+class TagCache(object):
+    """Persistent cache of parsed Tags, keyed by path and invalidated when the file's size, mtime or inode change.
+    Discarded entirely when opened by another VERSION.
+
+    Least recently used entries are evicted beyond max_entries. Safe to share between threads."""
+    def __init__(self, db_fn, max_entries=DEFAULT_MAX_ENTRIES):
+        self.db_fn = db_fn
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._pending_writes = 0
+        self._conn = sqlite3.connect(db_fn, check_same_thread=False)
+        version, = self._conn.execute("PRAGMA user_version").fetchone()
+        if version != VERSION:
+            self._conn.executescript("DROP TABLE IF EXISTS tags;")
+            self._conn.execute("PRAGMA user_version = {:d}".format(VERSION))
+        self._conn.executescript(SCHEMA)
+        self._num_entries, = self._conn.execute("SELECT COUNT(*) FROM tags").fetchone()
+
+
+    def get(self, path):
+        """Returns the cached Tags for path, or None if there are none for the file as it is now"""
+        key = stat_key(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, ino, tags FROM tags WHERE path = ?",
+                (sqlite3.Binary(key[0]),),
+            ).fetchone()
+
+            if row is None or tuple(row[:3]) != key[1:]:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE tags SET last_used = ? WHERE path = ?",
+                (time.time(), sqlite3.Binary(key[0])),
+            )
+            self._wrote()
+        return Tags(**json.loads(row[3]))
+
+
+    def put(self, path, tags, key=None):
+        """Caches tags for path. key is its stat_key() from before the tags were read, so tags of a file modified
+        while being read are never served; by default, the file as it is now."""
+        key = key or stat_key(path)
+        with self._lock:
+            replaced = self._conn.execute(
+                "DELETE FROM tags WHERE path = ?",
+                (sqlite3.Binary(key[0]),),
+            ).rowcount
+            self._conn.execute(
+                "INSERT INTO tags (path, size, mtime_ns, ino, tags, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (sqlite3.Binary(key[0]),) + key[1:] + (json.dumps(tags.to_dict()), time.time()),
+            )
+            self._num_entries += 1 - replaced
+            if self._num_entries > self.max_entries:
+                self._evict()
+            self._wrote()
+
+
+    def invalidate(self, path):
+        """Forgets path, for files rewritten in a way the stat key can't see (e.g. in place, keeping their mtime)"""
+        with self._lock:
+            self._num_entries -= self._conn.execute(
+                "DELETE FROM tags WHERE path = ?",
+                (sqlite3.Binary(os.path.abspath(path)),),
+            ).rowcount
+            self._wrote()
+
+
+    def read_tags(self, path, read_fn):
+        """Returns the Tags for path, calling read_fn(path) and caching the result on a miss"""
+        tags = self.get(path)
+        if tags is None:
+            key = stat_key(path)
+            tags = read_fn(path)
+            self.put(path, tags, key)
+        return tags
+
+
+    def flush(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending_writes = 0
+
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+    def _evict(self):
+        # drop an extra 10% so we don't evict on every insert
+        num_evicted = self._num_entries - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM tags WHERE path IN (SELECT path FROM tags ORDER BY last_used LIMIT ?)",
+            (num_evicted,),
+        )
+        self._num_entries -= num_evicted
+
+
+    def _wrote(self):
+        self._pending_writes += 1
+        if self._pending_writes >= COMMIT_EVERY:
+            self._conn.commit()
+            self._pending_writes = 0
+
+
+    def __repr__(self):
+        return "TagCache({}, hits={}, misses={})".format(self.db_fn, self.hits, self.misses)
+
+
+def stat_key(path):
+    """What a cache entry for path is valid for: the absolute path, and the file's size, mtime and inode"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    mtime_ns = getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 10 ** 9)
+    return (path, st.st_size, mtime_ns, st.st_ino)
+
+
+# the cache used by collector.AudioFile.read_tags; None bypasses caching
+_cache = None
+
+def configure(cache_dir=DEFAULT_CACHE_DIR, max_entries=DEFAULT_MAX_ENTRIES, enabled=True):
+    """Sets up (or with enabled=False, disables) the process-wide tag cache and returns it"""
+    global _cache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+
+    if enabled:
+        makedirs(cache_dir)
+        _cache = TagCache(os.path.join(cache_dir, "tags.sqlite"), max_entries=max_entries)
+    return _cache
+
+
+def get_cache():
+    return _cache
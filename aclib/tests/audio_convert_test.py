@@ -0,0 +1,308 @@
+import argparse
+import contextlib
+import imp
+import os
+import shutil
+
+import pytest
+
+from .. import (
+    collector,
+    journal,
+    outputprofile,
+    util,
+)
+from ..audioformat import (
+    mp3,
+    wav,
+)
+from ..audioformat.util import (
+    Tags,
+)
+from ..util import (
+    mktempdir,
+)
+
+from .util import (
+    MP3_FN,
+    WAV_FN,
+)
+
+# the script, loaded as a module
+audio_convert = imp.load_source(
+    "audio_convert",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "audio-convert.py"),
+)
+
+TAG_OVERRIDES = {
+    "album_artist": u"Artist",
+    "artist": u"Artist",
+    "album": u"Album",
+    "year": 2001,
+    "title": u"Title",
+}
+
+
+def _mksources(root, src_fn, name="CD1", num_tracks=2):
+    dirname = os.path.join(root, "inbox", name)
+    os.makedirs(dirname)
+    for track_no in xrange(1, num_tracks + 1):
+        shutil.copy(src_fn, os.path.join(dirname, "{:02d}{}".format(track_no, os.path.splitext(src_fn)[1])))
+    return dirname
+
+
+def _fake_encode(calls):
+    """Stands in for mp3.encode(), with the MP3 fixture as the encoding of every WAV"""
+    def encode(wav_fns, output_dir, jobs=1, lame_opts=None):
+        calls.append(list(wav_fns))
+        for fn in wav_fns:
+            shutil.copy(MP3_FN, os.path.join(output_dir, os.path.splitext(os.path.basename(fn))[0] + ".mp3"))
+    return encode
+
+
+@contextlib.contextmanager
+def _journal(cache_dir):
+    try:
+        yield journal.configure(cache_dir)
+    finally:
+        journal.configure(cache_dir, enabled=False)
+
+
+def _paf(tag_overrides, output_dir="out", fn="01.wav", num_total_discs=1, is_singles=False):
+    return audio_convert.PendingAudioFile(
+        collector.AudioFile(wav, fn),
+        tag_overrides,
+        num_total_discs,
+        is_singles,
+        output_dir,
+    )
+
+
+def test_proposed_tags_follow_overrides():
+    paf = _paf(dict(TAG_OVERRIDES, cd_no=1, track_no=3, cd_tracks=12))
+    paf.set_current_tags(Tags())
+    assert paf.proposed_tags.title == u"Title"
+    assert paf.track_num_representation == "03"
+    assert paf.new_filename == os.path.join("out", "Artist", "2001 - Album", "03 Title.mp3")
+    # computed once
+    assert paf.proposed_tags is paf.proposed_tags
+
+    # a new dict of overrides, as the plan editor assigns it, changes everything derived from them
+    paf.tag_overrides = dict(TAG_OVERRIDES, title=u"Other", album=u"B", cd_no=2, track_no=5, cd_tracks=12)
+    assert paf.proposed_tags.title == u"Other"
+    paf.num_total_discs = 2
+    assert paf.track_num_representation == "205"
+    assert paf.new_filename == os.path.join("out", "Artist", "2001 - B", "205 Other.mp3")
+
+
+def test_proposed_tags_follow_current_tags():
+    # nothing overrides the title or track number
+    paf = _paf({"album_artist": u"Artist", "album": u"Album", "year": 2001})
+    paf.set_current_tags(Tags(title=u"Old", cd_no=1, track_no=1, cd_tracks=9))
+    assert paf.new_filename == os.path.join("out", "Artist", "2001 - Album", "01 Old.mp3")
+
+    # e.g. read again in a batch
+    paf.set_current_tags(Tags(title=u"New", cd_no=1, track_no=2, cd_tracks=9))
+    assert paf.proposed_tags.title == u"New"
+    assert paf.track_num_representation == "02"
+    assert paf.new_filename == os.path.join("out", "Artist", "2001 - Album", "02 New.mp3")
+
+
+def test_plan_round_trip():
+    with mktempdir() as tmpdir:
+        dirnames = [_mksources(tmpdir, WAV_FN, name) for name in ("CD1", "CD2")]
+        out = os.path.join(tmpdir, "out")
+        discs = audio_convert.get_pending_discs(dirnames, dict(TAG_OVERRIDES, album=u"Caf\xe9"), out, False)
+        plan_fn = os.path.join(tmpdir, "plan.json")
+        audio_convert.write_plan(discs, out, plan_fn)
+
+        read_discs = audio_convert.read_plan(plan_fn)
+        assert len(read_discs) == 2
+        for disc, read_disc in zip(discs, read_discs):
+            assert read_disc.output_dir == out
+            assert read_disc.dirname == disc.dirname
+            for paf, read_paf in zip(disc.pending_audio_files, read_disc.pending_audio_files):
+                assert read_paf.current_filename == paf.current_filename
+                assert (read_paf.num_total_discs, read_paf.is_singles) == (2, False)
+                assert read_paf.proposed_tags == paf.proposed_tags
+                assert read_paf.new_filename == paf.new_filename
+
+
+def test_stale_plan():
+    with mktempdir() as tmpdir:
+        dirname = _mksources(tmpdir, WAV_FN, num_tracks=3)
+        out = os.path.join(tmpdir, "out")
+        plan_fn = os.path.join(tmpdir, "plan.json")
+        audio_convert.write_plan(audio_convert.get_pending_discs([dirname], TAG_OVERRIDES, out, False), out, plan_fn)
+        fns = sorted(os.path.join(dirname, fn) for fn in os.listdir(dirname))
+
+        # a different size, a different mtime, and gone
+        with open(fns[0], "ab") as f:
+            f.write("\0")
+        st = os.stat(fns[1])
+        os.utime(fns[1], (st.st_atime, st.st_mtime + 1))
+        os.remove(fns[2])
+        with pytest.raises(audio_convert.StalePlanException) as exc_info:
+            audio_convert.read_plan(plan_fn)
+        message = str(exc_info.value)
+        assert "3 source file(s) changed or disappeared" in message
+        assert all(fn in message for fn in fns)
+
+
+def test_resume(monkeypatch):
+    with mktempdir() as tmpdir:
+        dirname = _mksources(tmpdir, WAV_FN)
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(out)
+        encodes = []
+        monkeypatch.setattr(mp3, "encode", _fake_encode(encodes))
+
+        written = []
+        write_tags = audio_convert.PendingAudioFile.write_tags
+        def counting_write_tags(paf, tagged_fn, profile):
+            written.append(tagged_fn)
+            write_tags(paf, tagged_fn, profile)
+
+        def crashing_write_tags(paf, tagged_fn, profile):
+            if written:
+                raise RuntimeError("crashed")
+            counting_write_tags(paf, tagged_fn, profile)
+
+        with _journal(os.path.join(tmpdir, "cache")) as progress:
+            # killed while tagging the second track: nothing is cleaned up
+            disc, = audio_convert.get_pending_discs([dirname], TAG_OVERRIDES, out, False)
+            monkeypatch.setattr(audio_convert.PendingAudioFile, "write_tags", crashing_write_tags)
+            monkeypatch.setattr(audio_convert.PendingAudioFile, "discard_tagged_fns", lambda paf: None)
+            with pytest.raises(RuntimeError):
+                disc.process_disc()
+            assert len(encodes) == 1
+            assert len(written) == 1
+            disc_key, = progress.incomplete_discs()
+            assert progress.get(disc_key, "encoded", 2) is not None
+            assert progress.get(disc_key, "tagged", 2) is None
+
+            # picks up where it left off: nothing is encoded again, and only the second track is tagged
+            monkeypatch.undo()
+            monkeypatch.setattr(mp3, "encode", _fake_encode(encodes))
+            monkeypatch.setattr(audio_convert.PendingAudioFile, "write_tags", counting_write_tags)
+            disc, = audio_convert.get_pending_discs([dirname], TAG_OVERRIDES, out, False)
+            disc.process_disc()
+            assert len(encodes) == 1
+            assert len(written) == 2 and written[1] != written[0]
+
+            for paf in disc.pending_audio_files:
+                assert os.path.exists(paf.new_filename)
+                assert mp3.read_tags(paf.new_filename).album == u"Album"
+            assert os.listdir(os.path.join(out, "processed")) == ["CD1"]
+            assert not os.path.exists(dirname)
+            assert progress.incomplete_discs() == set()
+            assert not os.path.exists(os.path.join(progress.work_root(audio_convert.tempfile.gettempdir()), disc_key))
+
+
+def _mobile_profile(tmpdir):
+    output_dir = os.path.join(tmpdir, "mobile")
+    os.makedirs(output_dir)
+    return outputprofile.Profile(name="mobile", lame_opts=["-V", "6"], output_dir=output_dir)
+
+
+def test_profiles_share_decode(monkeypatch):
+    with mktempdir() as tmpdir:
+        dirname = _mksources(tmpdir, WAV_FN)
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(out)
+        mobile = _mobile_profile(tmpdir)
+        encodes = []
+        monkeypatch.setattr(mp3, "encode", _fake_encode(encodes))
+        decodes = []
+        decode = audio_convert.PendingAudioFile.decode
+        def counting_decode(paf, output_fn, verify=False):
+            decodes.append(output_fn)
+            decode(paf, output_fn, verify)
+        monkeypatch.setattr(audio_convert.PendingAudioFile, "decode", counting_decode)
+
+        with _journal(os.path.join(tmpdir, "cache")):
+            disc, = audio_convert.get_pending_discs([dirname], TAG_OVERRIDES, out, False)
+            disc.process_disc(extra_profiles=[mobile])
+
+        # each track decoded once, and encoded from that for both profiles
+        assert len(decodes) == 2
+        assert encodes == [decodes, decodes]
+        for paf in disc.pending_audio_files:
+            assert os.path.exists(paf.new_filename)
+            assert os.path.exists(paf.new_filename_for(mobile))
+            assert paf.encode_settings["mobile"]["lame_opts"] == ["-V", "6"]
+
+
+def test_profiles_resume(monkeypatch):
+    with mktempdir() as tmpdir:
+        # MP3s are tagged straight from the source, so no codec is needed
+        dirname = _mksources(tmpdir, MP3_FN)
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(out)
+        mobile = _mobile_profile(tmpdir)
+
+        written = []
+        write_tags = audio_convert.PendingAudioFile.write_tags
+        def counting_write_tags(paf, tagged_fn, profile):
+            written.append(profile.name)
+            write_tags(paf, tagged_fn, profile)
+        rename = audio_convert.PendingAudioFile.rename
+        def failing_rename(paf, profile):
+            if profile.name == "mobile":
+                raise RuntimeError("interrupted")
+            rename(paf, profile)
+
+        with _journal(os.path.join(tmpdir, "cache")) as progress:
+            # interrupted after the --output_dir profile's tracks were put in place, but not the other's
+            disc, = audio_convert.get_pending_discs([dirname], TAG_OVERRIDES, out, False)
+            monkeypatch.setattr(audio_convert.PendingAudioFile, "write_tags", counting_write_tags)
+            monkeypatch.setattr(audio_convert.PendingAudioFile, "rename", failing_rename)
+            with pytest.raises(RuntimeError):
+                disc.process_disc(extra_profiles=[mobile])
+            assert sorted(written) == ["default", "default", "mobile", "mobile"]
+            disc_key, = progress.incomplete_discs()
+            # journaled per track and profile
+            assert [progress.get(disc_key, "renamed", track) is not None for track in (1, 2, "mobile/1", "mobile/2")] \
+                == [True, True, False, False]
+            assert disc.resumed_filenames([mobile] + outputprofile.for_output_dir(out)[:1]) == set(
+                os.path.abspath(paf.new_filename) for paf in disc.pending_audio_files)
+
+            # only the other profile's tracks are done again
+            monkeypatch.setattr(audio_convert.PendingAudioFile, "rename", rename)
+            del written[:]
+            disc, = audio_convert.get_pending_discs([dirname], TAG_OVERRIDES, out, False)
+            disc.process_disc(extra_profiles=[mobile])
+            assert written == ["mobile", "mobile"]
+            for paf in disc.pending_audio_files:
+                assert os.path.exists(paf.new_filename)
+                assert mp3.read_tags(paf.new_filename_for(mobile)).album == u"Album"
+            assert progress.incomplete_discs() == set()
+
+
+def test_ingest_albums():
+    with mktempdir() as tmpdir:
+        inbox = os.path.join(tmpdir, "inbox")
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(out)
+        args = argparse.Namespace(output_dir=out, stream=False, profiles=[], verify=False)
+
+        # two albums whose discs are named alike, one with cover art
+        album_dirs = []
+        for album in (u"A", u"B"):
+            album_dir = os.path.join(inbox, album.encode("utf8"))
+            for disc in ("CD1", "CD2"):
+                dirname = _mksources(tmpdir, MP3_FN, os.path.join(album.encode("utf8"), disc))
+                for fn in os.listdir(dirname):
+                    mp3.write_tags(os.path.join(dirname, fn), Tags(album=album))
+            album_dirs.append(album_dir)
+        open(os.path.join(album_dirs[0], "cover.jpg"), "w").close()
+
+        for album_dir in album_dirs:
+            assert audio_convert.ingest_album(album_dir, {}, args, util.JobSlots(1))[0] == 4
+            # nothing left in the inbox to scan again
+            assert not os.path.exists(album_dir)
+
+        processed = os.path.join(out, "processed")
+        assert sorted(os.listdir(processed)) == ["A", "B"]
+        assert sorted(os.listdir(os.path.join(processed, "A"))) == ["CD1", "CD2", "cover.jpg"]
+        assert sorted(os.listdir(os.path.join(processed, "B"))) == ["CD1", "CD2"]
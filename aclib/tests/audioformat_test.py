@@ -1,9 +1,23 @@
 # -*- coding: utf8 -*-
 
+import array
 import contextlib
+import distutils.spawn
+import errno
+import hashlib
+import math
 import os
+import random
 import shutil
+import StringIO
+import struct
+import subprocess
+import sys
 import tempfile
+import threading
+
+import eyed3
+import pytest
 
 from .util import (
     FAAC_FN,
@@ -13,11 +27,18 @@ from .util import (
     WAV_FN,
 )
 
+from .. import (
+    audioformat,
+    trace,
+)
 from ..audioformat import (
     faac,
     flac,
+    id3,
     mp3,
+    mp4meta,
     vorbis,
+    vorbiscomment,
     wav,
 )
 from ..audioformat.util import (
@@ -73,9 +94,192 @@ def test_mp3_encode():
         # empty tags
         assert mp3.read_tags(encoded_fn) == Tags()
 
+def _gapless_album(tmpdir, track_frames, sample_rate=44100):
+    """Writes consecutive pieces of one noise signal as stereo WAV tracks, so every track boundary is continuous and
+    any shift of the audio shows. Returns the WAV file names and the album's PCM."""
+    rng = random.Random(0)
+    album = array.array("h", (int(max(-32768, min(32767, rng.gauss(0, 4000)))) for _ in xrange(2 * sum(track_frames))))
+    fmt_chunk = struct.pack("<HHIIHH", 1, 2, sample_rate, sample_rate * 4, 4, 16)
+    info = wav.WavInfo(fmt_chunk=fmt_chunk, channels=2, sample_rate=sample_rate, block_align=4, data_offset=None,
+                       data_size=None)
+
+    wav_fns = []
+    start = 0
+    for i, num_frames in enumerate(track_frames):
+        pcm = album[2 * start:2 * (start + num_frames)].tostring()
+        fn = os.path.join(tmpdir, "{:03d}.wav".format(i))
+        with open(fn, "wb") as f:
+            f.write(wav.wav_header(info, len(pcm)) + pcm)
+        wav_fns.append(fn)
+        start += num_frames
+    return wav_fns, album
+
+
+def _decode_mp3(fn, tmpdir):
+    """Decodes fn with lame, which trims the encoder delay/padding of its LAME header. Returns the PCM as mono sums."""
+    wav_fn = os.path.join(tmpdir, os.path.basename(fn) + ".wav")
+    subprocess.check_call(["lame", "--quiet", "--decode", fn, wav_fn])
+    info = wav.read_wav_info(wav_fn)
+    assert (info.channels, info.block_align) == (2, 4)
+    return _mono(array.array("h", wav.read_pcm(wav_fn, info, 0, info.data_size // info.block_align)))
+
+
+def _mono(samples):
+    return [samples[i] + samples[i + 1] for i in xrange(0, len(samples), 2)]
+
+
+def _rms_error(decoded, source):
+    return math.sqrt(sum((a - b) ** 2 for a, b in zip(decoded, source)) / float(len(source)))
+
+
+def test_mp3_gapless_encode():
+    """Parallel per-track encoding should be as gapless as the serial --nogap encode"""
+    # not multiples of the frame size, so boundaries fall mid-frame
+    track_frames = [30011, 25013, 27011]
+    with mktempdir() as tmpdir:
+        wav_fns, album = _gapless_album(tmpdir, track_frames)
+        album = _mono(album)
+
+        serial_dir = os.path.join(tmpdir, "serial")
+        parallel_dir = os.path.join(tmpdir, "parallel")
+        os.mkdir(serial_dir)
+        os.mkdir(parallel_dir)
+
+        mp3.encode(wav_fns, serial_dir, jobs=1)
+        mp3.encode(wav_fns, parallel_dir, jobs=3)
+
+        serial_counts = []
+        parallel_counts = []
+        for i in xrange(3):
+            serial_counts.append(mp3.gapless_sample_count(os.path.join(serial_dir, "{:03d}.mp3".format(i))))
+            parallel_counts.append(mp3.gapless_sample_count(os.path.join(parallel_dir, "{:03d}.mp3".format(i))))
+
+        # borrowed boundary samples are trimmed again, leaving exactly the source audio
+        assert parallel_counts == track_frames
+        assert sum(parallel_counts) == sum(serial_counts)
+
+        decoded = [_decode_mp3(os.path.join(parallel_dir, "{:03d}.mp3".format(i)), tmpdir) for i in xrange(3)]
+        assert [len(d) for d in decoded] == track_frames
+
+        # the audio either side of each boundary lines up with the source, not with the source shifted (e.g. by the
+        # borrowed samples)
+        window = mp3.GAPLESS_CONTEXT_SAMPLES
+        shifts = range(-4, 5) + [
+            -window, -window // 2, window // 2, window,
+        ]
+        boundary = 0
+        for i in xrange(2):
+            boundary += track_frames[i]
+            for decoded_pcm, source_start in (
+                    (decoded[i][-window:], boundary - window),
+                    (decoded[i + 1][:window], boundary),
+            ):
+                errors = dict(
+                    (shift, _rms_error(decoded_pcm, album[source_start + shift:source_start + shift + window]))
+                    for shift in shifts
+                )
+                assert min(errors, key=errors.get) == 0
+                # lossy, but close
+                assert errors[0] < 0.5 * _rms_error(album[source_start:source_start + window], [0] * window)
+
+
+requires_lame = pytest.mark.skipif(distutils.spawn.find_executable("lame") is None, reason="lame isn't installed")
+
+@requires_lame
+def test_mp3_gapless_encode_concurrent():
+    """Concurrent encoders don't inherit each other's stdin, which would keep them from ever finishing"""
+    track_frames = [5003] * 8
+    with mktempdir() as tmpdir:
+        wav_fns, _ = _gapless_album(tmpdir, track_frames)
+        output_dir = os.path.join(tmpdir, "out")
+        os.mkdir(output_dir)
+
+        encoder = threading.Thread(target=mp3.encode_gapless, args=(wav_fns, output_dir, 4))
+        encoder.daemon = True
+        encoder.start()
+        encoder.join(120)
+        assert not encoder.is_alive(), "encode_gapless() deadlocked"
+        assert [mp3.gapless_sample_count(os.path.join(output_dir, "{:03d}.mp3".format(i))) for i in xrange(8)] \
+            == track_frames
+
+
+def test_mp3_lame_tag():
+    with _mp3_copy_fn() as fn:
+        tag = mp3.read_lame_tag(fn)
+        assert tag.sample_rate == 11025
+        assert tag.samples_per_frame == 576
+        assert tag.num_frames == 36
+        assert (tag.delay, tag.padding) == (576, 836)
+
+        with open(fn, "rb") as f:
+            original = f.read()
+
+        # rewriting the same values keeps the file (and its checksum) intact
+        mp3.write_lame_delay_padding(fn, tag.delay, tag.padding)
+        with open(fn, "rb") as f:
+            assert f.read() == original
+
+        mp3.add_lame_delay_padding(fn, 1152, 100, 11025)
+        new_tag = mp3.read_lame_tag(fn)
+        assert (new_tag.delay, new_tag.padding) == (576 + 1152, 836 + 100)
+        assert mp3.gapless_sample_count(fn) == 36 * 576 - (576 + 1152) - (836 + 100)
+
+        with pytest.raises(mp3.InvalidLameTagException):
+            mp3.write_lame_delay_padding(fn, 4096, 0)
+
+        # tags are untouched
+        assert mp3.read_tags(fn) == MP3_FIXTURE_TAGS
+
+
+def test_wav_info():
+    info = wav.read_wav_info(WAV_FN)
+    assert (info.channels, info.sample_rate, info.block_align) == (2, 11025, 4)
+    assert info.data_size == 19456 * 4
+
+    with open(WAV_FN, "rb") as f:
+        data = f.read()
+    assert wav.read_pcm(WAV_FN, info, 0, 10) == data[info.data_offset:info.data_offset + 40]
+    assert wav.read_pcm(WAV_FN, info, -10, 100) == data[info.data_offset + info.data_size - 40:info.data_offset + info.data_size]
+
+    # a rendered header describes the same format
+    with tempfile.NamedTemporaryFile(suffix=".wav") as f:
+        f.write(wav.wav_header(info, 40))
+        f.write(wav.read_pcm(WAV_FN, info, 0, 10))
+        f.flush()
+        new_info = wav.read_wav_info(f.name)
+        assert new_info.fmt_chunk == info.fmt_chunk
+        assert new_info.data_size == 40
+
+
 def test_mp3_read_tags():
-    tags = mp3.read_tags(MP3_FN)
-    assert tags == MP3_FIXTURE_TAGS
+    for backend in mp3.TAG_BACKENDS:
+        tags = mp3.read_tags(MP3_FN, backend=backend)
+        assert tags == MP3_FIXTURE_TAGS
+
+
+def test_native_id3():
+    assert id3.read_tags(MP3_FN) == MP3_FIXTURE_TAGS
+    assert id3.read_frames(MP3_FN).version == (4, 0)
+
+    # not an ID3v2 tag
+    assert id3.read_frames(WAV_FN) is None
+    with pytest.raises(id3.InvalidMetadataException):
+        id3.read_tags(WAV_FN)
+
+    # ID3v2.3 (as written by eyed3) reads the same as with eyed3
+    with _mp3_copy_fn() as fn:
+        f = eyed3.load(fn)
+        f.tag.save(version=eyed3.id3.ID3_V2_3)
+        assert id3.read_frames(fn).version == (3, 0)
+        assert id3.read_tags(fn) == mp3.read_tags(fn, backend="eyed3")
+
+    # unsynchronised tags fall back to eyed3
+    with _mp3_copy_fn() as fn:
+        with open(fn, "r+b") as f:
+            f.seek(5)
+            f.write(chr(id3.FLAG_UNSYNC))
+        with pytest.raises(id3.InvalidMetadataException):
+            id3.read_tags(fn)
 
 
 def test_mp3_write_tags():
@@ -149,6 +353,40 @@ def test_mp3_track_cd():
         assert tags.cd_no == 14
 
 
+def test_mp3_write_tagged_copy():
+    """Ensures the single-pass copy has the same tags as an in-place write, and leaves room for later edits"""
+    new_tags = Tags(
+        album_artist=u"hello",
+        artist=u"", # clears the tag
+        track_no=555,
+        year=2022,
+        encoded_by=u"puppy dogs",
+    )
+    with _mp3_copy_fn() as fn, mktempdir() as tmpdir:
+        copy_fn = os.path.join(tmpdir, "tagged.mp3")
+        mp3.write_tagged_copy(fn, copy_fn, new_tags)
+
+        mp3.write_tags(fn, new_tags)
+        assert mp3.read_tags(copy_fn) == mp3.read_tags(fn)
+
+        # the audio is untouched
+        audio_size = os.path.getsize(MP3_FN) - eyed3.load(unicode(MP3_FN)).tag.file_info.tag_size
+        copy_tag = eyed3.load(unicode(copy_fn)).tag
+        copy_tag_size = copy_tag.file_info.tag_size
+        assert id3.tag_size(copy_fn) == copy_tag_size
+        assert copy_tag.file_info.tag_padding_size >= mp3.TAG_PADDING
+        assert os.path.getsize(copy_fn) == copy_tag_size + audio_size
+        with open(MP3_FN, "rb") as f1, open(copy_fn, "rb") as f2:
+            f1.seek(-audio_size, os.SEEK_END)
+            f2.seek(copy_tag_size)
+            assert f1.read() == f2.read()
+
+        # later edits fit in the padding
+        mp3.write_tags(copy_fn, Tags(title=u"A somewhat longer title than before"))
+        assert os.path.getsize(copy_fn) == copy_tag_size + audio_size
+        assert mp3.read_tags(copy_fn).title == u"A somewhat longer title than before"
+
+
 def test_mp3_genre():
     """Ensures that we properly validate genres"""
     def _validate(
@@ -185,18 +423,109 @@ def test_mp3_genre():
 
 
 def test_faac_read_tags():
-    tags = faac.read_tags(FAAC_FN)
-    assert tags == FAAC_FIXTURE_TAGS
+    for backend in faac.TAG_BACKENDS:
+        tags = faac.read_tags(FAAC_FN, backend=backend)
+        assert tags == FAAC_FIXTURE_TAGS
+
+
+def test_native_mp4meta():
+    assert faac.read_tags(FAAC_FN, backend="native") == FAAC_FIXTURE_TAGS
+
+    # only the tag list is read
+    items = mp4meta.read_ilst_items(FAAC_FN)
+    assert items["\xa9nam"] == (mp4meta.DATA_TYPE_UTF8, "Make It So")
+
+    with pytest.raises(mp4meta.InvalidMetadataException):
+        mp4meta.read_tags(FLAC_FN)
+
+    # no tags at all
+    with tempfile.NamedTemporaryFile(suffix=".mp4") as f:
+        with open(FAAC_FN, "rb") as fixture:
+            f.write(fixture.read(12093))
+        f.flush()
+        assert mp4meta.read_tags(f.name) == Tags()
+
+
+def _adts_stream(num_frames):
+    """A raw ADTS stream, as faac writes to .aac: AAC frames with no MP4 container"""
+    frames = []
+    for _ in xrange(num_frames):
+        payload = os.urandom(64)
+        length = 7 + len(payload)
+        # MPEG-4 AAC LC, 44.1 kHz, stereo, no CRC, VBR buffer fullness
+        frames.append(
+            "\xff\xf1\x50" + chr(0x80 | (length >> 11)) + chr((length >> 3) & 0xff) + chr(((length & 7) << 5) | 0x1f)
+            + "\xfc" + payload
+        )
+    return "".join(frames)
+
+
+def test_faac_read_tags_adts(monkeypatch):
+    with tempfile.NamedTemporaryFile(suffix=".aac") as f:
+        f.write(_adts_stream(4))
+        f.flush()
+        with pytest.raises(mp4meta.InvalidMetadataException):
+            mp4meta.read_tags(f.name)
+
+        # there are no atoms to read, so faad is asked instead
+        faad_cmds = []
+        def check_output(cmd, **kwargs):
+            faad_cmds.append(cmd)
+            return "ADTS, 0.093 sec, 128 kbps, 44100 Hz\n\nTitle: Make It So\nAlbum: Star Trek\n"
+        monkeypatch.setattr(faac.trace, "check_output", check_output)
+        tags = faac.read_tags(f.name)
+        assert (tags.title, tags.album) == (u"Make It So", u"Star Trek")
+        assert faad_cmds == [["faad", "--info", f.name]]
+
+
+def test_faac_audio_payload_hash_adts():
+    adts = _adts_stream(4)
+    with tempfile.NamedTemporaryFile(suffix=".aac") as f:
+        f.write(adts)
+        f.flush()
+        original_hash = faac.audio_payload_hash(f.name)
+
+        # an ID3v2 tag in front isn't audio
+        f.seek(0)
+        f.write("ID3\x04\0\0\0\0\0\x0a" + "\0" * 10 + adts)
+        f.flush()
+        assert faac.audio_payload_hash(f.name) == original_hash
+
+        f.seek(-1, os.SEEK_END)
+        f.write("\0" if adts[-1] != "\0" else "\1")
+        f.flush()
+        assert faac.audio_payload_hash(f.name) != original_hash
 
 
 def test_flac_read_tags():
-    tags = flac.read_tags(FLAC_FN)
-    assert tags == FLAC_FIXTURE_TAGS
+    for backend in flac.TAG_BACKENDS:
+        tags = flac.read_tags(FLAC_FN, backend=backend)
+        assert tags == FLAC_FIXTURE_TAGS
 
 
 def test_vorbis_read_tags():
-    tags = vorbis.read_tags(VORBIS_FN)
-    assert tags == VORBIS_FIXTURE_TAGS
+    for backend in vorbis.TAG_BACKENDS:
+        tags = vorbis.read_tags(VORBIS_FN, backend=backend)
+        assert tags == VORBIS_FIXTURE_TAGS
+
+
+def test_native_vorbiscomment():
+    assert flac.read_tags(FLAC_FN, backend="native") == FLAC_FIXTURE_TAGS
+    assert vorbis.read_tags(VORBIS_FN, backend="native") == VORBIS_FIXTURE_TAGS
+
+    # wrong container
+    with pytest.raises(vorbiscomment.InvalidMetadataException):
+        vorbiscomment.read_flac_comments(VORBIS_FN)
+    with pytest.raises(vorbiscomment.InvalidMetadataException):
+        vorbiscomment.read_ogg_comments(FLAC_FN)
+
+    # truncated metadata
+    with tempfile.NamedTemporaryFile(suffix=".flac") as f:
+        with open(FLAC_FN, "rb") as fixture:
+            f.write(fixture.read(200))
+        f.flush()
+        with pytest.raises(vorbiscomment.InvalidMetadataException):
+            vorbiscomment.read_flac_comments(f.name)
 
 
 def test_wav_read_tags():
@@ -205,6 +534,15 @@ def test_wav_read_tags():
     assert tags == Tags()
 
 
+def test_wav_decode_to_pipe():
+    # the file itself, without a process to copy it
+    decoder = wav.decode_to_pipe(WAV_FN)
+    with open(WAV_FN, "rb") as f:
+        assert decoder.stdout.read() == f.read()
+    decoder.stdout.close()
+    assert trace.wait(decoder) == 0
+
+
 def _gen_end_to_end(input_fn, read_tags, decode):
     def f():
         with mktempdir() as tmpdir:
@@ -236,3 +574,231 @@ test_faac_end_to_end = _gen_end_to_end(FAAC_FN, faac.read_tags, faac.decode)
 test_flac_end_to_end = _gen_end_to_end(FLAC_FN, flac.read_tags, flac.decode)
 test_vorbis_end_to_end = _gen_end_to_end(VORBIS_FN, vorbis.read_tags, vorbis.decode)
 test_wav_end_to_end = _gen_end_to_end(WAV_FN, wav.read_tags, wav.decode)
+
+
+def _gen_stream_end_to_end(input_fn, decode_to_pipe):
+    def f():
+        with mktempdir() as tmpdir:
+            mp3_fn = os.path.join(tmpdir, "streamed.mp3")
+            mp3.encode_stream(decode_to_pipe(input_fn), mp3_fn)
+            assert os.path.getsize(mp3_fn) > 0
+
+            # no intermediate files
+            assert os.listdir(tmpdir) == ["streamed.mp3"]
+
+            # one decode, several encoders
+            mp3.encode_stream_many(decode_to_pipe(input_fn), [
+                (os.path.join(tmpdir, "a.mp3"), mp3.LAME_OPTS),
+                (os.path.join(tmpdir, "b.mp3"), ["-V", "9"]),
+            ])
+            assert os.path.getsize(os.path.join(tmpdir, "a.mp3")) == os.path.getsize(mp3_fn)
+            assert 0 < os.path.getsize(os.path.join(tmpdir, "b.mp3")) < os.path.getsize(mp3_fn)
+    return f
+
+
+def test_mp3_tee():
+    class _ClosedPipe(object):
+        closed = False
+        def write(self, buf):
+            raise IOError(errno.EPIPE, "Broken pipe")
+        def close(self):
+            self.closed = True
+
+    class _Sink(StringIO.StringIO):
+        def close(self):
+            self.result = self.getvalue()
+            StringIO.StringIO.close(self)
+
+    data = os.urandom(3 * mp3.STREAM_BLOCK_SIZE + 1)
+    closed_pipe = _ClosedPipe()
+    sinks = [_Sink(), _Sink()]
+    mp3._tee(StringIO.StringIO(data), [sinks[0], closed_pipe, sinks[1]])
+    assert [sink.result for sink in sinks] == [data, data]
+    assert closed_pipe.closed
+
+
+test_faac_stream_end_to_end = _gen_stream_end_to_end(FAAC_FN, faac.decode_to_pipe)
+test_flac_stream_end_to_end = _gen_stream_end_to_end(FLAC_FN, flac.decode_to_pipe)
+test_vorbis_stream_end_to_end = _gen_stream_end_to_end(VORBIS_FN, vorbis.decode_to_pipe)
+test_wav_stream_end_to_end = _gen_stream_end_to_end(WAV_FN, wav.decode_to_pipe)
+
+
+def _gen_read_tags_many(module, input_fn, expected_tags):
+    def f():
+        with mktempdir() as tmpdir:
+            ext = os.path.splitext(input_fn)[1]
+            fns = []
+            for i in xrange(5):
+                fn = os.path.join(tmpdir, "{:03d}{}".format(i, ext))
+                shutil.copy(input_fn, fn)
+                fns.append(fn)
+
+            for batch in (fns, fns[:1], []):
+                assert module.read_tags_many(batch, jobs=2) == [expected_tags] * len(batch)
+    return f
+
+
+test_faac_read_tags_many = _gen_read_tags_many(faac, FAAC_FN, FAAC_FIXTURE_TAGS)
+test_flac_read_tags_many = _gen_read_tags_many(flac, FLAC_FN, FLAC_FIXTURE_TAGS)
+test_mp3_read_tags_many = _gen_read_tags_many(mp3, MP3_FN, MP3_FIXTURE_TAGS)
+test_vorbis_read_tags_many = _gen_read_tags_many(vorbis, VORBIS_FN, VORBIS_FIXTURE_TAGS)
+test_wav_read_tags_many = _gen_read_tags_many(wav, WAV_FN, Tags())
+
+
+def _gen_audio_payload_hash(module, input_fn, tag_value, audio_offset):
+    """Editing a tag in place leaves the hash alone; editing the audio doesn't"""
+    def f():
+        with mktempdir() as tmpdir:
+            fn = os.path.join(tmpdir, "copy" + os.path.splitext(input_fn)[1])
+            shutil.copy(input_fn, fn)
+            original_hash = module.audio_payload_hash(fn)
+
+            with open(fn, "rb") as f:
+                data = f.read()
+            if tag_value is not None:
+                pos = data.index(tag_value)
+                data = data[:pos] + tag_value.swapcase() + data[pos + len(tag_value):]
+                with open(fn, "wb") as f:
+                    f.write(data)
+                assert module.audio_payload_hash(fn) == original_hash
+
+            pos = len(data) + audio_offset if audio_offset < 0 else audio_offset
+            with open(fn, "wb") as f:
+                f.write(data[:pos] + chr(ord(data[pos]) ^ 0xff) + data[pos + 1:])
+            assert module.audio_payload_hash(fn) != original_hash
+    return f
+
+
+test_faac_audio_payload_hash = _gen_audio_payload_hash(faac, FAAC_FN, "Make It So", 100)
+test_mp3_audio_payload_hash = _gen_audio_payload_hash(mp3, MP3_FN, "Make It So", -10)
+test_vorbis_audio_payload_hash = _gen_audio_payload_hash(vorbis, VORBIS_FN, "Make It So", -10)
+test_wav_audio_payload_hash = _gen_audio_payload_hash(wav, WAV_FN, None, -10)
+
+
+def test_flac_audio_payload_hash():
+    # the encoder's MD5 of the audio stands in for hashing the audio
+    info = flac.read_streaminfo(FLAC_FN)
+    assert (info.sample_rate, info.channels, info.bits_per_sample, info.total_samples) == (11025, 1, 8, 19324)
+    assert info.md5 != "\0" * 16
+
+    with _flac_copy_fn() as fn:
+        original_hash = flac.audio_payload_hash(fn)
+        with open(fn, "rb") as f:
+            data = f.read()
+        pos = data.index("Make It So")
+        with open(fn, "wb") as f:
+            f.write(data[:pos] + "MAKE IT SO" + data[pos + 10:])
+        assert flac.audio_payload_hash(fn) == original_hash
+
+
+def _streaminfo_flac(fn, channels, bits_per_sample, total_samples, md5):
+    """Writes a FLAC with nothing but a STREAMINFO block, all a verifier reads"""
+    packed = (11025 << 44) | ((channels - 1) << 41) | ((bits_per_sample - 1) << 36) | total_samples
+    streaminfo = "\0" * 10 + struct.pack(">Q", packed) + md5
+    with open(fn, "wb") as f:
+        f.write("fLaC" + struct.pack(">I", (0x80 << 24) | len(streaminfo)) + streaminfo)
+
+
+def _wav_stream(channels, bits_per_sample, pcm):
+    """The WAV flac -d -c writes, with a chunk before the data and the pad byte of an odd data chunk"""
+    block_align = channels * (bits_per_sample // 8)
+    fmt_chunk = struct.pack("<HHIIHH", 1, channels, 11025, 11025 * block_align, block_align, bits_per_sample)
+    chunks = (
+        struct.pack("<4sI", "fmt ", len(fmt_chunk)) + fmt_chunk
+        + struct.pack("<4sI", "LIST", 3) + "abc\0"
+        + struct.pack("<4sI", "data", len(pcm)) + pcm + "\0" * (len(pcm) % 2)
+    )
+    return struct.pack("<4sI4s", "RIFF", 4 + len(chunks), "WAVE") + chunks
+
+
+def _gen_flac_verifier(channels, bits_per_sample):
+    def f():
+        total_samples = 1001
+        # the MD5 is of signed samples, which WAV stores unsigned at 8 bits
+        samples = os.urandom(total_samples * channels * bits_per_sample // 8)
+        pcm = samples.translate(flac._SIGN_FLIP) if bits_per_sample == 8 else samples
+        stream = _wav_stream(channels, bits_per_sample, pcm)
+
+        def feed(verifier, stream):
+            # in blocks that split the header and the samples anywhere
+            for start, end in zip((0, 7, 30, 51), (7, 30, 51, len(stream))):
+                verifier.feed(stream[start:end])
+
+        with tempfile.NamedTemporaryFile(suffix=".flac") as fp:
+            _streaminfo_flac(fp.name, channels, bits_per_sample, total_samples, hashlib.md5(samples).digest())
+            verifier = flac.make_verifier(fp.name)
+            feed(verifier, stream)
+            assert verifier.result() == flac.VERIFIED
+
+            corrupt = stream[:-10] + chr(ord(stream[-10]) ^ 1) + stream[-9:]
+            for bad_stream in (corrupt, stream[:-100]):
+                verifier = flac.make_verifier(fp.name)
+                feed(verifier, bad_stream)
+                with pytest.raises(flac.Md5MismatchException):
+                    verifier.result()
+
+            # nothing to check against
+            _streaminfo_flac(fp.name, channels, bits_per_sample, total_samples, "\0" * 16)
+            verifier = flac.make_verifier(fp.name)
+            feed(verifier, corrupt)
+            assert verifier.result() == flac.NO_MD5
+    return f
+
+test_flac_verifier_8_bit = _gen_flac_verifier(1, 8)
+test_flac_verifier_16_bit = _gen_flac_verifier(2, 16)
+
+
+def test_wav_find_data():
+    stream = _wav_stream(2, 16, "\0" * 8)
+    data_offset = stream.index("data") + 8
+    assert wav.find_data(stream) == data_offset
+    assert wav.find_data(stream[:data_offset]) == data_offset
+    assert wav.find_data(stream[:data_offset - 1]) is None
+    assert wav.find_data(stream[:5]) is None
+    with pytest.raises(wav.InvalidWavException):
+        wav.find_data("fLaC" + stream[4:])
+
+
+def test_flac_verify_end_to_end():
+    with mktempdir() as tmpdir:
+        wav_fn = os.path.join(tmpdir, "decoded.wav")
+        assert flac.decode(FLAC_FN, wav_fn, verify=True) == flac.VERIFIED
+        assert wav.read_wav_info(wav_fn).data_size == 19324
+
+        # while streaming, with no intermediate WAV
+        verifier = flac.make_verifier(FLAC_FN)
+        mp3.encode_stream_many(
+            flac.decode_to_pipe(FLAC_FN),
+            [(os.path.join(tmpdir, "streamed.mp3"), mp3.LAME_OPTS)],
+            observe=verifier.feed,
+        )
+        assert verifier.result() == flac.VERIFIED
+
+
+def test_codecs():
+    for codec in audioformat.CODECS:
+        module = audioformat.load_module(codec)
+        assert module.__name__ == "aclib.audioformat." + codec.name
+        assert hasattr(module, "read_tags_many")
+        assert hasattr(module, "decode_to_pipe") == codec.can_stream
+        assert hasattr(module, "audio_payload_hash")
+        assert codec.pcm_ratio >= 1
+        assert hasattr(module, "make_verifier") == codec.can_verify
+        for ext in codec.extensions:
+            assert audioformat.module_for_filename("Track" + ext.upper()) is module
+
+    assert audioformat.codec_for_filename("dir.flac/cover.jpg") is None
+    # a hidden file, not an extension
+    assert audioformat.codec_for_filename(".flac") is None
+
+
+def test_lazy_imports():
+    # importing the collector and finding a FLAC loads neither the other formats nor eyed3
+    output = subprocess.check_output([
+        sys.executable, "-c",
+        "import sys; from aclib import collector, audioformat; audioformat.module_for_filename('a.flac'); "
+        "print ' '.join(sorted(m for m in sys.modules if m.startswith(('aclib.audioformat.', 'eyed3')) and sys.modules[m]))",
+    ], cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    loaded = set(output.split())
+    assert "aclib.audioformat.flac" in loaded
+    assert not loaded & {"aclib.audioformat.faac", "aclib.audioformat.vorbis", "aclib.audioformat.mp4meta", "eyed3"}
@@ -0,0 +1,105 @@
+import os
+import shutil
+import sqlite3
+
+from .. import (
+    catalog,
+)
+from ..audioformat import (
+    mp3,
+)
+from ..audioformat.util import (
+    Tags,
+)
+from ..util import (
+    mktempdir,
+)
+
+from .util import (
+    MP3_FN,
+)
+
+
+def _tags(cd_no, track_no, album=u"Album"):
+    return Tags(album_artist=u"Artist", artist=u"Artist", title=u"Title", album=album, year=2001, cd_no=cd_no,
+                track_no=track_no, cd_tracks=2)
+
+
+def test_catalog():
+    with mktempdir() as tmpdir:
+        root = os.path.join(tmpdir, "out")
+        output_catalog = catalog.Catalog(os.path.join(tmpdir, "catalog.sqlite"))
+        fns = []
+        for cd_no, track_no in ((1, 1), (1, 2), (2, 1)):
+            fn = os.path.join(root, "Artist", "2001 - Album", "{}-{:02d} Title.mp3".format(cd_no, track_no))
+            output_catalog.add(fn, root, _tags(cd_no, track_no), duration=1.5, source_hash="{}{}".format(cd_no, track_no),
+                               encode_settings={"mode": "copy"}, verification="verified")
+            fns.append(fn)
+
+        entry = output_catalog.get(fns[0])
+        assert entry.path == fns[0]
+        assert entry.tags == _tags(1, 1)
+        assert (entry.duration, entry.source_hash, entry.encode_settings) == (1.5, "11", {"mode": "copy"})
+        assert entry.verification == "verified"
+        assert output_catalog.get(os.path.join(root, "missing.mp3")) is None
+
+        # case-insensitively, by disc, and only under the same root
+        assert [e.path for e in output_catalog.find_album(root, u"ARTIST", u"album", u"2001")] == sorted(fns)
+        assert [e.path for e in output_catalog.find_album(root, u"Artist", u"Album", 2001, cd_no=2)] == fns[2:]
+        assert output_catalog.find_album(root, u"Artist", u"Album", 2002) == []
+        assert output_catalog.find_album(tmpdir, u"Artist", u"Album", 2001) == []
+        assert [e.path for e in output_catalog.find_source("12")] == fns[1:2]
+
+        # replaced, removed, and persisted once flushed
+        output_catalog.add(fns[0], root, _tags(1, 1, album=u"Other"))
+        output_catalog.remove(fns[1])
+        output_catalog.close()
+        output_catalog = catalog.Catalog(os.path.join(tmpdir, "catalog.sqlite"))
+        assert len(output_catalog) == 2
+        assert output_catalog.get(fns[0]).tags.album == u"Other"
+        assert output_catalog.get(fns[0]).source_hash is None
+        assert output_catalog.get(fns[0]).verification is None
+        assert output_catalog.get(fns[1]) is None
+        output_catalog.close()
+
+
+def test_catalog_added_columns():
+    with mktempdir() as tmpdir:
+        db_fn = os.path.join(tmpdir, "catalog.sqlite")
+        fn = os.path.join(tmpdir, "out", "01.mp3")
+        # a catalog from before verification was recorded
+        conn = sqlite3.connect(db_fn)
+        conn.executescript(catalog.SCHEMA.replace(",\n    verification TEXT", ""))
+        conn.execute(
+            "INSERT INTO files (path, root, tags, added) VALUES (?, ?, ?, ?)",
+            (sqlite3.Binary(fn), sqlite3.Binary(tmpdir), "{}", 1.0),
+        )
+        conn.commit()
+        conn.close()
+
+        output_catalog = catalog.Catalog(db_fn)
+        assert output_catalog.get(fn).verification is None
+        output_catalog.add(fn, tmpdir, _tags(1, 1), verification="no_md5")
+        output_catalog.close()
+        output_catalog = catalog.Catalog(db_fn)
+        assert output_catalog.get(fn).verification == "no_md5"
+        output_catalog.close()
+
+
+def test_add_library():
+    with mktempdir() as tmpdir:
+        root = os.path.join(tmpdir, "out")
+        album_dir = os.path.join(root, "Artist", "2001 - Album")
+        os.makedirs(album_dir)
+        os.makedirs(os.path.join(root, "processed"))
+        for name in ("01.mp3", "02.mp3"):
+            shutil.copy(MP3_FN, os.path.join(album_dir, name))
+        shutil.copy(MP3_FN, os.path.join(root, "processed", "01.mp3"))
+
+        output_catalog = catalog.Catalog(os.path.join(tmpdir, "catalog.sqlite"))
+        assert catalog.add_library(output_catalog, root, jobs=2, skip_dirnames=("processed",)) == 2
+        tags = mp3.read_tags(MP3_FN)
+        entries = output_catalog.find_album(root, tags.album_artist, tags.album, tags.year)
+        assert [e.path for e in entries] == [os.path.join(album_dir, name) for name in ("01.mp3", "02.mp3")]
+        assert all(e.tags == tags and e.source_hash is None for e in entries)
+        output_catalog.close()
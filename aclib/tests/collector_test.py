@@ -1,10 +1,13 @@
 import collections
 import os
+import shutil
 
 import pytest
 
 from ..collector import (
     collect_audio_files,
+    read_tags_many,
+    scan_library,
     InvalidAudioDirectorException,
 )
 
@@ -18,6 +21,9 @@ from .util import (
 
     mkaudiodir,
 )
+from ..util import (
+    mktempdir,
+)
 
 
 def test_basic_collector():
@@ -68,3 +74,60 @@ def test_empty_dir():
     with mkaudiodir(other_ext_map={".whatever": 2}) as audio_dir:
         with pytest.raises(InvalidAudioDirectorException):
             collect_audio_files(audio_dir)
+
+
+def test_read_tags_many():
+    with mkaudiodir(num_mp3=3, num_wav=2) as audio_dir:
+        audio_files = collect_audio_files(audio_dir, allow_heterogenous=True)
+        tags = read_tags_many(audio_files, jobs=2)
+        assert len(tags) == 5
+        for audio_file, t in zip(audio_files, tags):
+            assert t == audio_file.read_tags()
+
+
+def _mklibrary(root):
+    """Creates a small library: two discs of an album, a heterogenous directory and some directories to skip"""
+    for rel_dir, fns in (
+        ("Artist/Album/CD1", [FLAC_FN, FLAC_FN]),
+        ("Artist/Album/CD2", [FLAC_FN]),
+        ("Artist/Album/CD2/scans", []),
+        ("Mixed", [FLAC_FN, MP3_FN]),
+        ("processed/Old", [MP3_FN]),
+        (".hidden", [MP3_FN]),
+    ):
+        os.makedirs(os.path.join(root, rel_dir))
+        for idx, fn in enumerate(fns):
+            shutil.copy(fn, os.path.join(root, rel_dir, "{:03d}{}".format(idx, os.path.splitext(fn)[1])))
+    open(os.path.join(root, "Artist", "Album", "cover.jpg"), "w").close()
+    os.symlink(os.path.join(root, "Artist"), os.path.join(root, "Artist", "Album", "loop"))
+
+
+def _gen_scan_library(jobs):
+    def test():
+        with mktempdir() as root:
+            _mklibrary(root)
+            scanned = {
+                os.path.relpath(s.path, root): s
+                for s in scan_library(root, jobs=jobs, skip_dirnames=("processed",))
+            }
+            assert sorted(scanned) == ["Artist/Album/CD1", "Artist/Album/CD2", "Mixed"]
+
+            assert scanned["Artist/Album/CD1"].error is None
+            assert [f.path for f in scanned["Artist/Album/CD1"].audio_files] == [
+                f.path for f in collect_audio_files(os.path.join(root, "Artist/Album/CD1"))
+            ]
+            assert len(scanned["Artist/Album/CD2"].audio_files) == 1
+            assert isinstance(scanned["Mixed"].error, InvalidAudioDirectorException)
+
+            scanned = list(scan_library(os.path.join(root, "Mixed"), jobs=jobs, allow_heterogenous=True))
+            assert len(scanned) == 1
+            assert len(scanned[0].audio_files) == 2
+    return test
+
+test_scan_library = _gen_scan_library(1)
+test_scan_library_threaded = _gen_scan_library(4)
+
+
+def test_scan_library_error():
+    with pytest.raises(OSError):
+        list(scan_library("/nonexistent", jobs=4))
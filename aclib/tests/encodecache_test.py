@@ -0,0 +1,77 @@
+import os
+import shutil
+import time
+
+from .. import encodecache
+from ..audioformat import (
+    mp3,
+)
+from ..util import (
+    mktempdir,
+)
+
+from .util import (
+    MP3_FN,
+    WAV_FN,
+)
+
+
+def test_encode_cache():
+    with mktempdir() as tmpdir:
+        cache = encodecache.EncodeCache(os.path.join(tmpdir, "cache"))
+        output_fn = os.path.join(tmpdir, "out.mp3")
+
+        assert not cache.get("abc", output_fn)
+        assert not os.path.exists(output_fn)
+
+        cache.put("abc", MP3_FN)
+        assert cache.get("abc", output_fn)
+        with open(output_fn, "rb") as f, open(MP3_FN, "rb") as g:
+            assert f.read() == g.read()
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_encode_cache_eviction():
+    with mktempdir() as tmpdir:
+        size = os.path.getsize(MP3_FN)
+        cache = encodecache.EncodeCache(os.path.join(tmpdir, "cache"), max_bytes=2 * size, max_age=60)
+        for key in ("old", "a", "b", "c"):
+            cache.put(key, MP3_FN)
+
+        now = time.time()
+        os.utime(cache._path("old"), (now - 120, now - 120))
+        os.utime(cache._path("a"), (now - 10, now - 10))
+        os.utime(cache._path("b"), (now - 5, now - 5))
+
+        cache.evict()
+        output_fn = os.path.join(tmpdir, "out.mp3")
+        # too old, then least recently used beyond max_bytes
+        assert not cache.get("old", output_fn)
+        assert not cache.get("a", output_fn)
+        assert cache.get("b", output_fn)
+        assert cache.get("c", output_fn)
+
+
+def test_track_keys():
+    opts = mp3.LAME_OPTS
+    hashes = ["1", "2", "3", "4"]
+
+    for mode in ("stream", "gapless", "nogap"):
+        keys = encodecache.track_keys(hashes, opts, mode)
+        assert len(set(keys)) == 4
+        # deterministic
+        assert keys == encodecache.track_keys(hashes, opts, mode)
+        # depends on encoder settings
+        assert not set(keys) & set(encodecache.track_keys(hashes, opts + ["-q", "0"], mode))
+
+    def _changed(mode, new_hashes):
+        old, new = encodecache.track_keys(hashes, opts, mode), encodecache.track_keys(new_hashes, opts, mode)
+        return [a != b for a, b in zip(old, new)]
+
+    # only the changed track, its neighbours or the whole disc need re-encoding
+    assert _changed("stream", ["1", "2", "x", "4"]) == [False, False, True, False]
+    assert _changed("gapless", ["1", "2", "x", "4"]) == [False, True, True, True]
+    assert _changed("nogap", ["1", "2", "x", "4"]) == [True, True, True, True]
+
+    # the same audio in a different position of a gapless disc gets different neighbours
+    assert encodecache.track_keys(["1", "2"], opts, "gapless")[0] != encodecache.track_keys(["2", "1"], opts, "gapless")[1]
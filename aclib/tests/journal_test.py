@@ -0,0 +1,158 @@
+import os
+import time
+
+import pytest
+
+from .. import (
+    journal,
+)
+from ..util import (
+    mktempdir,
+)
+
+
+def test_journal():
+    with mktempdir() as tmpdir:
+        fn = os.path.join(tmpdir, "journal.jsonl")
+        j = journal.Journal(fn)
+        j.record("disc1", "decoded", 1)
+        j.record("disc1", "tagged", 1, tagged_fn=u"a.mp3")
+        j.record("disc1", "source_moved", dirname=u"CD1")
+        j.record("disc2", "encoded", 3)
+        j.complete("disc2")
+        j.close()
+
+        # a crash while writing leaves a partial line
+        with open(fn, "a") as f:
+            f.write('{"disc": "disc3", "sta')
+
+        j = journal.Journal(fn)
+        assert j.incomplete_discs() == {"disc1"}
+        assert j.get("disc1", "decoded", 1) == {}
+        assert j.get("disc1", "tagged", 1) == {"tagged_fn": u"a.mp3"}
+        assert j.get("disc1", "source_moved") == {"dirname": u"CD1"}
+        assert j.get("disc1", "encoded", 1) is None
+        assert j.get("disc2", "encoded", 3) is None
+        j.close()
+
+        # compacted on load
+        with open(fn) as f:
+            assert len(f.readlines()) == 3
+
+
+def test_verification_resumed():
+    with mktempdir() as tmpdir:
+        fn = os.path.join(tmpdir, "journal.jsonl")
+        j = journal.Journal(fn)
+        # decoded to WAV, and encoded by a run from before encoded stages carried the outcome
+        j.record("disc1", "decoded", 1, verification="verified")
+        j.record("disc1", "encoded", 1)
+        j.record("disc1", "encoded", "mobile/1", verification="verified")
+        # streamed, for one profile
+        j.record("disc1", "encoded", 2, verification="no_md5")
+        # not checked
+        j.record("disc1", "decoded", 3, verification=None)
+        j.record("disc1", "encoded", 3, verification=None)
+        j.close()
+
+        # as an interrupted run's tracks are looked up when resuming
+        j = journal.Journal(fn)
+        assert j.verification("disc1", 1, 1) == "verified"
+        assert j.verification("disc1", 1, "mobile/1") == "verified"
+        assert j.verification("disc1", 2, 2) == "no_md5"
+        assert j.verification("disc1", 2, "mobile/2") is None
+        assert j.verification("disc1", 3, 3) is None
+        assert j.verification("disc2", 1, 1) is None
+        j.close()
+
+
+def test_remove_orphaned_work_dirs():
+    with mktempdir() as tmpdir:
+        j = journal.Journal(None)
+        j.record("resumable", "decoded", 1)
+
+        work_root = j.work_root(tmpdir)
+        # fine before anything was ever staged
+        j.remove_orphaned_work_dirs(work_root)
+
+        for name in ("resumable", "orphaned"):
+            os.makedirs(os.path.join(work_root, name, "wav"))
+        # another journal's work in progress is left alone
+        other_work_root = journal.Journal(None).work_root(tmpdir)
+        assert other_work_root != work_root
+        os.makedirs(os.path.join(other_work_root, "in_progress"))
+
+        j.remove_orphaned_work_dirs(work_root)
+        assert os.listdir(work_root) == ["resumable"]
+        assert os.listdir(other_work_root) == ["in_progress"]
+
+
+def test_abandoned_discs():
+    with mktempdir() as tmpdir:
+        fns = [os.path.join(tmpdir, "{}.flac".format(i)) for i in xrange(2)]
+        for fn in fns:
+            open(fn, "w").close()
+        key = journal.disc_key(fns)
+        sources = [fn.decode("utf8") for fn in fns]
+
+        j = journal.Journal(None)
+        j.record(key, "started", sources=sources, time=time.time())
+        # from before discs recorded their start
+        j.record("old", "decoded", 1)
+        # interrupted after its source was moved
+        j.record("moved", "started", sources=[u"/nonexistent/1.flac"], time=time.time())
+        j.record("moved", "source_moved", dirname=u"/nonexistent")
+        # interrupted long ago
+        j.record("stale", "started", sources=sources, time=time.time() - journal.MAX_INCOMPLETE_AGE - 1)
+        assert j.abandoned_discs() == {"moved", "stale"}
+
+        # sources that changed since
+        with open(fns[0], "w") as f:
+            f.write("changed")
+        assert j.abandoned_discs() == {key, "moved", "stale"}
+
+        work_root = j.work_root(tmpdir)
+        for name in (key, "old", "moved", "stale"):
+            os.makedirs(os.path.join(work_root, name))
+        j.remove_orphaned_work_dirs(work_root)
+        assert os.listdir(work_root) == ["old"]
+        assert j.incomplete_discs() == {"old"}
+
+
+def test_journal_lock():
+    with mktempdir() as tmpdir:
+        fn = os.path.join(tmpdir, "journal.jsonl")
+        j = journal.Journal(fn)
+        j.record("disc1", "decoded", 1)
+        # another process couldn't append to it, or compact it from under this one
+        with pytest.raises(journal.JournalLockedException):
+            journal.Journal(fn)
+
+        try:
+            # so processes sharing a cache directory get journals, and work directories, of their own
+            other = journal.configure(tmpdir)
+            assert other.fn == os.path.join(tmpdir, "journal.1.jsonl")
+            assert other.incomplete_discs() == set()
+            assert other.work_root(tmpdir) != j.work_root(tmpdir)
+        finally:
+            journal.configure(tmpdir, enabled=False)
+
+        j.close()
+        j = journal.Journal(fn)
+        assert j.incomplete_discs() == {"disc1"}
+        j.close()
+
+
+def test_disc_key():
+    with mktempdir() as tmpdir:
+        fns = [os.path.join(tmpdir, "{}.flac".format(i)) for i in xrange(2)]
+        for fn in fns:
+            open(fn, "w").close()
+
+        key = journal.disc_key(fns)
+        assert journal.disc_key(fns) == key
+        assert journal.disc_key(fns[:1]) != key
+
+        # changed sources mean starting over
+        os.utime(fns[1], (time.time() + 10, time.time() + 10))
+        assert journal.disc_key(fns) != key
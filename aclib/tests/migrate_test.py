@@ -0,0 +1,255 @@
+# -*- coding: utf8 -*-
+
+import json
+import os
+import shutil
+import struct
+
+import eyed3
+import eyed3.id3
+
+from .util import (
+    MP3_FN,
+)
+
+from .. import (
+    migrate,
+)
+from ..audioformat import (
+    id3,
+)
+from ..util import (
+    mktempdir,
+)
+
+
+def _add_raw_frame(fn, frame_id, body):
+    """Prepends a frame to the ID3v2 tag of fn behind eyed3's back, as other taggers would have written it"""
+    with open(fn, "rb") as f:
+        data = f.read()
+    major = ord(data[3])
+    tag_size = sum(ord(c) << (7 * i) for i, c in enumerate(reversed(data[6:10])))
+    # bodies under 128 bytes have the same size field whether or not it's syncsafe
+    assert len(body) < 128
+    frame = frame_id + struct.pack(">I", len(body)) + "\0\0" + body
+    new_size = tag_size + len(frame)
+    syncsafe = "".join(chr((new_size >> (7 * i)) & 0x7f) for i in reversed(xrange(4)))
+    with open(fn, "wb") as f:
+        f.write(data[:6] + syncsafe + frame + data[10:])
+    assert id3.read_frames(fn).version[0] == major
+
+
+def _strip_id3v2(fn, id3v1=None):
+    """Removes the ID3 tags of fn, appending the raw ID3v1 tag id3v1 if given"""
+    with open(fn, "rb") as f:
+        data = f.read()
+    tag_size = sum(ord(c) << (7 * i) for i, c in enumerate(reversed(data[6:10])))
+    audio = data[10 + tag_size:]
+    if audio[-128:-125] == "TAG":
+        audio = audio[:-128]
+    with open(fn, "wb") as f:
+        f.write(audio + (id3v1 or ""))
+
+
+def _id3v1(title, artist, album, year, track_no):
+    return "TAG" + title.ljust(30, "\0") + artist.ljust(30, "\0") + album.ljust(30, "\0") + year + "\0" * 28 + "\0" + chr(track_no) + "\xff"
+
+
+def _mklibrary(root):
+    """A v2.3 album without album artists, with RGAD frames and the year as the original release date, and a
+    Various Artists compilation"""
+    paths = []
+    for album, num_tracks in (("Artist/2001 - Album", 3), ("Various Artists/2002 - Hits", 2)):
+        album_dir = os.path.join(root, album)
+        os.makedirs(album_dir)
+        for track_no in xrange(1, num_tracks + 1):
+            fn = os.path.join(album_dir, "{:02d}.mp3".format(track_no))
+            shutil.copy(MP3_FN, fn)
+            f = eyed3.load(unicode(fn))
+            f.tag.album_artist = None
+            f.tag.recording_date = None
+            f.tag.original_release_date = 2001
+            f.tag.save(version=eyed3.id3.ID3_V2_3)
+            _add_raw_frame(fn, "RGAD", "\0" * 8)
+            os.utime(fn, (1000000000, 1000000000))
+            paths.append(fn)
+    return paths
+
+
+def _gen_migrate_library(jobs):
+    def f():
+        with mktempdir() as tmpdir:
+            paths = _mklibrary(tmpdir)
+            rules = migrate.make_rules(migrate.RULES.keys())
+            contents = {}
+            for path in paths:
+                with open(path, "rb") as fp:
+                    contents[path] = fp.read()
+
+            results = sorted(migrate.migrate_library([tmpdir], rules, jobs=jobs, dry_run=True))
+            assert [r.path for r in results] == sorted(paths)
+            assert all(r.error is None for r in results)
+            for path in paths:
+                with open(path, "rb") as fp:
+                    assert fp.read() == contents[path]
+
+            results = sorted(migrate.migrate_library([tmpdir], rules, jobs=jobs))
+            for result in results:
+                changed_fields = set((rule, field) for rule, field, _, _ in result.changes)
+                assert ("strip_rgad", "RGAD") in changed_fields
+                assert ("upgrade_v24", "version") in changed_fields
+                assert ("recording_date", "recording_date") in changed_fields
+                assert (("album_artist", "album_artist") in changed_fields) == ("Various Artists" not in result.path)
+
+                assert os.stat(result.path).st_mtime == 1000000000
+                id3_frames = id3.read_frames(result.path)
+                assert id3_frames.version[0] == 4
+                assert "RGAD" not in id3_frames.frames
+                assert "TDOR" not in id3_frames.frames
+
+                tag = eyed3.load(unicode(result.path)).tag
+                assert str(tag.recording_date) == str(tag.release_date) == "2001"
+                if "Various Artists" not in result.path:
+                    assert tag.album_artist == tag.artist
+
+            # all done: nothing left to load, let alone change
+            results = list(migrate.migrate_library([tmpdir], rules, jobs=jobs))
+            assert len(results) == len(paths)
+            assert all(r.changes == [] and r.error is None for r in results)
+    return f
+
+test_migrate_library_serial = _gen_migrate_library(1)
+test_migrate_library_parallel = _gen_migrate_library(3)
+
+
+def test_migrate_id3v1():
+    with mktempdir() as tmpdir:
+        v1_fn = os.path.join(tmpdir, "01.mp3")
+        untagged_fn = os.path.join(tmpdir, "02.mp3")
+        for fn in (v1_fn, untagged_fn):
+            shutil.copy(MP3_FN, fn)
+        _strip_id3v2(v1_fn, _id3v1("Title", "Artist", "Album", "2001", 1))
+        _strip_id3v2(untagged_fn)
+        with open(untagged_fn, "rb") as f:
+            untagged = f.read()
+        with open(v1_fn, "rb") as f:
+            v1 = f.read()
+
+        # an ID3v1 tag has neither a track count nor a disc number
+        result, = migrate.migrate_library([v1_fn], migrate.make_rules(["require_fields", "upgrade_v24"]))
+        assert result.changes == []
+        assert result.error == "MissingFieldsException: Missing cd_tracks, cd_no."
+        with open(v1_fn, "rb") as f:
+            assert f.read() == v1
+
+        rules = migrate.make_rules([name for name in migrate.RULES if name != "require_fields"])
+        for _ in xrange(2):
+            # nothing to migrate, and nothing wrong, without a tag
+            result, = migrate.migrate_library([untagged_fn], rules)
+            assert (result.changes, result.error) == ([], None)
+        with open(untagged_fn, "rb") as f:
+            assert f.read() == untagged
+
+        result, = migrate.migrate_library([v1_fn], rules)
+        assert result.error is None
+        assert ("upgrade_v24", "version", u"1.1.0", u"2.4.0") in result.changes
+        assert ("album_artist", "album_artist", None, u"Artist") in result.changes
+        assert id3.read_frames(v1_fn).version[0] == 4
+        tag = eyed3.load(unicode(v1_fn)).tag
+        assert (tag.title, tag.album_artist, str(tag.recording_date)) == (u"Title", u"Artist", "2001")
+
+        # and once is enough
+        result, = migrate.migrate_library([v1_fn], rules)
+        assert (result.changes, result.error) == ([], None)
+
+
+def test_album_artist_needed():
+    with mktempdir() as tmpdir:
+        fn = os.path.join(tmpdir, "01.mp3")
+        rule = migrate.AddAlbumArtist()
+        for tpe2, needed in (
+                ("\x01\xff\xfe\0\0", True),
+                ("\x00", True),
+                ("\x03 \0", True),
+                ("\x01\xff\xfeA\0", False),
+                ("\x03Artist", False)):
+            id3_frames = id3.Id3Frames(version=(4, 0), frames={"TPE2": [tpe2]})
+            assert rule.needed(id3_frames, fn) == needed, repr(tpe2)
+        assert not rule.needed(id3.Id3Frames(version=(4, 0), frames={}), "Various Artists/01.mp3")
+
+
+def test_recording_date_needed():
+    rule = migrate.RecordingDate()
+    for frames, needed in (
+            ({}, False),
+            ({"TDRC": ["\x032016"]}, False),
+            ({"TDRC": ["\x032016-05-01"], "TDRL": ["\x032016"], "TDOR": ["\x032016"]}, False),
+            ({"TDRC": ["\x032016"], "TDOR": ["\x032001"]}, True),
+            ({"TDRL": ["\x032016"]}, True),
+            ({"TDRC": ["\x01\xff"]}, True)):
+        assert rule.needed(id3.Id3Frames(version=(4, 0), frames=frames), "01.mp3") == needed, frames
+    assert not rule.needed(id3.Id3Frames(version=(3, 0), frames={"TYER": ["\x002016"]}), "01.mp3")
+    assert rule.needed(id3.Id3Frames(version=(3, 0), frames={"TYER": ["\x002016"], "TORY": ["\x002001"]}), "01.mp3")
+
+
+def test_require_fields():
+    with mktempdir() as tmpdir:
+        fn = os.path.join(tmpdir, "01.mp3")
+        shutil.copy(MP3_FN, fn)
+        rules = migrate.make_rules(["require_fields"])
+        assert not rules[0].needed(id3.read_frames(fn), fn)
+        result, = migrate.migrate_library([fn], rules)
+        assert (result.changes, result.error) == ([], None)
+
+        f = eyed3.load(unicode(fn))
+        f.tag.album = None
+        f.tag.track_num = (4, None)
+        f.tag.save()
+        assert rules[0].needed(id3.read_frames(fn), fn)
+        with open(fn, "rb") as fp:
+            contents = fp.read()
+        result, = migrate.migrate_library([fn], migrate.make_rules(["require_fields", "recording_date"]))
+        assert result.error == "MissingFieldsException: Missing album, cd_tracks."
+        with open(fn, "rb") as fp:
+            assert fp.read() == contents
+
+
+def test_skip_containing():
+    with mktempdir() as tmpdir:
+        paths = _mklibrary(tmpdir)
+        assert sorted(migrate.find_mp3s([tmpdir], skip_containing=["Various"])) == sorted(
+            path for path in paths if "Various" not in path)
+        assert list(migrate.find_mp3s(paths[-1:], skip_containing=["Various"])) == []
+
+
+def test_migrate_file_error():
+    with mktempdir() as tmpdir:
+        fn = os.path.join(tmpdir, "01.mp3")
+        shutil.copy(MP3_FN, fn)
+        _add_raw_frame(fn, "RGAD", "\0" * 8)
+        # a release date that disagrees, so there's something to write
+        _add_raw_frame(fn, "TDOR", "\x032001")
+
+        # eyed3 can't write RGAD back
+        result, = migrate.migrate_library([fn], migrate.make_rules(["album_artist", "recording_date"]))
+        assert result.changes == []
+        assert result.error is not None
+
+
+def test_change_log():
+    with mktempdir() as tmpdir:
+        log_fn = os.path.join(tmpdir, "changes.jsonl")
+        change_log = migrate.ChangeLog(log_fn)
+        change_log.record(migrate.MigrationResult(
+            path=u"Artist/01 é.mp3".encode("utf8"),
+            changes=[("album_artist", "album_artist", None, u"Artist")],
+            error=None,
+        ))
+        change_log.close()
+
+        with open(log_fn) as f:
+            lines = f.readlines()
+        assert len(lines) == 1
+        entry = json.loads(lines[0])
+        assert entry["path"] == u"Artist/01 é.mp3"
+        assert entry["changes"] == [["album_artist", "album_artist", None, u"Artist"]]
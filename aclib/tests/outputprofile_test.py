@@ -0,0 +1,41 @@
+import argparse
+import os
+
+import pytest
+
+from .. import (
+    outputprofile,
+)
+from ..audioformat import (
+    mp3,
+)
+
+
+def test_parse_profile():
+    profile = outputprofile.parse_profile("mobile:phone")
+    assert profile == outputprofile.Profile(
+        name="mobile",
+        lame_opts=outputprofile.PRESETS["mobile"],
+        output_dir=os.path.abspath("phone"),
+    )
+
+    # colons past the second belong to the options
+    profile = outputprofile.parse_profile("tiny:/music/tiny:-V 9 --resample 22.05")
+    assert (profile.name, profile.lame_opts) == ("tiny", ["-V", "9", "--resample", "22.05"])
+
+    for spec in ("mobile", ":phone", "mobile:", "tiny:/music/tiny", "default:/music", "a/b:/music::-V 9"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            outputprofile.parse_profile(spec)
+
+
+def test_for_output_dir():
+    mobile = outputprofile.parse_profile("mobile:/music/mobile")
+    profiles = outputprofile.for_output_dir("/music/archive", [mobile])
+    assert [p.name for p in profiles] == [outputprofile.DEFAULT_NAME, "mobile"]
+    assert profiles[0].lame_opts == mp3.LAME_OPTS
+    assert profiles[0].output_dir == "/music/archive"
+
+    with pytest.raises(AssertionError):
+        outputprofile.for_output_dir("/music/mobile", [mobile])
+    with pytest.raises(AssertionError):
+        outputprofile.for_output_dir("/music/archive", [mobile, mobile._replace(output_dir="/music/other")])
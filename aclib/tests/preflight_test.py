@@ -0,0 +1,290 @@
+import collections
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from .. import (
+    catalog,
+    outputprofile,
+    preflight,
+    util,
+)
+from ..audioformat import (
+    mp3,
+)
+from ..audioformat.util import (
+    Tags,
+)
+from ..util import (
+    mktempdir,
+)
+
+from .util import (
+    FLAC_FN,
+    MP3_FN,
+)
+
+
+class _Track(object):
+    """What preflight needs of a PendingAudioFile, named the same way"""
+    def __init__(self, fn, output_dir, title, track_no, cd_tracks, album=u"Album", is_singles=False):
+        self.current_filename = fn
+        self.output_dir = output_dir
+        self.is_singles = is_singles
+        self.proposed_tags = Tags(album_artist=u"Artist", artist=u"Artist", album=album, year=2001, title=title,
+                                  cd_no=1, track_no=track_no, cd_tracks=cd_tracks)
+
+    @property
+    def new_filename(self):
+        tags = self.proposed_tags
+        track_num = util.get_track_filename_representation(tags.cd_no, tags.track_no, 1, tags.cd_tracks)
+        return os.path.join(
+            self.output_dir,
+            "Artist",
+            u"2001 - {}".format(tags.album).encode("utf8"),
+            u"{} {}.mp3".format(track_num, tags.title).encode("utf8"),
+        )
+
+    def new_filename_for(self, profile):
+        return os.path.join(profile.output_dir, os.path.relpath(self.new_filename, self.output_dir))
+
+    def missing_tags(self):
+        return [] if self.proposed_tags.title else ["title"]
+
+    def needs_conversion(self):
+        return not self.current_filename.endswith(".mp3")
+
+
+class _Disc(object):
+    """What preflight needs of a PendingDisc"""
+    def __init__(self, dirname, tracks, output_dir, resumed=()):
+        self.dirname = dirname
+        self.pending_audio_files = tracks
+        self.output_dir = output_dir
+        self.resumed = set(resumed)
+        self.processed_subdir = ""
+
+    def resumed_filenames(self, profiles):
+        return self.resumed
+
+
+def _mkdisc(root, name, output_dir, src_fn=FLAC_FN, num_tracks=2, **track_args):
+    dirname = os.path.join(root, "inbox", name)
+    os.makedirs(dirname)
+    tracks = []
+    for track_no in xrange(1, num_tracks + 1):
+        fn = os.path.join(dirname, "{:02d}{}".format(track_no, os.path.splitext(src_fn)[1]))
+        shutil.copy(src_fn, fn)
+        tracks.append(_Track(fn, output_dir, title=u"Title {}".format(track_no), track_no=track_no,
+                             cd_tracks=num_tracks, **track_args))
+    return _Disc(dirname, tracks, output_dir)
+
+
+def _touch(fn):
+    util.makedirs(os.path.dirname(fn))
+    open(fn, "w").close()
+
+
+def test_no_problems():
+    with mktempdir() as tmpdir:
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(out)
+        out2 = os.path.join(tmpdir, "out2")
+        os.makedirs(out2)
+        # the same album for another output directory, and another album
+        discs = [_mkdisc(tmpdir, "CD1", out), _mkdisc(tmpdir, "CD1-copy", out2), _mkdisc(tmpdir, "Other", out, album=u"Other")]
+
+        assert preflight.find_problems(discs, "processed") == []
+        preflight.check(discs, "processed")
+
+
+def test_track_problems():
+    with mktempdir() as tmpdir:
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(out)
+        disc = _mkdisc(tmpdir, "CD1", out, num_tracks=4)
+        tracks = disc.pending_audio_files
+        tracks[0].proposed_tags.title = None
+        # more than the disc has
+        tracks[2].proposed_tags.track_no = 5
+        # the same target as the second track
+        tracks[3].proposed_tags.title = u"Title 2"
+        tracks[3].proposed_tags.track_no = 2
+
+        problems = preflight.find_problems([disc], "processed")
+        assert len(problems) == 3
+        assert problems[0] == "{} is missing title.".format(tracks[0].current_filename)
+        assert problems[1].startswith(tracks[2].current_filename + ": Track number (5)")
+        assert problems[2] == "{} is the target of more than one track.".format(tracks[1].new_filename)
+
+
+def test_target_collisions():
+    with mktempdir() as tmpdir:
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(out)
+        output_catalog = catalog.Catalog(os.path.join(tmpdir, "catalog.sqlite"))
+        disc = _mkdisc(tmpdir, "CD1", out, num_tracks=3)
+        tracks = disc.pending_audio_files
+        # converted before, and still there
+        _touch(tracks[0].new_filename)
+        output_catalog.add(tracks[0].new_filename, out, Tags(album=u"Old"))
+        # converted before, but deleted since
+        output_catalog.add(tracks[1].new_filename, out, Tags(album=u"Old"))
+        # put in place by an interrupted run of this disc
+        _touch(tracks[2].new_filename)
+        disc.resumed = {tracks[2].new_filename}
+
+        problems = preflight.find_problems([disc], "processed", output_catalog)
+        assert len(problems) == 1
+        assert problems[0].startswith("{} would overwrite {}, converted ".format(
+            tracks[0].current_filename, tracks[0].new_filename))
+        assert output_catalog.get(tracks[1].new_filename) is None
+
+        # by another disc of the run
+        other = _mkdisc(tmpdir, "CD1-copy", out, num_tracks=1)
+        os.remove(tracks[0].new_filename)
+        problems = preflight.find_problems([disc, other], "processed")
+        assert problems == ["{} is the target of more than one track.".format(tracks[0].new_filename)]
+        output_catalog.close()
+
+
+def test_profile_problems():
+    with mktempdir() as tmpdir:
+        out, mobile_out = os.path.join(tmpdir, "out"), os.path.join(tmpdir, "mobile")
+        os.makedirs(out)
+        os.makedirs(mobile_out)
+        mobile = outputprofile.Profile(name="mobile", lame_opts=["-V", "6"], output_dir=mobile_out)
+        disc = _mkdisc(tmpdir, "CD1", out)
+        # the second track goes to an album directory of its own
+        disc.pending_audio_files[1].proposed_tags.album = u"Other"
+        mobile_target = disc.pending_audio_files[1].new_filename_for(mobile)
+        _touch(mobile_target)
+
+        problems = preflight.find_problems([disc], "processed", extra_profiles=[mobile])
+        assert problems == [
+            "{} would overwrite {}.".format(disc.pending_audio_files[1].current_filename, mobile_target),
+            "{} has tracks for more than one output directory.".format(disc.dirname),
+        ]
+
+
+def test_duplicate_discs():
+    with mktempdir() as tmpdir:
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(out)
+        output_catalog = catalog.Catalog(os.path.join(tmpdir, "catalog.sqlite"))
+        disc = _mkdisc(tmpdir, "CD1", out)
+        tags = disc.pending_audio_files[0].proposed_tags
+        # the album under another file name, e.g. converted with other titles
+        existing_fn = os.path.join(out, "Artist", "2001 - Album", "01 Old Title.mp3")
+        _touch(existing_fn)
+        output_catalog.add(existing_fn, out, tags.copy(album=u"ALBUM"))
+        # and what's left of an even older conversion
+        deleted_fn = os.path.join(out, "Artist", "2001 - Album", "01 Older Title.mp3")
+        output_catalog.add(deleted_fn, out, tags)
+
+        expected = "{} is disc 1 of Artist - Album (2001), already converted to {}.".format(
+            disc.dirname, os.path.dirname(existing_fn))
+        assert preflight.find_problems([disc], "processed", output_catalog) == [expected]
+        assert output_catalog.get(deleted_fn) is None
+
+        # other output directories, singles and a disc's own files don't count
+        profile, = outputprofile.for_output_dir(os.path.join(tmpdir, "elsewhere"))
+        assert preflight.duplicate_discs(output_catalog, disc, profile, set()) == []
+        profile, = outputprofile.for_output_dir(out)
+        assert preflight.duplicate_discs(output_catalog, disc, profile, {existing_fn}) == []
+        for track in disc.pending_audio_files:
+            track.is_singles = True
+        assert preflight.find_problems([disc], "processed", output_catalog) == []
+        output_catalog.close()
+
+
+def test_processed_taken():
+    with mktempdir() as tmpdir:
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(os.path.join(out, "processed", "CD1"))
+        discs = [_mkdisc(tmpdir, "CD1", out)]
+        # source directories of the same name, of different albums
+        discs.append(_mkdisc(os.path.join(tmpdir, "b"), "CD2", out, album=u"B"))
+        discs.append(_mkdisc(os.path.join(tmpdir, "c"), "CD2", out, album=u"C"))
+
+        problems = preflight.find_problems(discs, "processed")
+        assert problems == [
+            "{} can't be moved to {}, which is taken.".format(discs[0].dirname, os.path.join(out, "processed", "CD1")),
+            "{} can't be moved to {}, which is taken.".format(discs[2].dirname, os.path.join(out, "processed", "CD2")),
+        ]
+
+        # unless each album's go to a directory of their own
+        discs[1].processed_subdir, discs[2].processed_subdir = "B", "C"
+        assert preflight.find_problems(discs[1:], "processed") == []
+
+
+def test_space_problems(monkeypatch):
+    with mktempdir() as tmpdir:
+        out, mobile_out = os.path.join(tmpdir, "out"), os.path.join(tmpdir, "mobile")
+        os.makedirs(out)
+        os.makedirs(mobile_out)
+        mobile = outputprofile.Profile(name="mobile", lame_opts=["-V", "6"], output_dir=mobile_out)
+        disc = _mkdisc(tmpdir, "CD1", out)
+
+        StatVfs = collections.namedtuple("StatVfs", ("f_bavail", "f_frsize"))
+        monkeypatch.setattr(os, "statvfs", lambda path: StatVfs(f_bavail=1, f_frsize=4096))
+        monkeypatch.setattr(os, "access", lambda path, mode: path != mobile_out)
+        problems = preflight.find_problems([disc], "processed", extra_profiles=[mobile])
+        assert problems[0] == "{} isn't writable.".format(mobile_out)
+        # the directories are on one filesystem, with the temp dir, which is checked for them all together
+        assert problems[1:] == [
+            "About 0 MB are needed on the filesystem of {}, but only 0 MB are free.".format(
+                ", ".join(sorted([out, mobile_out, tempfile.gettempdir()]))),
+        ]
+
+        monkeypatch.setattr(os, "statvfs", lambda path: StatVfs(f_bavail=1 << 20, f_frsize=4096))
+        assert preflight.space_problems({out: 1 << 30, mobile_out: 1 << 30}) == []
+        assert len(preflight.space_problems({out: 3 << 30, mobile_out: 2 << 30})) == 1
+
+
+def test_estimate_space():
+    with mktempdir() as tmpdir:
+        out, mobile_out = os.path.join(tmpdir, "out"), os.path.join(tmpdir, "mobile")
+        profiles = outputprofile.for_output_dir(out, [
+            outputprofile.Profile(name="mobile", lame_opts=["-V", "6"], output_dir=mobile_out),
+        ])
+        size = os.path.getsize(FLAC_FN)
+        pcm_bytes = size * 2.0
+        mp3_bytes = int(pcm_bytes * mp3.MAX_ENCODED_RATIO)
+
+        disc = _mkdisc(tmpdir, "CD1", out)
+        # decoded to WAV and encoded for both profiles in the temp dir; a tagged copy in each output directory
+        assert preflight.estimate_space(disc, profiles) == {
+            tempfile.gettempdir(): 2 * (int(pcm_bytes) + 2 * mp3_bytes),
+            out: 2 * mp3_bytes,
+            mobile_out: 2 * mp3_bytes,
+        }
+        # no WAVs when streaming
+        assert preflight.estimate_space(disc, profiles, stream=True) == {
+            tempfile.gettempdir(): 2 * 2 * mp3_bytes,
+            out: 2 * mp3_bytes,
+            mobile_out: 2 * mp3_bytes,
+        }
+
+        # MP3s are copied as they are
+        disc = _mkdisc(tmpdir, "MP3s", out, src_fn=MP3_FN)
+        expected = 2 * (os.path.getsize(MP3_FN) + mp3.TAG_PADDING)
+        assert preflight.estimate_space(disc, profiles) == {tempfile.gettempdir(): 0, out: expected, mobile_out: expected}
+
+
+def test_check_reports_everything():
+    with mktempdir() as tmpdir:
+        out = os.path.join(tmpdir, "out")
+        os.makedirs(os.path.join(out, "processed", "CD2"))
+        discs = [_mkdisc(tmpdir, "CD1", out), _mkdisc(tmpdir, "CD2", out, album=u"Other")]
+        discs[0].pending_audio_files[0].proposed_tags.title = None
+
+        with pytest.raises(preflight.PreflightException) as exc_info:
+            preflight.check(discs, "processed")
+        message = str(exc_info.value)
+        # every problem of every disc, not just the first
+        assert message.startswith("2 problem(s) found before converting anything:\n")
+        assert "{} is missing title.".format(discs[0].pending_audio_files[0].current_filename) in message
+        assert "{} can't be moved to".format(discs[1].dirname) in message
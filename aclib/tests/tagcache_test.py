@@ -0,0 +1,142 @@
+import os
+import shutil
+import sqlite3
+
+from .. import (
+    collector,
+    tagcache,
+)
+from ..audioformat import (
+    mp3,
+)
+from ..util import (
+    mktempdir,
+)
+
+from .util import (
+    MP3_FN,
+
+    mkaudiodir,
+)
+
+
+def _counting_reader():
+    calls = []
+    def read_fn(path):
+        calls.append(path)
+        return mp3.read_tags(path)
+    return read_fn, calls
+
+
+def test_tag_cache():
+    with mktempdir() as tmpdir:
+        fn = os.path.join(tmpdir, "a.mp3")
+        shutil.copy(MP3_FN, fn)
+
+        cache = tagcache.TagCache(os.path.join(tmpdir, "tags.sqlite"))
+        read_fn, calls = _counting_reader()
+
+        tags = cache.read_tags(fn, read_fn)
+        assert cache.read_tags(fn, read_fn) == tags
+        assert len(calls) == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # persists across instances
+        cache.close()
+        cache = tagcache.TagCache(os.path.join(tmpdir, "tags.sqlite"))
+        assert cache.get(fn) == tags
+
+        # invalidated when the file changes
+        with open(fn, "ab") as f:
+            f.write("\0")
+        assert cache.get(fn) is None
+        cache.read_tags(fn, read_fn)
+        assert len(calls) == 2
+
+        # or explicitly, when the change can't be seen
+        cache.invalidate(fn)
+        assert cache.get(fn) is None
+        cache.close()
+
+
+def test_tag_cache_modified_while_read():
+    with mktempdir() as tmpdir:
+        fn = os.path.join(tmpdir, "a.mp3")
+        shutil.copy(MP3_FN, fn)
+        cache = tagcache.TagCache(os.path.join(tmpdir, "tags.sqlite"))
+
+        def read_fn(path):
+            tags = mp3.read_tags(path)
+            with open(path, "ab") as f:
+                f.write("\0")
+            return tags
+        cache.read_tags(fn, read_fn)
+        # cached for the file as it was when reading started
+        assert cache.get(fn) is None
+        cache.close()
+
+
+def test_tag_cache_version():
+    with mktempdir() as tmpdir:
+        fn = os.path.join(tmpdir, "a.mp3")
+        shutil.copy(MP3_FN, fn)
+        db_fn = os.path.join(tmpdir, "tags.sqlite")
+        cache = tagcache.TagCache(db_fn)
+        cache.put(fn, mp3.read_tags(fn))
+        cache.close()
+
+        # kept by the same version
+        cache = tagcache.TagCache(db_fn)
+        assert cache.get(fn) is not None
+        cache.close()
+
+        # discarded when read by an older one
+        conn = sqlite3.connect(db_fn)
+        conn.execute("PRAGMA user_version = {:d}".format(tagcache.VERSION - 1))
+        conn.close()
+        cache = tagcache.TagCache(db_fn)
+        assert cache.get(fn) is None
+        cache.put(fn, mp3.read_tags(fn))
+        assert cache.get(fn) is not None
+        cache.close()
+
+
+def test_tag_cache_eviction():
+    with mktempdir() as tmpdir:
+        cache = tagcache.TagCache(os.path.join(tmpdir, "tags.sqlite"), max_entries=10)
+        fns = []
+        for i in xrange(20):
+            fn = os.path.join(tmpdir, "{:03d}.mp3".format(i))
+            shutil.copy(MP3_FN, fn)
+            fns.append(fn)
+            cache.put(fn, mp3.read_tags(fn))
+            # keep the first file in use
+            assert cache.get(fns[0]) is not None
+
+        num_cached = sum(1 for fn in fns if cache.get(fn) is not None)
+        assert num_cached <= 10
+        assert cache.get(fns[0]) is not None
+        assert cache.get(fns[1]) is None
+        assert cache.get(fns[-1]) is not None
+        cache.close()
+
+
+def test_collector_uses_cache():
+    with mktempdir() as cache_dir:
+        try:
+            cache = tagcache.configure(cache_dir)
+            with mkaudiodir(num_mp3=3) as audio_dir:
+                audio_files = collector.collect_audio_files(audio_dir)
+
+                tags = collector.read_tags_many(audio_files)
+                assert (cache.hits, cache.misses) == (0, 3)
+
+                assert collector.read_tags_many(audio_files) == tags
+                assert [af.read_tags() for af in audio_files] == tags
+                assert (cache.hits, cache.misses) == (6, 3)
+
+            # bypass
+            assert tagcache.configure(enabled=False) is None
+            assert tagcache.get_cache() is None
+        finally:
+            tagcache.configure(enabled=False)
@@ -0,0 +1,72 @@
+import json
+import os
+import subprocess
+
+from .. import (
+    trace,
+)
+from ..util import (
+    mktempdir,
+)
+
+
+def _read_events(fn, fmt):
+    with open(fn) as f:
+        if fmt == "chrome":
+            return json.load(f)
+        return [json.loads(line) for line in f]
+
+
+def _gen_trace(fmt):
+    def f():
+        with mktempdir() as tmpdir:
+            fn = os.path.join(tmpdir, "trace")
+            trace.configure(fn, fmt)
+            try:
+                with trace.span("disc", dirname="CD1") as disc_args:
+                    assert trace.check_output(["echo", "hi"]) == "hi\n"
+                    trace.check_call(["true"])
+                    proc = trace.popen(["sh", "-c", "exit 3"])
+                    assert trace.wait(proc) == 3
+                    assert trace.wait(proc) == 3
+                    disc_args["audio_seconds"] = 60.0
+
+                try:
+                    trace.check_call(["false"])
+                    assert False, "false succeeded"
+                except subprocess.CalledProcessError as exc:
+                    assert exc.returncode == 1
+            finally:
+                trace.configure(None)
+
+            events = _read_events(fn, fmt)
+            assert [e["name"] for e in events] == ["echo", "true", "sh", "disc", "false"]
+            assert [e["args"]["returncode"] for e in events if e["name"] != "disc"] == [0, 0, 3, 1]
+
+            echo = events[0]
+            assert echo["args"]["cmd"] == ["echo", "hi"]
+            assert echo["args"]["max_rss_kb"] > 0
+            assert echo["args"]["user_seconds"] >= 0
+            assert echo["args"]["sys_seconds"] >= 0
+
+            disc = events[3]
+            assert disc["args"]["dirname"] == "CD1"
+            assert disc["args"]["audio_seconds"] == 60.0
+            assert disc["args"]["realtime_factor"] > 0
+            if fmt == "chrome":
+                assert all(e["ph"] == "X" for e in events)
+                assert disc["ts"] <= echo["ts"] and echo["ts"] + echo["dur"] <= disc["ts"] + disc["dur"]
+            else:
+                assert disc["start"] <= echo["start"] and echo["duration"] <= disc["duration"]
+    return f
+
+test_trace_jsonl = _gen_trace("jsonl")
+test_trace_chrome = _gen_trace("chrome")
+
+
+def test_trace_disabled():
+    assert trace.get_tracer() is None
+    with trace.span("disc") as disc_args:
+        disc_args["audio_seconds"] = 1.0
+    proc = trace.popen(["sh", "-c", "exit 2"])
+    assert trace.wait(proc) == 2
@@ -1,3 +1,8 @@
+import errno
+import os
+import threading
+import time
+
 import pytest
 
 from .. import util
@@ -26,3 +31,111 @@ def test_get_trackfilename_representation():
     with pytest.raises(util.InvalidDiscTrackException):
         # track_num > num_tracks
         util.get_track_filename_representation(1, 11, 1, 10)
+
+
+def test_parallel_map():
+    items = range(50)
+    for jobs in (1, 4, 100):
+        assert util.parallel_map(lambda x: x * 2, items, jobs) == [x * 2 for x in items]
+
+    def _fail(x):
+        raise ValueError(x)
+
+    with pytest.raises(ValueError):
+        util.parallel_map(_fail, items, 4)
+
+
+def test_parallel_map_job_slots():
+    slots = util.JobSlots(2)
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def _track(x):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return x
+
+    # two "discs" sharing one budget never run more than two tracks at once
+    results = util.parallel_map(
+        lambda disc: util.parallel_map(_track, range(disc * 10, disc * 10 + 5), slots),
+        range(2),
+        2,
+    )
+    assert results == [range(0, 5), range(10, 15)]
+    assert max_running[0] <= 2
+    assert util.job_count(slots) == 2
+    assert util.job_count(3) == 3
+
+
+def test_makedirs():
+    with util.mktempdir() as tmpdir:
+        path = os.path.join(tmpdir, "a", "b")
+        util.makedirs(path)
+        util.makedirs(path)
+        assert os.path.isdir(path)
+
+        fn = os.path.join(tmpdir, "file")
+        open(fn, "w").close()
+        with pytest.raises(OSError):
+            util.makedirs(fn)
+
+
+def test_remove_staging_dir():
+    with util.mktempdir() as tmpdir:
+        staging = os.path.join(tmpdir, util.STAGING_DIRNAME)
+        os.makedirs(os.path.join(staging, "audio-convert-work", "disc"))
+        util.remove_staging_dir(tmpdir)
+        assert os.listdir(tmpdir) == []
+        # nothing to remove
+        util.remove_staging_dir(tmpdir)
+
+
+def test_clone_file():
+    with util.mktempdir() as tmpdir:
+        src = os.path.join(tmpdir, "src")
+        with open(src, "wb") as f:
+            f.write(os.urandom(3 << 20))
+
+        for copy_fn in (util.clone_file, util.link_or_clone):
+            dst = os.path.join(tmpdir, copy_fn.__name__)
+            copy_fn(src, dst)
+            with open(src, "rb") as f1, open(dst, "rb") as f2:
+                assert f1.read() == f2.read()
+
+        # a clone is independent of its source
+        with open(os.path.join(tmpdir, "clone_file"), "ab") as f:
+            f.write("more")
+        assert os.path.getsize(src) == 3 << 20
+
+
+def test_link_or_clone(monkeypatch):
+    with util.mktempdir() as tmpdir:
+        src = os.path.join(tmpdir, "src")
+        with open(src, "wb") as f:
+            f.write("data")
+        dst = os.path.join(tmpdir, "dst")
+        util.link_or_clone(src, dst)
+        assert os.stat(dst).st_nlink == 2
+
+        # across filesystems: a copy, which outlives the source
+        def link(src, dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        monkeypatch.setattr(os, "link", link)
+        util.link_or_clone(os.path.relpath(src), dst + "2")
+        assert not os.path.islink(dst + "2")
+        os.rename(src, src + ".moved")
+        with open(dst + "2", "rb") as f:
+            assert f.read() == "data"
+
+
+def test_mktempdir_cleanup():
+    with pytest.raises(ValueError):
+        with util.mktempdir() as tmpdir:
+            open(os.path.join(tmpdir, "a"), "w").close()
+            raise ValueError()
+    assert not os.path.exists(tmpdir)
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from .. import (
+    watch,
+)
+from ..util import (
+    mktempdir,
+)
+
+
+def test_quiet_tracker():
+    with mktempdir() as inbox:
+        for d in ("a/CD1", "b", "processed"):
+            os.makedirs(os.path.join(inbox, d))
+        open(os.path.join(inbox, "loose.mp3"), "w").close()
+
+        tracker = watch.QuietTracker([inbox], quiet_period=10, ignore_names=("processed",))
+        albums = tracker.changed([
+            os.path.join(inbox, "a/CD1/01.flac"),
+            os.path.join(inbox, "a"),
+            os.path.join(inbox, "loose.mp3"),
+            os.path.join(inbox, "processed/c/01.mp3"),
+            os.path.join(inbox, ".hidden/01.mp3"),
+            inbox,
+            "/elsewhere/01.mp3",
+        ], now=100)
+        assert albums == {os.path.join(inbox, "a")}
+
+        tracker.changed([os.path.join(inbox, "b/01.flac")], now=105)
+        assert tracker.pop_quiet(now=109) == []
+        assert tracker.pop_quiet(now=110) == [os.path.join(inbox, "a")]
+
+        # changes restart the clock
+        tracker.changed([os.path.join(inbox, "b/02.flac")], now=112)
+        assert tracker.pop_quiet(now=120) == []
+        assert tracker.pop_quiet(now=122) == [os.path.join(inbox, "b")]
+        assert len(tracker) == 0
+
+
+def _gen_watcher(make):
+    def test():
+        with mktempdir() as inbox:
+            os.makedirs(os.path.join(inbox, "a"))
+            try:
+                watcher = make([inbox])
+            except watch.WatcherUnavailableException:
+                pytest.skip("watcher not available here")
+
+            try:
+                assert watcher.wait(0.01) == set()
+
+                os.makedirs(os.path.join(inbox, "b", "CD1"))
+                with open(os.path.join(inbox, "a", "01.flac"), "w") as f:
+                    f.write("data")
+
+                changed = set()
+                for _ in xrange(50):
+                    changed |= watcher.wait(0.1)
+                    if os.path.join(inbox, "b", "CD1") in changed and os.path.join(inbox, "a", "01.flac") in changed:
+                        break
+                assert os.path.join(inbox, "b", "CD1") in changed
+                assert os.path.join(inbox, "a", "01.flac") in changed
+
+                # watches follow new directories
+                open(os.path.join(inbox, "b", "CD1", "01.flac"), "w").close()
+                changed = set()
+                for _ in xrange(50):
+                    changed |= watcher.wait(0.1)
+                    if os.path.join(inbox, "b", "CD1", "01.flac") in changed:
+                        break
+                assert os.path.join(inbox, "b", "CD1", "01.flac") in changed
+            finally:
+                watcher.close()
+    return test
+
+test_inotify_watcher = _gen_watcher(watch.InotifyWatcher)
+test_polling_watcher = _gen_watcher(lambda dirs: watch.PollingWatcher(dirs, interval=0.05))
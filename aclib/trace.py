@@ -0,0 +1,201 @@
+"""Timing of conversion stages and of the codec processes they run.
+
+Spans record the wall time of a stage; subprocesses started through popen() and reaped through wait() (or run by
+check_call()/check_output()) also record the CPU time and peak memory of the child, from wait4(). Events are written
+as JSON lines or as a Chrome trace-event file (for chrome://tracing or Perfetto). Until configure() is called with a
+file name, none of this costs more than a function call."""
+
+import contextlib
+import errno
+import json
+import os
+import subprocess
+import threading
+import time
+
+FORMATS = ("jsonl", "chrome")
+
+class Tracer(object):
+    """Writes events to fn as they finish, in format fmt. Safe to share between threads."""
+    def __init__(self, fn, fmt="jsonl"):
+        assert fmt in FORMATS, "Unknown trace format {}".format(fmt)
+        self.fn = fn
+        self.fmt = fmt
+        self._lock = threading.Lock()
+        self._origin = time.time()
+        self._f = open(fn, "w")
+        if fmt == "chrome":
+            self._f.write("[\n")
+        self._first = True
+
+
+    def emit(self, name, category, start, duration, args):
+        """Records an event that began at start (a time.time()) and took duration seconds"""
+        thread = threading.current_thread()
+        if self.fmt == "chrome":
+            # both ends rounded the same way, so nested events stay nested
+            ts = int((start - self._origin) * 1e6)
+            end = int((start + duration - self._origin) * 1e6)
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": ts,
+                "dur": end - ts,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": args,
+            }
+        else:
+            event = {
+                "name": name,
+                "category": category,
+                "start": start,
+                "duration": duration,
+                "thread": thread.name,
+                "args": args,
+            }
+
+        line = json.dumps(event, sort_keys=True)
+        with self._lock:
+            if self._f is None:
+                return
+            if self.fmt == "chrome" and not self._first:
+                line = ",\n" + line
+            elif self.fmt == "jsonl":
+                line += "\n"
+            self._first = False
+            self._f.write(line)
+            self._f.flush()
+
+
+    def close(self):
+        with self._lock:
+            if self._f is None:
+                return
+            if self.fmt == "chrome":
+                self._f.write("\n]\n")
+            self._f.close()
+            self._f = None
+
+
+    def __repr__(self):
+        return "Tracer({}, {})".format(self.fn, self.fmt)
+
+
+@contextlib.contextmanager
+def span(name, category="stage", **args):
+    """Times the enclosed block as an event called name.
+
+    Yields a dict whose entries are added to the event's args, for results only known inside the block. If it gets an
+    "audio_seconds" entry, the event also gets "realtime_factor": audio seconds converted per wall second."""
+    tracer = _tracer
+    extra = {}
+    if tracer is None:
+        yield extra
+        return
+
+    start = time.time()
+    try:
+        yield extra
+    finally:
+        duration = time.time() - start
+        args.update(extra)
+        if args.get("audio_seconds") and duration > 0:
+            args["realtime_factor"] = args["audio_seconds"] / duration
+        tracer.emit(name, category, start, duration, _jsonable(args))
+
+
+def popen(cmd, **kwargs):
+    """subprocess.Popen(cmd, **kwargs), noting when the process started for wait()"""
+    proc = subprocess.Popen(cmd, **kwargs)
+    proc.trace_cmd = cmd
+    proc.trace_start = time.time()
+    return proc
+
+
+def wait(proc):
+    """proc.wait() for a process started by popen(). Returns its exit status.
+
+    When tracing, the child is reaped with wait4() so that its CPU time and peak memory go into the event."""
+    if _tracer is None or proc.returncode is not None:
+        return proc.wait()
+
+    while True:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as exc:
+            if exc.errno == errno.EINTR:
+                continue
+            if exc.errno == errno.ECHILD:
+                # reaped behind our back; nothing to account
+                return proc.wait()
+            raise
+
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    _tracer.emit(
+        os.path.basename(proc.trace_cmd[0]),
+        "subprocess",
+        proc.trace_start,
+        time.time() - proc.trace_start,
+        _jsonable({
+            "cmd": proc.trace_cmd,
+            "returncode": proc.returncode,
+            "user_seconds": rusage.ru_utime,
+            "sys_seconds": rusage.ru_stime,
+            # kilobytes on Linux
+            "max_rss_kb": rusage.ru_maxrss,
+        }),
+    )
+    return proc.returncode
+
+
+def check_call(cmd, **kwargs):
+    """subprocess.check_call(), traced"""
+    rc = wait(popen(cmd, **kwargs))
+    if rc:
+        raise subprocess.CalledProcessError(rc, cmd)
+    return 0
+
+
+def check_output(cmd, **kwargs):
+    """subprocess.check_output(), traced"""
+    # only stdout is piped, so reading it to the end can't deadlock; communicate() would reap the child itself
+    assert kwargs.get("stderr") is not subprocess.PIPE
+    proc = popen(cmd, stdout=subprocess.PIPE, **kwargs)
+    output = proc.stdout.read()
+    proc.stdout.close()
+    rc = wait(proc)
+    if rc:
+        raise subprocess.CalledProcessError(rc, cmd, output=output)
+    return output
+
+
+def _jsonable(value):
+    # paths are byte strings in the local encoding
+    if isinstance(value, str):
+        return value.decode("utf8", "replace")
+    if isinstance(value, dict):
+        return dict((k, _jsonable(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+# the tracer used by audio-convert; None disables tracing
+_tracer = None
+
+def configure(fn, fmt="jsonl"):
+    """Starts writing the process-wide trace to fn (or with fn=None, stops tracing) and returns the tracer"""
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = None
+    if fn is not None:
+        _tracer = Tracer(fn, fmt)
+    return _tracer
+
+
+def get_tracer():
+    return _tracer
@@ -1,6 +1,12 @@
 import contextlib
+import errno
+import fcntl
+import multiprocessing
+import multiprocessing.pool
+import os
 import shutil
 import tempfile
+import threading
 
 class InvalidDiscTrackException(Exception):
     # thrown when an invalid disc/track combination is fed to get_track_filename_representation
@@ -26,9 +32,135 @@ def get_track_filename_representation(disc_num, track_num, num_discs, num_tracks
         return "None"
 
 @contextlib.contextmanager
-def mktempdir():
-    tmpdir = tempfile.mkdtemp()
-    yield tmpdir
-    shutil.rmtree(tmpdir)
+def mktempdir(dir=None):
+    tmpdir = tempfile.mkdtemp(dir=dir)
+    try:
+        yield tmpdir
+    finally:
+        shutil.rmtree(tmpdir)
 
 
+# hidden directory earlier versions staged temporary files in, in output directories the system temp dir isn't on
+STAGING_DIRNAME = ".audio-convert-tmp"
+
+# ioctl sharing src's extents with dst on filesystems with reflinks (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# errors meaning "can't be done here", rather than actual failures
+_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM, errno.EMLINK)
+
+
+def remove_staging_dir(path):
+    """Removes what earlier versions staged in output directory path. Nothing is staged there any more: intermediate
+    files are never renamed into the output, so they stay in the system temp dir."""
+    staging = os.path.join(path, STAGING_DIRNAME)
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+
+
+def clone_file(src, dst):
+    """Copies src to dst as a reflink if the filesystem supports it, so no data is copied; otherwise a plain copy"""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (IOError, OSError) as exc:
+            if exc.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+
+def link_or_clone(src, dst):
+    """Makes dst a hard link to src if possible, otherwise (e.g. across filesystems) a clone_file() of it. Either way
+    dst outlives src being moved or removed.
+
+    Only for files that are never modified through either name."""
+    try:
+        os.link(src, dst)
+    except OSError as exc:
+        if exc.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+        clone_file(src, dst)
+
+
+def default_jobs():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class JobSlots(object):
+    """A concurrency budget shared by everything that runs under it, e.g. all discs of one run"""
+    def __init__(self, jobs):
+        assert jobs >= 1
+        self.jobs = jobs
+        self._semaphore = threading.BoundedSemaphore(jobs)
+
+    @contextlib.contextmanager
+    def slot(self):
+        self._semaphore.acquire()
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    def __repr__(self):
+        return "JobSlots({})".format(self.jobs)
+
+
+def job_count(jobs):
+    """The number of concurrent jobs allowed by either a plain count or a JobSlots"""
+    if isinstance(jobs, JobSlots):
+        return jobs.jobs
+    return jobs
+
+
+@contextlib.contextmanager
+def job_slot(jobs):
+    """Holds one slot of a shared JobSlots for the duration of the block. A no-op for a plain job count."""
+    if isinstance(jobs, JobSlots):
+        with jobs.slot():
+            yield
+    else:
+        yield
+
+
+def parallel_map(fn, items, jobs):
+    """Calls fn on every item using up to `jobs` worker threads and returns the results in the order of items.
+
+    `jobs` is either a plain count or a JobSlots, in which case every call also holds one of its shared slots.
+
+    Threads are enough here: the work we fan out is waiting on decoder/encoder subprocesses."""
+    items = list(items)
+    if isinstance(jobs, JobSlots):
+        slots = jobs
+        def _fn(item):
+            with slots.slot():
+                return fn(item)
+        return _thread_map(_fn, items, slots.jobs)
+    return _thread_map(fn, items, jobs)
+
+
+def _thread_map(fn, items, jobs):
+    if jobs <= 1 or len(items) <= 1:
+        return map(fn, items)
+
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(items)))
+    try:
+        # map_async().get() with a timeout keeps the main thread responsive to Ctrl+C
+        return pool.map_async(fn, items).get(2 ** 31)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def makedirs(path):
+    """os.makedirs(), but fine with the directory already existing (e.g. created concurrently by another disc)"""
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
@@ -0,0 +1,232 @@
+"""Watching inbox directories for new albums.
+
+A watcher reports the paths of entries that changed anywhere under its directories: InotifyWatcher asks the kernel
+(Linux only, through ctypes), PollingWatcher compares snapshots of the tree and works everywhere. QuietTracker turns
+those reports into albums (top-level directories of an inbox) that have stopped changing."""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+
+# struct inotify_event, without the variable-length name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class WatcherUnavailableException(Exception):
+    # thrown when a watcher can't be used on this system
+    pass
+
+
+class InotifyWatcher(object):
+    """Reports changes under dirs as they happen, using inotify. Watches are added as subdirectories appear."""
+    def __init__(self, dirs):
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError) as exc:
+            raise WatcherUnavailableException("inotify isn't available: {}".format(exc))
+        if self._fd < 0:
+            raise WatcherUnavailableException("inotify_init1 failed: {}".format(os.strerror(ctypes.get_errno())))
+
+        self.dirs = list(dirs)
+        # watch descriptor -> directory
+        self._paths = {}
+        for d in self.dirs:
+            self._add_tree(d)
+
+
+    def wait(self, timeout):
+        """Blocks for up to timeout seconds. Returns the set of paths that changed (empty on timeout)."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        data = os.read(self._fd, 1 << 16)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + name_len].rstrip("\0")
+            pos += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped: everything may have changed
+                for d in self.dirs:
+                    changed.update(os.path.join(d, fn) for fn in _listdir(d))
+                continue
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            if wd not in self._paths:
+                continue
+
+            path = os.path.join(self._paths[wd], name) if name else self._paths[wd]
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # anything already inside was created before the watch existed
+                changed.update(self._add_tree(path))
+        return changed
+
+
+    def close(self):
+        os.close(self._fd)
+
+
+    def _add_tree(self, root):
+        """Watches root and every directory below it. Returns the paths of everything found."""
+        found = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            wd = self._libc.inotify_add_watch(self._fd, dirpath, WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    # gone again already
+                    continue
+                raise OSError(err, os.strerror(err), dirpath)
+            self._paths[wd] = dirpath
+            found.extend(os.path.join(dirpath, fn) for fn in dirnames + filenames)
+        return found
+
+
+class PollingWatcher(object):
+    """Reports changes under dirs by comparing the size and mtime of every entry every interval seconds"""
+    def __init__(self, dirs, interval=5.0):
+        self.dirs = list(dirs)
+        self.interval = interval
+        self._snapshot = self._take_snapshot()
+
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._take_snapshot()
+        changed = set(
+            path
+            for path in set(snapshot) | set(self._snapshot)
+            if snapshot.get(path) != self._snapshot.get(path)
+        )
+        self._snapshot = snapshot
+        return changed
+
+
+    def close(self):
+        pass
+
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for d in self.dirs:
+            for dirpath, dirnames, filenames in os.walk(d):
+                for fn in dirnames + filenames:
+                    path = os.path.join(dirpath, fn)
+                    try:
+                        st = os.lstat(path)
+                    except OSError as exc:
+                        if exc.errno == errno.ENOENT:
+                            continue
+                        raise
+                    snapshot[path] = (st.st_size, st.st_mtime)
+        return snapshot
+
+
+def make_watcher(dirs, poll_interval=5.0, force_polling=False):
+    """An InotifyWatcher if possible, otherwise a PollingWatcher"""
+    if not force_polling:
+        try:
+            return InotifyWatcher(dirs)
+        except WatcherUnavailableException:
+            pass
+    return PollingWatcher(dirs, interval=poll_interval)
+
+
+class QuietTracker(object):
+    """Tracks the last change to each album (top-level directory of an inbox) to find the ones that have settled.
+
+    Hidden directories and those named in ignore_names aren't albums."""
+    def __init__(self, inbox_dirs, quiet_period, ignore_names=()):
+        self.inbox_dirs = [os.path.abspath(d) for d in inbox_dirs]
+        self.quiet_period = quiet_period
+        self.ignore_names = ignore_names
+        # album directory -> time of its last change
+        self._last_change = collections.OrderedDict()
+
+
+    def changed(self, paths, now=None):
+        """Notes changes to paths. Returns the albums they belong to."""
+        now = time.time() if now is None else now
+        albums = set()
+        for path in paths:
+            album = self.album_for_path(path)
+            if album is not None:
+                self._last_change.pop(album, None)
+                self._last_change[album] = now
+                albums.add(album)
+        return albums
+
+
+    def pop_quiet(self, now=None):
+        """Returns (and stops tracking) the albums that haven't changed for quiet_period seconds, oldest first"""
+        now = time.time() if now is None else now
+        quiet = [
+            album
+            for album, last_change in self._last_change.iteritems()
+            if now - last_change >= self.quiet_period
+        ]
+        for album in quiet:
+            del self._last_change[album]
+        return quiet
+
+
+    def __len__(self):
+        return len(self._last_change)
+
+
+    def album_for_path(self, path):
+        """The album directory path is in, or None if it isn't in one (e.g. a loose file in an inbox)"""
+        path = os.path.abspath(path)
+        for inbox in self.inbox_dirs:
+            rel = os.path.relpath(path, inbox)
+            if rel == os.curdir or rel.startswith(os.pardir + os.sep) or rel == os.pardir:
+                continue
+
+            name = rel.split(os.sep, 1)[0]
+            if name.startswith(".") or name in self.ignore_names:
+                return None
+
+            album = os.path.join(inbox, name)
+            if album != path or os.path.isdir(album):
+                return album
+        return None
+
+
+def _listdir(d):
+    try:
+        return os.listdir(d)
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            return []
+        raise
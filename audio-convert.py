@@ -1,25 +1,40 @@
 #!/usr/bin/python
 
 import argparse
-import errno
 import itertools
+import json
 import operator
 import os
+import Queue
 import shutil
 import subprocess
+import sys
 import tempfile
-
-import pycolor
-import tabulate
-import yaml
+import threading
+import time
+import traceback
 
 from aclib import (
     audioformat,
+    catalog,
     collector,
+    encodecache,
+    journal,
+    outputprofile,
+    preflight,
+    tagcache,
+    trace,
     util,
+    watch,
 )
 
 PROCESSED_DIR = "processed"
+# subcommands, given as the first argument; without one, audio-convert plans, edits and applies interactively
+COMMANDS = ("plan", "apply", "watch")
+# bump when plan files change incompatibly
+PLAN_VERSION = 1
+# held while moving files into the output and processed directories
+FILESYSTEM_LOCK = threading.Lock()
 UTF8_TYPE = lambda s: unicode(s, "utf8")
 TAG_OVERRIDES = {
         "album_artist": {"type": UTF8_TYPE, "strip_from_singles": False},
@@ -36,15 +51,108 @@ TAG_OVERRIDES = {
 def construct_yaml_str(self, node):
     # Override the default string handling function to return unicode objects always
     return self.construct_scalar(node)
-yaml.Loader.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
-yaml.SafeLoader.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
 
 
-def parse_args():
+def import_yaml():
+    """Imports yaml, set up to load strings as unicode.
+
+    yaml, tabulate and pycolor are only needed for the interactive review, so they're imported where they're used
+    rather than slowing down every other command."""
+    import yaml
+    yaml.Loader.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
+    yaml.SafeLoader.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
+    return yaml
+
+
+def parse_args(argv):
+    """Returns (command, args), command being one of COMMANDS or None"""
+    command = None
+    if argv and argv[0] in COMMANDS:
+        command = argv.pop(0)
+
     parser = argparse.ArgumentParser(
-        description="Standardize your audio encoding and tagging!",
+        prog="audio-convert.py" + (" " + command if command else ""),
+        description={
+            None: "Standardize your audio encoding and tagging! To prepare work and run it unattended later, see 'audio-convert.py plan --help' and 'audio-convert.py apply --help'.",
+            "plan": "Write what audio-convert would do (sources, proposed tags, target paths) to a plan file for 'apply'. Edit proposed_tags in it to change tags.",
+            "apply": "Convert, tag and move everything in plan files, without any prompts.",
+            "watch": "Keep watching inbox directories and convert every album (top-level directory of an inbox) once it stops changing, without any prompts. Albums are tagged as they are, plus any tag overrides; albums missing required tags are reported and left in place until they change.",
+        }[command],
+    )
+
+    if command in (None, "plan"):
+        _add_tag_args(parser)
+        _add_selection_args(parser)
+    if command == "watch":
+        _add_tag_args(parser)
+        _add_watch_args(parser)
+    if command == "plan":
+        parser.add_argument(
+            "--plan_fn", "-o",
+            required=True,
+            help="Where to write the plan.",
+        )
+    if command == "apply":
+        parser.add_argument(
+            "plan_fns",
+            metavar="PLAN_FN",
+            nargs="+",
+            help="Plan files written by 'plan'. Rejected if any source file has changed since.",
+        )
+
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=util.default_jobs(),
+        help="Number of decoders/encoders to run concurrently, shared by all discs. Defaults to the number of cores; 1 encodes each disc with a single lame --nogap.",
     )
 
+    parser.add_argument(
+        "--cache_dir",
+        default=tagcache.DEFAULT_CACHE_DIR,
+        help="Where to keep the persistent tag cache.",
+    )
+
+    parser.add_argument(
+        "--no_tag_cache",
+        action="store_true",
+        help="Always read tags from the files, bypassing the tag cache.",
+    )
+
+    parser.add_argument(
+        "--trace",
+        default=None,
+        metavar="TRACE_FN",
+        help="Write the wall time of every stage, and the CPU time and peak memory of every decoder/encoder, to this file. Discs also get their realtime factor (seconds of audio per second of conversion).",
+    )
+
+    parser.add_argument(
+        "--trace_format",
+        choices=trace.FORMATS,
+        default="jsonl",
+        help="jsonl writes an event per line; chrome writes a trace-event file for chrome://tracing or Perfetto.",
+    )
+
+    if command != "plan":
+        _add_processing_args(parser)
+
+    args = parser.parse_args(argv)
+    assert args.jobs >= 1, "--jobs must be at least 1."
+    if command != "apply":
+        assert os.path.exists(args.output_dir)
+    if command != "plan":
+        assert all(os.path.isdir(p.output_dir) for p in args.profiles), "The OUTPUT_DIR of every --profile must exist."
+    if command == "watch":
+        assert args.workers >= 1, "--workers must be at least 1."
+        assert all(os.path.isdir(d) for d in args.inbox_dirs), "Every INBOX_DIR must be a directory."
+    if command in (None, "plan"):
+        assert not (args.singles and len(args.audio_dirs) > 1), "Only process one singles directory at a time."
+        assert not (args.singles and args.recursive), "--singles and --recursive are mutually exclusive."
+    return command, args
+
+
+def _add_tag_args(parser):
+    """Arguments for how audio is tagged and where it goes"""
     # force these tags (optional)
     override_group = parser.add_argument_group("tag_overrides", "ID3 tag overrides")
     for k, cfg in TAG_OVERRIDES.iteritems():
@@ -55,12 +163,21 @@ def parse_args():
         default=".",
     )
 
+
+def _add_selection_args(parser):
+    """Arguments choosing the audio"""
     parser.add_argument(
         "--singles",
         action="store_true",
         help="If specified, the single directory passed to 'audio_dirs' represents a list of singles to be tagged as Various Artists and stripped of most metadata.",
     )
 
+    parser.add_argument(
+        "--recursive", "-r",
+        action="store_true",
+        help="Scan each AUDIO_DIR recursively and process every directory with audio in it as a single-disc album of its own.",
+    )
+
     parser.add_argument(
         "audio_dirs",
         metavar="AUDIO_DIR",
@@ -68,10 +185,97 @@ def parse_args():
         help="Directories of audio to process non-recursively. Multiple directories will be interpreted as multiple discs and will be tagged CD=1,2,3,...",
     )
 
-    args = parser.parse_args()
-    assert os.path.exists(args.output_dir)
-    assert not (args.singles and len(args.audio_dirs) > 1), "Only process one singles directory at a time."
-    return args
+
+def _add_watch_args(parser):
+    parser.add_argument(
+        "--quiet_period",
+        type=float,
+        default=60.0,
+        help="Seconds an album must go without changes before it's converted.",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="Number of albums converted at once. Their decoders and encoders share the --jobs budget.",
+    )
+
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="Poll for changes instead of using inotify, e.g. for network filesystems. Used anyway where inotify isn't available.",
+    )
+
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=5.0,
+        help="Seconds between scans when polling.",
+    )
+
+    parser.add_argument(
+        "--status_interval",
+        type=float,
+        default=60.0,
+        help="Seconds between status lines while nothing else is reported.",
+    )
+
+    parser.add_argument(
+        "inbox_dirs",
+        metavar="INBOX_DIR",
+        nargs="+",
+        help="Directories to watch. Every directory in them is an album; audio directories below it are its discs, in sorted order.",
+    )
+
+
+def _add_processing_args(parser):
+    """Arguments for converting and moving the audio"""
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Pipe each decoder straight into its own encoder instead of decoding the whole disc to WAV files first. Gapless playback then relies on the LAME header rather than --nogap.",
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the decoded audio of FLACs against the MD5 in their STREAMINFO as it's decoded, failing the disc on a mismatch. Tracks taken from the encode cache aren't decoded, so aren't checked.",
+    )
+
+    parser.add_argument(
+        "--no_encode_cache",
+        action="store_true",
+        help="Always encode, bypassing the cache of previously encoded (untagged) MP3s.",
+    )
+
+    parser.add_argument(
+        "--encode_cache_max_gb",
+        type=float,
+        default=encodecache.DEFAULT_MAX_BYTES / float(1 << 30),
+        help="Size the encode cache is trimmed to after each disc, least recently used first.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profiles",
+        metavar="NAME:OUTPUT_DIR[:LAME_OPTS]",
+        type=outputprofile.parse_profile,
+        action="append",
+        default=[],
+        help="Also encode every disc into OUTPUT_DIR with LAME_OPTS (space-separated), from the same decode. LAME_OPTS may be left out for the presets {}. May be repeated.".format(", ".join(outputprofile.PRESETS)),
+    )
+
+    parser.add_argument(
+        "--no_catalog",
+        action="store_true",
+        help="Neither check new discs against the catalog of converted output (in --cache_dir) for collisions and duplicates, nor record them in it.",
+    )
+
+
+class StalePlanException(Exception):
+    # thrown when applying a plan whose source files have changed since it was written
+    pass
 
 
 class PendingDisc(object):
@@ -92,68 +296,299 @@ class PendingDisc(object):
         self.dirname = dirname.pop()
         self.pending_audio_files = pending_audio_files
         self.output_dir = output_dir
+        # the source goes to processed/<processed_subdir>/ once it's converted, e.g. its album's directory of its own
+        self.processed_subdir = ""
+
+    def process_disc(self, jobs=1, stream=False, extra_profiles=(), verify=False):
+        """Converts, tags and moves this disc. `jobs` is a job count or a util.JobSlots shared with other discs. Each
+        source is decoded once and encoded for its own output directory as well as for each of extra_profiles
+        (outputprofile.Profiles). With verify, sources that carry a checksum of their audio are checked against it
+        while they're decoded.
+
+        Every stage each track completes is recorded in the journal, so rerunning an interrupted disc picks up where it
+        left off and reuses the intermediate files it already made."""
+        with trace.span("disc", dirname=self.dirname, tracks=len(self.pending_audio_files)) as disc_args:
+            self._process_disc(jobs, stream, outputprofile.for_output_dir(self.output_dir, extra_profiles), verify)
+            if trace.get_tracer() is not None:
+                # the realtime factor of the whole disc follows from this
+                disc_args["audio_seconds"] = sum(
+                    audioformat.mp3.duration(paf.new_filename) or 0.0
+                    for paf in self.pending_audio_files
+                )
+
+    def _process_disc(self, jobs, stream, profiles, verify):
+        progress = journal.get_journal()
+        disc_key = journal.disc_key([paf.current_filename for paf in self.pending_audio_files])
+        # intermediate files stay on local temporary storage: outputs are tagged copies written next to their targets,
+        # so none of them is ever renamed into an output directory
+        work_dir = os.path.join(progress.work_root(tempfile.gettempdir()), disc_key)
+        if progress.get(disc_key, "started") is None:
+            # so the disc can be given up on if it's never resumed; see Journal.abandoned_discs()
+            progress.record(
+                disc_key,
+                "started",
+                sources=[os.path.abspath(paf.current_filename).decode("utf8") for paf in self.pending_audio_files],
+                time=time.time(),
+            )
 
-    def process_disc(self):
-        # copy to mp3_tmpdir, reencoding if necessary
-        with util.mktempdir() as mp3_tmpdir:
-            if any(paf.needs_conversion() for paf in self.pending_audio_files):
-                with util.mktempdir() as wav_tmpdir:
-                    for idx, paf in enumerate(self.pending_audio_files, 1):
-                        paf.decode(os.path.join(wav_tmpdir, "{:03d}.wav".format(idx)))
+        # outputs an interrupted run didn't put in place yet
+        pending = [
+            (idx, paf, profile)
+            for profile in profiles
+            for idx, paf in enumerate(self.pending_audio_files, 1)
+            if not self._is_renamed(progress, disc_key, idx, paf, profile)
+        ]
 
-                    audioformat.mp3.encode([
-                            paf.decoded_fn
-                            for paf in self.pending_audio_files
-                        ],
-                        mp3_tmpdir,
-                    )
-                    for paf in self.pending_audio_files:
-                        assert paf.decoded_fn.endswith(".wav")
-                        encoded_fn = os.path.join(
-                            mp3_tmpdir,
-                            os.path.splitext(os.path.basename(paf.decoded_fn))[0] + ".mp3",
-                        )
-                        paf.mark_encoded_fn(encoded_fn)
+        if pending:
+            if any(paf.needs_conversion() for paf in self.pending_audio_files):
+                with trace.span("convert", dirname=self.dirname, stream=stream, profiles=len(profiles)):
+                    self._convert(work_dir, progress, disc_key, jobs, stream, profiles, verify)
             else:
-                for paf in self.pending_audio_files:
-                    new_fn = os.path.join(
-                        mp3_tmpdir,
-                        os.path.basename(paf.current_filename),
-                    )
-                    assert not os.path.exists(new_fn)
-                    shutil.copy(paf.current_filename, new_fn)
-                    paf.mark_encoded_fn(new_fn)
+                # MP3s that don't need encoding are tagged straight from the source, whatever the profile
+                for profile in profiles:
+                    for paf in self.pending_audio_files:
+                        paf.mark_encoded_fn(paf.current_filename, profile, {"mode": "copy"})
 
-            # write tags
+        for profile in profiles:
+            dirs = set(os.path.dirname(paf.new_filename_for(profile)) for paf in self.pending_audio_files)
+            assert len(dirs) == 1
+            with FILESYSTEM_LOCK:
+                util.makedirs(dirs.pop())
+
+        output_catalog = catalog.get_catalog()
+        try:
+            # write tagged copies next to their final names, then rename
+            with trace.span("tag", dirname=self.dirname):
+                util.parallel_map(
+                    lambda (idx, paf, profile): self._tag(progress, disc_key, idx, paf, profile),
+                    pending,
+                    jobs,
+                )
+            if output_catalog is not None:
+                # hashed before the sources are moved; a no-op for sources the encode cache already hashed
+                util.parallel_map(lambda paf: paf.source_hash, self.pending_audio_files, jobs)
+
+            # discs may be processed concurrently: serialize the collision checks and moves between them
+            with FILESYSTEM_LOCK:
+                with trace.span("rename", dirname=self.dirname):
+                    for idx, paf, profile in pending:
+                        new_filename = paf.new_filename_for(profile)
+                        paf.rename(profile)
+                        progress.record(
+                            disc_key,
+                            "renamed",
+                            _journal_track(idx, profile),
+                            new_filename=new_filename.decode("utf8"),
+                        )
+                        if output_catalog is not None:
+                            output_catalog.add(
+                                new_filename,
+                                profile.output_dir,
+                                paf.proposed_tags,
+                                duration=audioformat.mp3.duration(new_filename),
+                                source_hash=paf.source_hash,
+                                encode_settings=paf.encode_settings[profile.name],
+                                verification=paf.verification,
+                            )
+                    if output_catalog is not None:
+                        output_catalog.flush()
+
+                with trace.span("move_source", dirname=self.dirname):
+                    processed_dir = os.path.join(self.output_dir, PROCESSED_DIR, self.processed_subdir)
+                    util.makedirs(processed_dir)
+                    # recorded first: once the source is gone, the disc can only be completed
+                    progress.record(disc_key, "source_moved", dirname=os.path.abspath(self.dirname).decode("utf8"))
+                    shutil.move(self.dirname, processed_dir)
+        except:
             for paf in self.pending_audio_files:
-                paf.write_tags()
+                paf.discard_tagged_fns()
+            raise
+
+        if os.path.exists(work_dir):
+            shutil.rmtree(work_dir)
+        progress.complete(disc_key)
+
+    def resumed_filenames(self, profiles):
+        """Absolute target paths of the outputs an interrupted run of this disc already put in place"""
+        progress = journal.get_journal()
+        disc_key = journal.disc_key([paf.current_filename for paf in self.pending_audio_files])
+        return set(
+            os.path.abspath(paf.new_filename_for(profile))
+            for profile in profiles
+            for idx, paf in enumerate(self.pending_audio_files, 1)
+            if self._is_renamed(progress, disc_key, idx, paf, profile)
+        )
 
-            # create output directory and rename
-            dirs = set(paf.new_directory for paf in self.pending_audio_files)
-            assert len(dirs) == 1
+    def _is_renamed(self, progress, disc_key, idx, paf, profile):
+        renamed = progress.get(disc_key, "renamed", _journal_track(idx, profile))
+        new_filename = paf.new_filename_for(profile)
+        return (
+            renamed is not None
+            and renamed["new_filename"] == new_filename.decode("utf8")
+            and os.path.exists(new_filename)
+        )
 
-            output_dir = dirs.pop()
-            try:
-                os.makedirs(output_dir)
-            except OSError as exc:  # Python >2.5
-                if exc.errno == errno.EEXIST and os.path.isdir(output_dir):
-                    pass
-                else:
-                    raise
+    def _tag(self, progress, disc_key, idx, paf, profile):
+        """Writes the tagged copy of a track, unless an interrupted run left one with the same tags and target"""
+        new_filename = paf.new_filename_for(profile)
+        # named after the target and the disc, so an unfinished copy from an interrupted run is overwritten
+        tagged_fn = os.path.join(
+            os.path.dirname(new_filename),
+            ".{}.{}.tmp".format(os.path.basename(new_filename), disc_key[:12]),
+        )
 
-            for paf in self.pending_audio_files:
-                paf.rename()
+        track = _journal_track(idx, profile)
+        tagged = progress.get(disc_key, "tagged", track)
+        if (tagged is not None
+                and tagged["tagged_fn"] == tagged_fn.decode("utf8")
+                and tagged["tags"] == paf.proposed_tags.to_dict()
+                and os.path.exists(tagged_fn)):
+            paf.mark_tagged_fn(tagged_fn, profile)
+            return
+
+        paf.write_tags(tagged_fn, profile)
+        progress.record(disc_key, "tagged", track, tagged_fn=tagged_fn.decode("utf8"), tags=paf.proposed_tags.to_dict())
+
+    def _convert(self, work_dir, progress, disc_key, jobs, stream, profiles, verify):
+        """Encodes every track to {:03d}.mp3 in a directory of work_dir per profile, decoding each source once and
+        reusing what an interrupted run already encoded and untagged MP3s from the encode cache if possible.
+
+        With verify, the outcome of checking each decoded source is journaled with the stage that decoded it."""
+        pafs = self.pending_audio_files
+        mp3_dirs = {}
+        encoded_fns = {}
+        for profile in profiles:
+            # the first profile's directory is named as it was before there were profiles, so older runs resume
+            mp3_dirs[profile.name] = os.path.join(work_dir, "mp3" if profile is profiles[0] else "mp3-" + profile.name)
+            util.makedirs(mp3_dirs[profile.name])
+            encoded_fns[profile.name] = [
+                os.path.join(mp3_dirs[profile.name], "{:03d}.mp3".format(idx))
+                for idx in xrange(1, len(pafs) + 1)
+            ]
+        can_stream = all(audioformat.codec_for_filename(paf.current_filename).can_stream for paf in pafs)
+        mode = "stream" if stream and can_stream else audioformat.mp3.encode_mode(len(pafs), jobs)
+
+        # by profile, the tracks that don't need encoding in this run, either journaled by an interrupted one or cached
+        reused = dict(
+            (profile.name, [
+                progress.get(disc_key, "encoded", _journal_track(idx, profile)) is not None and os.path.exists(encoded_fn)
+                for idx, encoded_fn in enumerate(encoded_fns[profile.name], 1)
+            ])
+            for profile in profiles
+        )
 
-            processed_dir = os.path.join(self.output_dir, PROCESSED_DIR)
-            if not os.path.exists(processed_dir):
-                os.mkdir(processed_dir)
-            shutil.move(self.dirname, processed_dir)
+        cache = encodecache.get_cache()
+        if cache is not None:
+            with trace.span("encode_cache_get", dirname=self.dirname) as cache_args:
+                payload_hashes = util.parallel_map(lambda paf: paf.source_hash, pafs, jobs)
+                keys = {}
+                cached = {}
+                for profile in profiles:
+                    # the profile's options are part of the key
+                    keys[profile.name] = encodecache.track_keys(
+                        payload_hashes,
+                        profile.lame_opts,
+                        mode,
+                        context_samples=(audioformat.mp3.GAPLESS_CONTEXT_SAMPLES if mode == "gapless" else None),
+                    )
+                    cached[profile.name] = [
+                        is_reused or cache.get(key, fn)
+                        for key, fn, is_reused in zip(keys[profile.name], encoded_fns[profile.name], reused[profile.name])
+                    ]
+                cache_args["hits"] = sum(sum(profile_cached) for profile_cached in cached.itervalues())
+        else:
+            keys = dict((profile.name, [None] * len(pafs)) for profile in profiles)
+            cached = dict(reused)
+
+        def _stream_encode((idx, paf, outputs)):
+            paf.stream_encode([(encoded_fns[profile.name][idx - 1], profile.lame_opts) for profile in outputs], verify)
+            for profile in outputs:
+                progress.record(disc_key, "encoded", _journal_track(idx, profile), verification=paf.verification)
+
+        if mode == "stream":
+            # decode straight into the encoders of every profile that misses the track, one pipeline per track
+            util.parallel_map(
+                _stream_encode,
+                [
+                    (idx, paf, [profile for profile in profiles if not cached[profile.name][idx - 1]])
+                    for idx, paf in enumerate(pafs, 1)
+                    if not all(cached[profile.name][idx - 1] for profile in profiles)
+                ],
+                jobs,
+            )
+        elif not all(all(cached[profile.name]) for profile in profiles):
+            # tracks of a disc are encoded together, so a single miss means encoding the whole disc for that profile
+            wav_dir = os.path.join(work_dir, "wav")
+            util.makedirs(wav_dir)
+
+            def _decode((idx, paf)):
+                decoded_fn = os.path.join(wav_dir, "{:03d}.wav".format(idx))
+                decoded = progress.get(disc_key, "decoded", idx)
+                if decoded is not None and os.path.exists(decoded_fn):
+                    paf.mark_decoded_fn(decoded_fn, decoded.get("verification"))
+                    return
+                paf.decode(decoded_fn, verify)
+                progress.record(disc_key, "decoded", idx, verification=paf.verification)
+
+            # decode in parallel, once for all profiles; results (and the encoders' input) stay in track order
+            util.parallel_map(_decode, enumerate(pafs, 1), jobs)
+
+            for profile in profiles:
+                if all(cached[profile.name]):
+                    continue
+                with trace.span("encode", dirname=self.dirname, mode=mode, profile=profile.name):
+                    audioformat.mp3.encode([
+                            paf.decoded_fn
+                            for paf in pafs
+                        ],
+                        mp3_dirs[profile.name],
+                        jobs=jobs,
+                        lame_opts=profile.lame_opts,
+                    )
+                for idx, paf, encoded_fn in zip(itertools.count(1), pafs, encoded_fns[profile.name]):
+                    assert paf.decoded_fn.endswith(".wav")
+                    assert encoded_fn == os.path.join(
+                        mp3_dirs[profile.name],
+                        os.path.splitext(os.path.basename(paf.decoded_fn))[0] + ".mp3",
+                    )
+                    progress.record(disc_key, "encoded", _journal_track(idx, profile), verification=paf.verification)
+                cached[profile.name] = [False] * len(pafs)
+            shutil.rmtree(wav_dir)
+
+        for profile in profiles:
+            encode_settings = {"mode": mode, "lame_opts": profile.lame_opts}
+            for idx, paf, key, encoded_fn, is_cached, is_reused in zip(
+                    itertools.count(1),
+                    pafs,
+                    keys[profile.name],
+                    encoded_fns[profile.name],
+                    cached[profile.name],
+                    reused[profile.name]):
+                if cache is not None and not is_cached:
+                    # cached before tags are written
+                    cache.put(key, encoded_fn)
+                elif is_cached and not is_reused:
+                    progress.record(disc_key, "encoded", _journal_track(idx, profile))
+                elif is_reused and paf.verification is None:
+                    # decoded by the interrupted run
+                    paf.verification = progress.verification(disc_key, idx, _journal_track(idx, profile))
+                paf.mark_encoded_fn(encoded_fn, profile, encode_settings)
+
+        if cache is not None:
+            cache.evict()
+
+
+def _journal_track(idx, profile):
+    """How track idx of a disc is known in the journal for profile. The --output_dir profile's tracks keep their plain
+    index, as before there were profiles."""
+    if profile.name == outputprofile.DEFAULT_NAME:
+        return idx
+    return "{}/{}".format(profile.name, idx)
 
 
 class PendingAudioFile(object):
     def __init__(self, audio_file, tag_overrides, num_total_discs, is_singles, output_dir):
         self.audio_file = audio_file
-        self.tag_overrides = tag_overrides
         self.num_total_discs = num_total_discs
         self.is_singles = is_singles
         self.output_dir = output_dir
@@ -161,10 +596,40 @@ class PendingAudioFile(object):
         self._current_tags = None
         self._current_tags_memoized = False
 
+        # derived from the current tags and the overrides; see _invalidate_proposed()
+        self._proposed_tags = None
+        self._track_num_representation = None
+        self._new_filename = None
+
+        self.tag_overrides = tag_overrides
+
         # set if decoded
         self._decoded_fn = None
-        # marked externally if encoded
-        self._encoded_fn = None
+        # how checking the decoded audio against the source's own checksum went (e.g. flac.VERIFIED); None if it
+        # wasn't checked
+        self.verification = None
+        # by profile name: the encoded files, marked externally, and the tagged copies set by write_tags(), waiting
+        # to be renamed into place
+        self._encoded_fns = {}
+        self._tagged_fns = {}
+        # by profile name: how the output was encoded, as recorded in the catalog; set along with the encoded file
+        self.encode_settings = {}
+        self._source_hash = None
+
+    @property
+    def tag_overrides(self):
+        return self._tag_overrides
+
+    @tag_overrides.setter
+    def tag_overrides(self, tag_overrides):
+        """Assign a new dict to change overrides; mutating the current one in place won't be noticed"""
+        self._tag_overrides = tag_overrides
+        self._invalidate_proposed()
+
+    def _invalidate_proposed(self):
+        self._proposed_tags = None
+        self._track_num_representation = None
+        self._new_filename = None
 
     @property
     def current_tags(self):
@@ -173,8 +638,20 @@ class PendingAudioFile(object):
             self._current_tags_memoized = True
         return self._current_tags
 
+    def set_current_tags(self, tags):
+        """Supplies tags read elsewhere (e.g. in a batch) instead of reading them on first access"""
+        self._current_tags = tags
+        self._current_tags_memoized = True
+        self._invalidate_proposed()
+
     @property
     def proposed_tags(self):
+        """Computed once per set of overrides. Treat the result as read-only."""
+        if self._proposed_tags is None:
+            self._proposed_tags = self._make_proposed_tags()
+        return self._proposed_tags
+
+    def _make_proposed_tags(self):
         proposed_tags = self.current_tags.copy(**self.tag_overrides)
 
         # null-out empty-stringed tags
@@ -192,14 +669,32 @@ class PendingAudioFile(object):
     def current_filename(self):
         return self.audio_file.path
 
+    @property
+    def source_hash(self):
+        """The audio payload hash of the source, computed once"""
+        if self._source_hash is None:
+            self._source_hash = self.audio_file.audio_payload_hash()
+        return self._source_hash
+
+    @property
+    def track_num_representation(self):
+        if self._track_num_representation is None:
+            new_tags = self.proposed_tags
+            self._track_num_representation = util.get_track_filename_representation(
+                new_tags.cd_no, new_tags.track_no,
+                self.num_total_discs, new_tags.cd_tracks,
+            )
+        return self._track_num_representation
+
     @property
     def new_filename(self):
-        new_tags = self.proposed_tags
+        if self._new_filename is None:
+            self._new_filename = self._make_new_filename()
+        return self._new_filename
 
-        track_num = util.get_track_filename_representation(
-            new_tags.cd_no, new_tags.track_no,
-            self.num_total_discs, new_tags.cd_tracks,
-        )
+    def _make_new_filename(self):
+        new_tags = self.proposed_tags
+        track_num = self.track_num_representation
 
         if self.is_singles:
             return os.path.join(
@@ -215,49 +710,110 @@ class PendingAudioFile(object):
             u"{track_num} {title}.mp3".format(track_num=track_num, title=new_tags.title).replace("/", "-").encode("utf8"),
         )
 
-    @property
-    def new_directory(self):
-        return os.path.dirname(self.new_filename)
+    def new_filename_for(self, profile):
+        """new_filename, but under the output directory of an outputprofile.Profile"""
+        if profile.output_dir == os.path.abspath(self.output_dir):
+            return self.new_filename
+        return os.path.join(profile.output_dir, os.path.relpath(self.new_filename, self.output_dir))
 
     def needs_conversion(self):
         return self.audio_file.ext != ".mp3"
 
-    def decode(self, output_fn):
+    def can_verify(self):
+        return audioformat.codec_for_filename(self.current_filename).can_verify
+
+    def decode(self, output_fn, verify=False):
+        """Decodes to the WAV file output_fn. With verify, the audio is checked as it's written, if the source can be."""
         assert not self._decoded_fn
-        self.audio_file.decode(output_fn)
+        with trace.span("decode", fn=self.current_filename) as decode_args:
+            self.verification = self.audio_file.decode(output_fn, verify=verify and self.can_verify())
+            decode_args["verification"] = self.verification
         self._decoded_fn = output_fn
 
+    def mark_decoded_fn(self, decoded_fn, verification=None):
+        """Supplies a file already decoded (e.g. by an interrupted run) instead of decoding again"""
+        assert not self._decoded_fn
+        assert os.path.exists(decoded_fn)
+        self._decoded_fn = decoded_fn
+        self.verification = verification
+
+    def stream_encode(self, outputs, verify=False):
+        """Decodes straight into an encoder for every (output_fn, lame_opts) of outputs. With verify, the stream is
+        checked on its way through, if the source can be."""
+        assert not self._decoded_fn
+        verifier = self.audio_file.make_verifier() if verify and self.can_verify() else None
+        with trace.span("stream_encode", fn=self.current_filename, outputs=len(outputs)) as encode_args:
+            audioformat.mp3.encode_stream_many(
+                self.audio_file.decode_to_pipe(),
+                outputs,
+                observe=None if verifier is None else verifier.feed,
+            )
+            if verifier is not None:
+                self.verification = verifier.result()
+            encode_args["verification"] = self.verification
+
     @property
     def decoded_fn(self):
         assert self._decoded_fn
         return self._decoded_fn
 
-    def mark_encoded_fn(self, encoded_fn):
-        assert not self._encoded_fn
+    def mark_encoded_fn(self, encoded_fn, profile, encode_settings):
+        assert profile.name not in self._encoded_fns
         assert os.path.exists(encoded_fn)
-        self._encoded_fn = encoded_fn
+        self._encoded_fns[profile.name] = encoded_fn
+        self.encode_settings[profile.name] = encode_settings
 
-    def write_tags(self):
-        assert self._encoded_fn
-        assert self._encoded_fn.endswith(".mp3")
+    def write_tags(self, tagged_fn, profile):
+        """Writes a tagged copy of the file encoded for profile to tagged_fn, a temporary file in the profile's output
+        directory"""
+        encoded_fn = self._encoded_fns[profile.name]
+        assert encoded_fn.endswith(".mp3")
+        assert profile.name not in self._tagged_fns
+        assert os.path.dirname(tagged_fn) == os.path.dirname(self.new_filename_for(profile))
 
         new_tags = self.proposed_tags
-        assert new_tags.album_artist
-        assert new_tags.year
-        assert new_tags.album
-        assert new_tags.title
-        assert new_tags.cd_no
-        assert new_tags.track_no or self.is_singles
-        assert self.num_total_discs or self.is_singles
-        assert new_tags.cd_tracks or self.is_singles
-
-        return audioformat.mp3.write_tags(self._encoded_fn, self.proposed_tags)
-
-    def rename(self):
-        assert self._encoded_fn
-        assert os.path.exists(self._encoded_fn)
-        assert not os.path.exists(self.new_filename)
-        shutil.move(self._encoded_fn, self.new_filename)
+        self.check_proposed_tags()
+
+        self._tagged_fns[profile.name] = tagged_fn
+        with trace.span("write_tags", fn=self.current_filename, profile=profile.name):
+            audioformat.mp3.write_tagged_copy(encoded_fn, tagged_fn, new_tags)
+
+    def missing_tags(self):
+        """Names of the proposed tags written files need that are missing"""
+        new_tags = self.proposed_tags
+        required = ["album_artist", "year", "album", "title", "cd_no"]
+        if not self.is_singles:
+            required += ["track_no", "num_total_discs", "cd_tracks"]
+        return [
+            name
+            for name in required
+            if not (self.num_total_discs if name == "num_total_discs" else getattr(new_tags, name))
+        ]
+
+    def check_proposed_tags(self):
+        """Asserts that the proposed tags have everything written files need"""
+        missing = self.missing_tags()
+        assert not missing, "{} is missing {}.".format(self.current_filename, ", ".join(missing))
+
+    def mark_tagged_fn(self, tagged_fn, profile):
+        """Supplies a tagged copy already written (e.g. by an interrupted run) instead of writing it again"""
+        assert profile.name not in self._tagged_fns
+        assert os.path.exists(tagged_fn)
+        self._tagged_fns[profile.name] = tagged_fn
+
+    def rename(self, profile):
+        tagged_fn = self._tagged_fns.pop(profile.name)
+        new_filename = self.new_filename_for(profile)
+        assert os.path.exists(tagged_fn)
+        assert not os.path.exists(new_filename)
+        os.rename(tagged_fn, new_filename)
+
+    def discard_tagged_fns(self):
+        """Removes the tagged copies left by write_tags() that haven't been renamed into place"""
+        for tagged_fn in self._tagged_fns.itervalues():
+            if os.path.exists(tagged_fn):
+                os.unlink(tagged_fn)
+        self._tagged_fns = {}
 
     def __repr__(self):
         return "PendingAudioFile({}, {}, {})".format(self.audio_file, self.tag_overrides, self.new_filename)
@@ -276,10 +832,15 @@ def get_tag_overrides(args):
     return overrides
 
 
-def get_pending_discs(audio_dirs, global_tag_overrides, output_dir, is_singles):
+def get_pending_discs(audio_dirs, global_tag_overrides, output_dir, is_singles, jobs=1, separate_albums=False):
+    """With separate_albums, each directory is a single-disc album of its own rather than one disc of the same album"""
+    num_discs = 1 if separate_albums else len(audio_dirs)
     pending_discs = []
     for disc_num, d in enumerate(audio_dirs, 1):
-        audio_files = collector.collect_audio_files(d, allow_heterogenous=is_singles)
+        if separate_albums:
+            disc_num = 1
+        with trace.span("collect", dirname=d):
+            audio_files = collector.collect_audio_files(d, allow_heterogenous=is_singles)
         disc_overrides = dict(global_tag_overrides)
         if is_singles:
             disc_overrides["album_artist"] = u"Various Artists"
@@ -305,16 +866,30 @@ def get_pending_discs(audio_dirs, global_tag_overrides, output_dir, is_singles):
                 PendingAudioFile(
                     audio_file,
                     overrides,
-                    len(audio_dirs),
+                    num_discs,
                     is_singles,
                     output_dir,
             ))
         pending_discs.append(PendingDisc(pending_audio_files, output_dir))
 
+    # read all current tags up front, with as few subprocesses as possible
+    all_pafs = [
+        paf
+        for disc in pending_discs
+        for paf in disc.pending_audio_files
+    ]
+    with trace.span("read_tags", files=len(all_pafs)):
+        all_tags = collector.read_tags_many([paf.audio_file for paf in all_pafs], jobs=jobs)
+    for paf, tags in zip(all_pafs, all_tags):
+        paf.set_current_tags(tags)
+
     return pending_discs
 
 
 def print_pending_discs(pending_discs):
+    import pycolor
+    import tabulate
+
     def get_update_str(new_val, old_val):
         if new_val == old_val:
             return old_val
@@ -339,11 +914,12 @@ def print_pending_discs(pending_discs):
     for disc in pending_discs:
         for af in disc.pending_audio_files:
             print get_update_str(af.new_filename, af.current_filename)
+            proposed_tags, current_tags = af.proposed_tags, af.current_tags
             cells = []
             for slot in audioformat.util.Tags.__slots__:
                 cells.append(u"{}: {}".format(
                     slot,
-                    get_update_str(getattr(af.proposed_tags, slot), getattr(af.current_tags, slot)),
+                    get_update_str(getattr(proposed_tags, slot), getattr(current_tags, slot)),
                 ))
             print_2_column_table(cells)
 
@@ -357,6 +933,7 @@ def update_pending_discs(initial_pending_discs, output_dir, is_singles):
     if maybe_no == 'n':
         return initial_pending_discs
 
+    yaml = import_yaml()
     paf_by_filename = {}
     with tempfile.NamedTemporaryFile() as tmpfile:
         display_yaml = []
@@ -388,16 +965,10 @@ def update_pending_discs(initial_pending_discs, output_dir, is_singles):
     for disc in loaded_yaml:
         pending_audio_files = []
         for paf in disc["audio_files"]:
+            # keep the already-read current tags; new overrides invalidate everything derived from the old ones
             cached_af = paf_by_filename.pop(paf.pop("filename"))
-            pending_audio_files.append(
-                PendingAudioFile(
-                    cached_af.audio_file,
-                    paf.pop("proposed_tags"),
-                    cached_af.num_total_discs,
-                    is_singles,
-                    output_dir,
-                ),
-            )
+            cached_af.tag_overrides = paf.pop("proposed_tags")
+            pending_audio_files.append(cached_af)
         pending_discs.append(
             PendingDisc(pending_audio_files, output_dir),
         )
@@ -412,14 +983,357 @@ def update_pending_discs(initial_pending_discs, output_dir, is_singles):
     return pending_discs
 
 
-def main():
-    args = parse_args()
+def scan_audio_dirs(root_dirs, jobs=1):
+    """Every directory with audio under root_dirs, sorted. Unusable (e.g. heterogenous) directories are reported and skipped."""
+    audio_dirs = []
+    for root_dir in root_dirs:
+        for scanned in collector.scan_library(root_dir, jobs=jobs, skip_dirnames=(PROCESSED_DIR,)):
+            if scanned.error is not None:
+                print "Skipping {}: {}".format(scanned.path, scanned.error)
+                continue
+            audio_dirs.append(scanned.path)
+    print "Found {} directories with audio.".format(len(audio_dirs))
+    return sorted(audio_dirs)
+
+
+def source_stamp(fn):
+    """What a plan records of a source file to notice it changing before it's applied"""
+    st = os.stat(fn)
+    return [st.st_size, getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 10 ** 9)]
+
+
+def write_plan(pending_discs, output_dir, plan_fn):
+    """Writes pending_discs to plan_fn as JSON, with absolute paths so it can be applied from anywhere"""
+    plan = {
+        "version": PLAN_VERSION,
+        # paths are UTF-8 byte strings; json needs them as unicode
+        "output_dir": os.path.abspath(output_dir).decode("utf8"),
+        "discs": [
+            {
+                "audio_files": [
+                    {
+                        "filename": os.path.abspath(paf.current_filename).decode("utf8"),
+                        "source_stamp": source_stamp(paf.current_filename),
+                        "num_total_discs": paf.num_total_discs,
+                        "is_singles": paf.is_singles,
+                        "proposed_tags": paf.proposed_tags.to_dict(),
+                        # informational: apply derives it from proposed_tags again
+                        "new_filename": os.path.abspath(paf.new_filename).decode("utf8"),
+                    }
+                    for paf in disc.pending_audio_files
+                ],
+            }
+            for disc in pending_discs
+        ],
+    }
 
-    initial_pending_discs = get_pending_discs(args.audio_dirs, get_tag_overrides(args), args.output_dir, args.singles)
-    pending_discs = update_pending_discs(initial_pending_discs, args.output_dir, args.singles)
+    # readable (and editable) UTF-8 rather than \u escapes
+    data = json.dumps(plan, indent=2, separators=(",", ": "), sort_keys=True, ensure_ascii=False).encode("utf8")
+
+    tmp_fn = plan_fn + ".tmp"
+    with open(tmp_fn, "w") as f:
+        f.write(data)
+    os.rename(tmp_fn, plan_fn)
+
+
+def read_plan(plan_fn):
+    """Rebuilds the PendingDiscs of a plan. Raises a StalePlanException if any of its sources changed since."""
+    with open(plan_fn) as f:
+        plan = json.load(f)
+    assert plan["version"] == PLAN_VERSION, "{} is from an incompatible version of audio-convert.".format(plan_fn)
+
+    output_dir = plan["output_dir"].encode("utf8")
+    pending_discs = []
+    stale = []
+    for disc in plan["discs"]:
+        pending_audio_files = []
+        for entry in disc["audio_files"]:
+            fn = entry["filename"].encode("utf8")
+            if not os.path.exists(fn) or source_stamp(fn) != entry["source_stamp"]:
+                stale.append(fn)
+                continue
+
+            audio_module = audioformat.module_for_filename(fn)
+            assert audio_module is not None, "Unsupported file {} in {}.".format(fn, plan_fn)
+            paf = PendingAudioFile(
+                collector.AudioFile(audio_module, fn),
+                entry["proposed_tags"],
+                entry["num_total_discs"],
+                entry["is_singles"],
+                output_dir,
+            )
+            # every tag is overridden by the plan, so there's no need to read the current ones
+            paf.set_current_tags(audioformat.util.Tags())
+            pending_audio_files.append(paf)
+        if not stale:
+            pending_discs.append(PendingDisc(pending_audio_files, output_dir))
+
+    if stale:
+        raise StalePlanException("{} is stale: {} source file(s) changed or disappeared since it was written:\n{}".format(
+            plan_fn,
+            len(stale),
+            "\n".join(stale),
+        ))
+    return pending_discs
+
+
+def configure_processing(args, output_dirs):
+    """Sets up the encode cache, catalog and journal for processing discs into output_dirs. Returns the JobSlots of
+    --jobs."""
+    encodecache.configure(
+        os.path.join(args.cache_dir, "encode"),
+        max_bytes=int(args.encode_cache_max_gb * (1 << 30)),
+        enabled=not args.no_encode_cache,
+    )
+
+    catalog.configure(args.cache_dir, enabled=not args.no_catalog)
 
+    # intermediate files of discs that can't be resumed; see PendingDisc.process_disc()
+    progress = journal.configure(args.cache_dir)
+    progress.remove_orphaned_work_dirs(progress.work_root(tempfile.gettempdir()))
+    for output_dir in set(output_dirs):
+        util.remove_staging_dir(output_dir)
+
+    return util.JobSlots(args.jobs)
+
+
+def process_discs(pending_discs, args):
+    # every disc gets its own thread, but decoders and encoders across all discs share one budget of --jobs
+    job_slots = configure_processing(args, [disc.output_dir for disc in pending_discs])
+    preflight.check(
+        pending_discs,
+        PROCESSED_DIR,
+        catalog.get_catalog(),
+        stream=args.stream,
+        extra_profiles=args.profiles,
+    )
+    util.parallel_map(
+        lambda disc: disc.process_disc(
+            jobs=job_slots,
+            stream=args.stream,
+            extra_profiles=args.profiles,
+            verify=args.verify,
+        ),
+        pending_discs,
+        len(pending_discs),
+    )
+
+
+class IngestStatus(object):
+    """Counts of what the watch daemon is doing, shared between its threads"""
+    def __init__(self):
+        self.start_time = time.time()
+        self.queued = set()
+        self.in_flight = set()
+        self.num_albums = 0
+        self.num_tracks = 0
+        self.num_bytes = 0
+        self.num_failed = 0
+        self._lock = threading.Lock()
+
+    def queue(self, album):
+        with self._lock:
+            self.queued.add(album)
+
+    def is_pending(self, album):
+        with self._lock:
+            return album in self.queued or album in self.in_flight
+
+    def start(self, album):
+        with self._lock:
+            self.queued.discard(album)
+            self.in_flight.add(album)
+
+    def finish(self, album, num_tracks=0, num_bytes=0, failed=False):
+        with self._lock:
+            self.in_flight.discard(album)
+            if failed:
+                self.num_failed += 1
+            elif num_tracks:
+                self.num_albums += 1
+                self.num_tracks += num_tracks
+                self.num_bytes += num_bytes
+
+    def __str__(self):
+        with self._lock:
+            hours = max(time.time() - self.start_time, 1) / 3600.0
+            return "queued: {}, in flight: {}, done: {} albums / {} tracks ({:.1f} albums/h, {:.1f} MB/min), failed: {}".format(
+                len(self.queued),
+                len(self.in_flight),
+                self.num_albums,
+                self.num_tracks,
+                self.num_albums / hours,
+                self.num_bytes / float(1 << 20) / (hours * 60),
+                self.num_failed,
+            )
+
+
+def ingest_album(album_dir, tag_overrides, args, job_slots):
+    """Converts an album found by the watch daemon. Returns (number of tracks, bytes of source audio)."""
+    audio_dirs = []
+    for scanned in collector.scan_library(album_dir, skip_dirnames=(PROCESSED_DIR,)):
+        if scanned.error is not None:
+            raise scanned.error
+        audio_dirs.append(scanned.path)
+    if not audio_dirs:
+        # e.g. only what's left after its discs were moved to processed/
+        return 0, 0
+
+    pending_discs = get_pending_discs(sorted(audio_dirs), tag_overrides, args.output_dir, False, jobs=job_slots.jobs)
+    # discs of different albums are often named alike (e.g. CD1)
+    processed_subdir = os.path.basename(os.path.normpath(album_dir))
     for disc in pending_discs:
-        disc.process_disc()
+        disc.processed_subdir = processed_subdir
+    pafs = [paf for disc in pending_discs for paf in disc.pending_audio_files]
+    # reject anything that would fail part-way before doing any work
+    preflight.check(
+        pending_discs,
+        PROCESSED_DIR,
+        catalog.get_catalog(),
+        stream=args.stream,
+        extra_profiles=args.profiles,
+    )
+
+    num_bytes = sum(os.path.getsize(paf.current_filename) for paf in pafs)
+    util.parallel_map(
+        lambda disc: disc.process_disc(
+            jobs=job_slots,
+            stream=args.stream,
+            extra_profiles=args.profiles,
+            verify=args.verify,
+        ),
+        pending_discs,
+        len(pending_discs),
+    )
+    retire_album_dir(album_dir, os.path.join(args.output_dir, PROCESSED_DIR, processed_subdir))
+    return len(pafs), num_bytes
+
+
+def retire_album_dir(album_dir, processed_dir):
+    """Once every disc of an album in an inbox has been moved to processed_dir, moves what's left of the album (e.g.
+    cover art) there too and removes its directory, so that it isn't scanned again. Anything processed_dir already has
+    is left in place, and the album directory with it."""
+    if not os.path.isdir(album_dir):
+        # a single disc, moved already
+        return
+    if any(True for _ in collector.scan_library(album_dir, skip_dirnames=(PROCESSED_DIR,))):
+        # audio that arrived since
+        return
+
+    with FILESYSTEM_LOCK:
+        util.makedirs(processed_dir)
+        for name in os.listdir(album_dir):
+            if not os.path.exists(os.path.join(processed_dir, name)):
+                shutil.move(os.path.join(album_dir, name), processed_dir)
+        if not os.listdir(album_dir):
+            os.rmdir(album_dir)
+
+
+def watch_inboxes(args):
+    """Runs the watch daemon until interrupted"""
+    tag_overrides = get_tag_overrides(args)
+    job_slots = configure_processing(args, [args.output_dir])
+    status = IngestStatus()
+
+    albums = Queue.Queue()
+    def _worker():
+        while True:
+            album = albums.get()
+            status.start(album)
+            try:
+                num_tracks, num_bytes = ingest_album(album, tag_overrides, args, job_slots)
+            except Exception:
+                status.finish(album, failed=True)
+                print "Failed {}; left in place until it changes:".format(album)
+                traceback.print_exc()
+                print status
+            else:
+                status.finish(album, num_tracks, num_bytes)
+                if num_tracks:
+                    print "Converted {} ({} tracks).".format(album, num_tracks)
+                    print status
+
+    for _ in xrange(args.workers):
+        t = threading.Thread(target=_worker)
+        t.daemon = True
+        t.start()
+
+    watcher = watch.make_watcher(args.inbox_dirs, poll_interval=args.poll_interval, force_polling=args.poll)
+    tracker = watch.QuietTracker(args.inbox_dirs, args.quiet_period, ignore_names=(PROCESSED_DIR,))
+    print "Watching {} with {}.".format(", ".join(args.inbox_dirs), type(watcher).__name__)
+
+    # whatever is already there counts as new
+    tracker.changed([os.path.join(d, fn) for d in args.inbox_dirs for fn in os.listdir(d)])
+
+    last_status = time.time()
+    try:
+        while True:
+            tracker.changed(watcher.wait(1.0))
+            for album in tracker.pop_quiet():
+                if status.is_pending(album):
+                    # changed while queued or converting (if only by moving its discs out): look again later
+                    tracker.changed([album])
+                    continue
+                status.queue(album)
+                albums.put(album)
+
+            if time.time() - last_status >= args.status_interval:
+                print status
+                last_status = time.time()
+    except KeyboardInterrupt:
+        print "Stopping. Interrupted discs resume where they left off when they're converted again."
+    finally:
+        watcher.close()
+
+
+def main():
+    command, args = parse_args(sys.argv[1:])
+    trace.configure(args.trace, args.trace_format)
+    try:
+        run(command, args)
+    finally:
+        # completes the trace file
+        trace.configure(None)
+
+
+def run(command, args):
+    cache = tagcache.configure(args.cache_dir, enabled=not args.no_tag_cache)
+
+    if command == "watch":
+        watch_inboxes(args)
+        return
+
+    if command == "apply":
+        # read every plan first, so a stale one is rejected before any work is done
+        pending_discs = []
+        for plan_fn in args.plan_fns:
+            pending_discs.extend(read_plan(plan_fn))
+        print "Applying {} disc(s) from {} plan(s).".format(len(pending_discs), len(args.plan_fns))
+        process_discs(pending_discs, args)
+        return
+
+    audio_dirs = args.audio_dirs
+    if args.recursive:
+        audio_dirs = scan_audio_dirs(args.audio_dirs, jobs=args.jobs)
+
+    initial_pending_discs = get_pending_discs(
+        audio_dirs,
+        get_tag_overrides(args),
+        args.output_dir,
+        args.singles,
+        jobs=args.jobs,
+        separate_albums=args.recursive,
+    )
+    if cache is not None:
+        print "Tag cache: {} hits, {} misses".format(cache.hits, cache.misses)
+
+    if command == "plan":
+        write_plan(initial_pending_discs, args.output_dir, args.plan_fn)
+        print "Wrote a plan for {} disc(s) to {}.".format(len(initial_pending_discs), args.plan_fn)
+        return
+
+    pending_discs = update_pending_discs(initial_pending_discs, args.output_dir, args.singles)
+    process_discs(pending_discs, args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,276 @@
+"""Times each stage of converting synthetic albums, writing the results as JSON so runs can be compared.
+
+Albums are generated from sine or noise WAVs and encoded to each source format with its command-line encoder (flac,
+oggenc, faac, lame); formats whose encoder isn't installed are skipped. The stages mirror audio-convert:
+collect, read_tags, decode, encode (whole disc, as with WAV files), stream_encode (decoder piped into lame, as with
+--stream), write_tags and rename/move."""
+
+import argparse
+import distutils.spawn
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from aclib import (
+    collector,
+    tagcache,
+    util,
+)
+from aclib.audioformat import (
+    mp3,
+)
+from aclib.audioformat.util import (
+    Tags,
+)
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+
+# source format -> command encoding wav_fn to output_fn with tags
+ENCODERS = {
+    "flac": lambda wav_fn, output_fn, tags: [
+        "flac", "--silent", "--force",
+        "-T", "ARTIST=" + tags.artist,
+        "-T", "ALBUM=" + tags.album,
+        "-T", "TITLE=" + tags.title,
+        "-T", "DATE={}".format(tags.year),
+        "-T", "TRACKNUMBER={}".format(tags.track_no),
+        "-o", output_fn, wav_fn,
+    ],
+    "ogg": lambda wav_fn, output_fn, tags: [
+        "oggenc", "--quiet",
+        "-a", tags.artist, "-l", tags.album, "-t", tags.title,
+        "-d", str(tags.year), "-N", str(tags.track_no),
+        "-o", output_fn, wav_fn,
+    ],
+    "mp4": lambda wav_fn, output_fn, tags: [
+        "faac", "-w",
+        "--artist", tags.artist, "--album", tags.album, "--title", tags.title,
+        "--year", str(tags.year), "--track", str(tags.track_no),
+        "-o", output_fn, wav_fn,
+    ],
+    "mp3": lambda wav_fn, output_fn, tags: ["lame", "--quiet"] + mp3.LAME_OPTS + [wav_fn, output_fn],
+    "wav": None,
+}
+
+STAGES = ("collect", "read_tags", "decode", "encode", "stream_encode", "write_tags", "rename")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--formats", default=",".join(sorted(ENCODERS)), help="Comma-separated source formats.")
+    parser.add_argument("--tracks", type=int, default=12, help="Tracks per album.")
+    parser.add_argument("--seconds", type=float, default=180.0, help="Length of each track.")
+    parser.add_argument("--signal", choices=("sine", "noise"), default="sine")
+    parser.add_argument("--jobs", "-j", type=int, default=util.default_jobs())
+    parser.add_argument("--repeat", type=int, default=3, help="Times each stage is run; all timings are kept.")
+    parser.add_argument("--work_dir", default=None, help="Where to generate albums; a temporary directory by default.")
+    parser.add_argument("--output_fn", "-o", default="benchmark-{}.json".format(time.strftime("%Y%m%d-%H%M%S")))
+    return parser.parse_args()
+
+
+def write_wav(fn, seconds, signal, seed):
+    """Writes a 16-bit stereo WAV of a sine wave (a different pitch per seed) or white noise"""
+    frame_size = 2 * CHANNELS
+    num_bytes = int(seconds * SAMPLE_RATE) * frame_size
+    rng = random.Random(seed)
+
+    if signal == "sine":
+        # a whole number of cycles per second, so every second is the same
+        freq = int(220 * 2 ** (seed % 24 / 12.0))
+        samples = [int(16000 * math.sin(2 * math.pi * freq * i / SAMPLE_RATE)) for i in xrange(SAMPLE_RATE)]
+        second = struct.pack("<{}h".format(SAMPLE_RATE * CHANNELS), *[s for s in samples for _ in xrange(CHANNELS)])
+
+    w = wave.open(fn, "wb")
+    try:
+        w.setnchannels(CHANNELS)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        for start in xrange(0, num_bytes, SAMPLE_RATE * frame_size):
+            chunk_size = min(SAMPLE_RATE * frame_size, num_bytes - start)
+            if signal == "noise":
+                w.writeframes("{:0{}x}".format(rng.getrandbits(chunk_size * 8), chunk_size * 2).decode("hex"))
+            else:
+                w.writeframes(second[:chunk_size])
+    finally:
+        w.close()
+
+
+def make_album(album_dir, fmt, wav_fns):
+    """Encodes the WAVs as fmt into album_dir. Returns False if fmt's encoder isn't installed."""
+    util.makedirs(album_dir)
+    for track_no, wav_fn in enumerate(wav_fns, 1):
+        output_fn = os.path.join(album_dir, "{:02d}.{}".format(track_no, fmt))
+        tags = Tags(
+            artist=u"Benchmark Artist",
+            album=u"Benchmark Album",
+            title=u"Track {}".format(track_no),
+            year=2020,
+            track_no=track_no,
+        )
+        if ENCODERS[fmt] is None:
+            shutil.copy(wav_fn, output_fn)
+            continue
+        try:
+            subprocess.check_call(ENCODERS[fmt](wav_fn, output_fn, tags))
+        except OSError:
+            return False
+    return True
+
+
+class Timer(object):
+    """Wall-clock time plus the CPU time of this process and its children"""
+    def __enter__(self):
+        self._start = (time.time(), os.times())
+        return self
+
+    def __exit__(self, *exc_info):
+        start_wall, start_times = self._start
+        end_times = os.times()
+        self.wall = time.time() - start_wall
+        self.cpu = sum(end_times[:4]) - sum(start_times[:4])
+
+
+def bench_album(album_dir, scratch_dir, args):
+    """Runs every stage once on a copy of album_dir. Returns {stage: Timer}, without the stages that don't apply."""
+    timers = {}
+    def stage(name):
+        timers[name] = Timer()
+        return timers[name]
+
+    source_dir = os.path.join(scratch_dir, "source")
+    shutil.copytree(album_dir, source_dir)
+    wav_dir = os.path.join(scratch_dir, "wav")
+    mp3_dir = os.path.join(scratch_dir, "mp3")
+    stream_dir = os.path.join(scratch_dir, "stream")
+    output_dir = os.path.join(scratch_dir, "output")
+    for d in (wav_dir, mp3_dir, stream_dir, output_dir):
+        os.makedirs(d)
+
+    with stage("collect"):
+        audio_files = collector.collect_audio_files(source_dir)
+
+    with stage("read_tags"):
+        all_tags = collector.read_tags_many(audio_files, jobs=args.jobs)
+
+    if audio_files[0].ext == ".mp3":
+        # passed through: tagged straight from the source
+        encoded_fns = [af.path for af in audio_files]
+    else:
+        wav_fns = [os.path.join(wav_dir, "{:03d}.wav".format(idx)) for idx in xrange(1, len(audio_files) + 1)]
+        with stage("decode"):
+            util.parallel_map(lambda (af, wav_fn): af.decode(wav_fn), zip(audio_files, wav_fns), args.jobs)
+
+        with stage("encode"):
+            mp3.encode(wav_fns, mp3_dir, jobs=args.jobs)
+        encoded_fns = [os.path.join(mp3_dir, "{:03d}.mp3".format(idx)) for idx in xrange(1, len(audio_files) + 1)]
+
+        with stage("stream_encode"):
+            util.parallel_map(
+                lambda (idx, af): mp3.encode_stream(af.decode_to_pipe(), os.path.join(stream_dir, "{:03d}.mp3".format(idx))),
+                enumerate(audio_files, 1),
+                args.jobs,
+            )
+
+    tagged_fns = [os.path.join(output_dir, ".{:03d}.mp3.tmp".format(idx)) for idx in xrange(1, len(audio_files) + 1)]
+    with stage("write_tags"):
+        util.parallel_map(
+            lambda (encoded_fn, tagged_fn, tags): mp3.write_tagged_copy(
+                encoded_fn,
+                tagged_fn,
+                tags.copy(album_artist=tags.artist, cd_no=1, cd_tracks=len(audio_files)),
+            ),
+            zip(encoded_fns, tagged_fns, all_tags),
+            args.jobs,
+        )
+
+    with stage("rename"):
+        for idx, tagged_fn in enumerate(tagged_fns, 1):
+            os.rename(tagged_fn, os.path.join(output_dir, "{:02d} Track.mp3".format(idx)))
+        processed_dir = os.path.join(scratch_dir, "processed")
+        os.makedirs(processed_dir)
+        shutil.move(source_dir, processed_dir)
+
+    return timers
+
+
+def main():
+    args = parse_args()
+    formats = args.formats.split(",")
+    assert all(fmt in ENCODERS for fmt in formats), "Formats must be among {}.".format(sorted(ENCODERS))
+    if distutils.spawn.find_executable("lame") is None:
+        sys.exit("lame is required: every stage after decoding encodes MP3s.")
+
+    # every read has to hit the files
+    tagcache.configure(enabled=False)
+
+    work_dir = args.work_dir or tempfile.gettempdir()
+    with util.mktempdir(dir=work_dir) as tmpdir:
+        print "Generating {} {:.0f}s {} tracks...".format(args.tracks, args.seconds, args.signal)
+        wav_fns = []
+        for idx in xrange(args.tracks):
+            wav_fns.append(os.path.join(tmpdir, "{:03d}.wav".format(idx)))
+            write_wav(wav_fns[-1], args.seconds, args.signal, idx)
+
+        results = []
+        for fmt in formats:
+            album_dir = os.path.join(tmpdir, "album-" + fmt)
+            if not make_album(album_dir, fmt, wav_fns):
+                print "Skipping {}: encoder not installed.".format(fmt)
+                continue
+            album_bytes = sum(os.path.getsize(os.path.join(album_dir, fn)) for fn in os.listdir(album_dir))
+
+            for run in xrange(args.repeat):
+                with util.mktempdir(dir=tmpdir) as scratch_dir:
+                    timers = bench_album(album_dir, scratch_dir, args)
+                for name in STAGES:
+                    if name not in timers:
+                        continue
+                    results.append({
+                        "format": fmt,
+                        "stage": name,
+                        "run": run,
+                        "wall_seconds": timers[name].wall,
+                        "cpu_seconds": timers[name].cpu,
+                        "tracks": args.tracks,
+                        "audio_seconds": args.tracks * args.seconds,
+                        "source_bytes": album_bytes,
+                    })
+                    print "{:5} {:14} run {}: {:8.3f}s wall {:8.3f}s cpu".format(
+                        fmt, name, run, timers[name].wall, timers[name].cpu)
+
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    with open(args.output_fn, "w") as f:
+        json.dump({
+            "meta": {
+                "time": time.time(),
+                "revision": revision,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "jobs": args.jobs,
+                "tracks": args.tracks,
+                "seconds": args.seconds,
+                "signal": args.signal,
+                "repeat": args.repeat,
+            },
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+    print "Wrote {} results to {}.".format(len(results), args.output_fn)
+
+
+if __name__ == "__main__":
+    main()
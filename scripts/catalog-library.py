@@ -0,0 +1,50 @@
+"""Adds the MP3s already in an output directory to audio-convert's catalog, so they're checked for collisions and
+duplicates like the files audio-convert writes from now on."""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from aclib import (
+    catalog,
+    tagcache,
+    util,
+)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "output_dir",
+        help="Output directory of audio-convert, as given with --output_dir.",
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=util.default_jobs(),
+        help="Number of directories to scan and files to read concurrently. Defaults to the number of cores.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=tagcache.DEFAULT_CACHE_DIR,
+        help="audio-convert's cache directory, which holds the catalog.",
+    )
+    args = parser.parse_args(argv)
+    assert os.path.isdir(args.output_dir), "OUTPUT_DIR must be a directory."
+
+    tagcache.configure(args.cache_dir)
+    output_catalog = catalog.configure(args.cache_dir)
+    start = time.time()
+    try:
+        # the sources audio-convert moved out of the way
+        num_added = catalog.add_library(output_catalog, args.output_dir, jobs=args.jobs, skip_dirnames=("processed",))
+    finally:
+        catalog.configure(args.cache_dir, enabled=False)
+        tagcache.configure(enabled=False)
+    print "Cataloged {} files in {:.1f}s.".format(num_added, time.time() - start)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])